@@ -6,6 +6,7 @@ This module is the unit test for the core API Lambda functions.
 """
 
 import os
+import json
 import unittest
 from unittest.mock import patch
 from requests.models import Response
@@ -70,12 +71,31 @@ class CoreCustomResourcesTestCase(unittest.TestCase):
         This function tests the generate_keys custom resource function
         """ 
         # test create
-        generate_keys.create(None, None)
+        mock_event = {"ResourceProperties": {}}
+        generate_keys.create(mock_event, None)
+        private_jwk = json.loads(generate_keys.secrets_client.create_secret.call_args_list[0].kwargs['SecretString'])
+        self.assertEqual(private_jwk['alg'], 'RS256')
+
+        # test create with other signing algorithms
+        for (key_algorithm, kty) in [('ES256', 'EC'), ('EdDSA', 'OKP')]:
+            generate_keys.create({"ResourceProperties": {"KeyAlgorithm": key_algorithm}}, None)
+            public_jwk = json.loads(generate_keys.secrets_client.create_secret.call_args.kwargs['SecretString'])
+            self.assertEqual(public_jwk['alg'], key_algorithm)
+            self.assertEqual(public_jwk['kty'], kty)
+            self.assertNotIn('d', public_jwk)
 
         # test create with exception
         with patch.object(generate_keys.secrets_client, 'create_secret', side_effect=Exception):
             with self.assertRaises(Exception):
-                generate_keys.create(None, None)
+                generate_keys.create(mock_event, None)
+
+        # test update keeps the keys unless the signing algorithm changed
+        with patch.object(generate_keys.secrets_client, 'put_secret_value') as mock_put_secret_value:
+            generate_keys.update({"ResourceProperties": {"KeyAlgorithm": "RS256"}, "OldResourceProperties": {}}, None)
+            mock_put_secret_value.assert_not_called()
+            generate_keys.update({"ResourceProperties": {"KeyAlgorithm": "ES256"}, "OldResourceProperties": {"KeyAlgorithm": "RS256"}}, None)
+            self.assertEqual(mock_put_secret_value.call_count, 2)
+            self.assertEqual(json.loads(mock_put_secret_value.call_args.kwargs['SecretString'])['alg'], 'ES256')
 
         # test delete
         generate_keys.delete(None, None)
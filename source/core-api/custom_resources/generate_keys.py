@@ -24,6 +24,14 @@ user_config = config.Config(**user_agent_extra)
 secrets_client = boto3.client('secretsmanager', config=user_config)
 SECRET_NAME_PREFIX = os.environ["STACK_NAME"]
 
+# key parameters for each supported JWT signing algorithm
+KEY_PARAMETERS = {
+    'RS256': {'kty': 'RSA', 'size': 2048},
+    'ES256': {'kty': 'EC', 'crv': 'P-256'},
+    'EdDSA': {'kty': 'OKP', 'crv': 'Ed25519'}
+}
+DEFAULT_KEY_ALGORITHM = 'RS256'
+
 
 @helper.create
 def create(event, _):
@@ -32,20 +40,7 @@ def create(event, _):
     Keys generated are stored in Secrets Manager.
     """
     print(event)
-
-    # key id
-    kid = uuid.uuid4().hex
-
-    # create JWK format keys
-    keypair = jwk.JWK.generate(kid=kid, alg='RS256', kty='RSA', size=2048)
-
-    # get the private and public JWK from the pair
-    private_jwk = keypair.export_private(as_dict=True)
-    print("Private key generated.")
-
-    public_jwk = keypair.export_public(as_dict=True)
-    print("Public key generated")
-    print(f"{json.dumps(public_jwk, indent=4)}")
+    (private_jwk, public_jwk) = generate_keypair(get_key_algorithm(event['ResourceProperties']))
 
     # store pub/private keys in secrets manager
     try:
@@ -70,10 +65,28 @@ def create(event, _):
 @helper.update
 def update(event, _):
     """
-    Keys will not be regenerated on resource updates.
+    Keys will not be regenerated on resource updates unless the signing algorithm changed.
     """
     print(event)
-    print("Not going to update keys on update.")
+    key_algorithm = get_key_algorithm(event['ResourceProperties'])
+    if key_algorithm == get_key_algorithm(event.get('OldResourceProperties', {})):
+        print("Not going to update keys on update.")
+        return
+
+    # tokens signed with the previous key can no longer be verified
+    (private_jwk, public_jwk) = generate_keypair(key_algorithm)
+    try:
+        secrets_client.put_secret_value(
+            SecretId=f"{SECRET_NAME_PREFIX}/jwk-private",
+            SecretString=json.dumps(private_jwk))
+        print("Private key updated in secrets manager.")
+        secrets_client.put_secret_value(
+            SecretId=f"{SECRET_NAME_PREFIX}/jwk-public",
+            SecretString=json.dumps(public_jwk))
+        print("Public key updated in secrets manager.")
+    except Exception as exception:
+        print(exception)
+        raise exception
 
 
 @helper.delete
@@ -93,6 +106,34 @@ def delete(event, _):
     print(response)
 
 
+def get_key_algorithm(resource_properties) -> str:
+    """
+    Returns the signing algorithm requested by the resource properties
+    """
+    return resource_properties.get('KeyAlgorithm', DEFAULT_KEY_ALGORITHM)
+
+
+def generate_keypair(key_algorithm):
+    """
+    This function generates a key pair for the signing algorithm and
+    returns the private and public JWK as dictionaries.
+    """
+    # key id
+    kid = uuid.uuid4().hex
+
+    # create JWK format keys
+    keypair = jwk.JWK.generate(kid=kid, alg=key_algorithm, **KEY_PARAMETERS[key_algorithm])
+
+    # get the private and public JWK from the pair
+    private_jwk = keypair.export_private(as_dict=True)
+    print(f"{key_algorithm} private key generated.")
+
+    public_jwk = keypair.export_public(as_dict=True)
+    print("Public key generated")
+    print(f"{json.dumps(public_jwk, indent=4)}")
+    return (private_jwk, public_jwk)
+
+
 def handler(event, context):
     """
     This function is the entry point for the Lambda-backed custom resource.
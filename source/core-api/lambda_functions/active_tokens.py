@@ -0,0 +1,67 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: Apache-2.0
+
+"""
+This module maintains the set of active tokens in Redis.
+A token is added when it is issued and removed when its session is completed or abandoned.
+Members are scored by the token expiry time, so expired tokens are excluded by the count
+without having to be removed first.
+"""
+
+from time import time
+from boto3.dynamodb.conditions import Key, Attr
+from counters import ACTIVE_TOKENS
+from token_index import query_token_index
+
+
+def add_active_token(rc, request_id, expires) -> None:
+    """
+    Add an issued token to the active tokens
+    """
+    rc.zadd(ACTIVE_TOKENS, {request_id: expires})
+
+
+def remove_active_token(rc, request_id) -> None:
+    """
+    Remove a token whose session is completed or abandoned from the active tokens
+    """
+    rc.zrem(ACTIVE_TOKENS, request_id)
+
+
+def remove_active_tokens(rc, request_ids) -> None:
+    """
+    Remove the tokens of several completed or abandoned sessions from the active tokens
+    """
+    if request_ids:
+        rc.zrem(ACTIVE_TOKENS, *request_ids)
+
+
+def count_active_tokens(rc) -> int:
+    """
+    Returns the number of tokens that have not expired, expired tokens are pruned in the same round trip
+    """
+    pipe = rc.pipeline()
+    queue_count_active_tokens(pipe, int(time()))
+    (_, count) = pipe.execute()
+    return int(count)
+
+
+def queue_count_active_tokens(pipe, current_time) -> None:
+    """
+    Queue the commands pruning the expired tokens and counting the active ones on a pipeline.
+    The count is the last of the two results.
+    """
+    pipe.zremrangebyscore(ACTIVE_TOKENS, "-inf", f"({current_time}")
+    pipe.zcount(ACTIVE_TOKENS, current_time, "+inf")
+
+
+def query_active_tokens(ddb_table, event_id, token_index_shards, expires_from, expires_before) -> list:
+    """
+    Returns the active tokens (request_id and expires) in the token table that expire
+    at or after expires_from and before expires_before
+    """
+    return query_token_index(
+        ddb_table, event_id, token_index_shards, Key('expires').between(expires_from, expires_before - 1),
+        ProjectionExpression="request_id, expires",
+        FilterExpression=Attr('session_status').eq(0)
+    )
@@ -13,77 +13,101 @@ import os
 import json
 import boto3
 import redis
-from time import time
 from botocore import config
 from vwr.common.sanitize import deep_clean
-from counters import QUEUE_COUNTER
+import queue_assignment
+from queue_assignment import ASSIGN_QUEUE_NUM_SCRIPT, reserve_queue_numbers
+from queue_number_lease import QueueNumberAllocator
+from telemetry import RECORD_TELEMETRY_SCRIPT, ENQUEUED, record_telemetry
 
 # connection info and other globals
 SOLUTION_ID = os.environ['SOLUTION_ID']
 REDIS_HOST = os.environ["REDIS_HOST"]
 REDIS_PORT = os.environ["REDIS_PORT"]
-QUEUE_URL = os.environ["QUEUE_URL"]
 EVENT_ID = os.environ["EVENT_ID"]
 SECRET_NAME_PREFIX = os.environ["STACK_NAME"]
 QUEUE_POSITION_ENTRYTIME_TABLE = os.environ["QUEUE_POSITION_ENTRYTIME_TABLE"]
 ENABLE_QUEUE_POSITION_EXPIRY = os.environ["ENABLE_QUEUE_POSITION_EXPIRY"]
+ENABLE_QUEUE_POSITION_WRITE_BEHIND = os.environ["ENABLE_QUEUE_POSITION_WRITE_BEHIND"]
+QUEUE_NUMBER_LEASE_SIZE = int(os.environ["QUEUE_NUMBER_LEASE_SIZE"])
+
+# number of assignments written to DynamoDB and marked as persisted per step
+PERSIST_CHUNK_SIZE = 500
 
 boto_session = boto3.session.Session()
 region = boto_session.region_name
 user_agent_extra = {"user_agent_extra": SOLUTION_ID}
 user_config = config.Config(**user_agent_extra)
-sqs_client = boto3.client('sqs', config=user_config, endpoint_url=f"https://sqs.{region}.amazonaws.com")
 secrets_client = boto3.client('secretsmanager', config=user_config, endpoint_url=f"https://secretsmanager.{region}.amazonaws.com")
 secrets_response = secrets_client.get_secret_value(SecretId=f"{SECRET_NAME_PREFIX}/redis-auth")
 redis_auth = secrets_response.get("SecretString")
 rc = redis.Redis(host=REDIS_HOST, port=REDIS_PORT, ssl=True, decode_responses=True, password=redis_auth)
 ddb_resource = boto3.resource('dynamodb', endpoint_url=f'https://dynamodb.{region}.amazonaws.com', config=user_config)
-ddb_table = ddb_resource.Table(QUEUE_POSITION_ENTRYTIME_TABLE)
+
+assign_queue_num_script = rc.register_script(ASSIGN_QUEUE_NUM_SCRIPT)
+record_telemetry_script = rc.register_script(RECORD_TELEMETRY_SCRIPT)
+
+# hand out queue numbers from leased blocks if enabled
+allocator = QueueNumberAllocator(rc, QUEUE_NUMBER_LEASE_SIZE) if QUEUE_NUMBER_LEASE_SIZE > 0 else None
 
 
 def lambda_handler(event, _):
     """
     This function is the entry handler for Lambda.
+    Messages that fail processing are reported back to SQS as batch item failures,
+    successfully processed messages are deleted by the event source mapping.
+    Batches can hold up to 10,000 messages, so only the batch size is logged.
     """
-    print(event)
-    num_msg = len(event['Records'])
-    cur_count = rc.incr(QUEUE_COUNTER, num_msg)
-    print(cur_count)
-    q_start_num = cur_count - (num_msg-1)
-    
-    # iterate over msgs
-    return_with_exception = False
+    print(f"Messages received: {len(event['Records'])}")
+    batch_item_failures = []
+
+    # parse and validate the whole batch before any queue number is reserved
+    # redelivered duplicates of the same request ID share one assignment
+    valid_msgs = {}
     for msg in event['Records']:
         try:
             body = json.loads(msg['body'])
             request_id = msg['messageAttributes']['apig_request_id']['stringValue']
             client_event_id = deep_clean(body['event_id'])
-
-            # if valid, assign number and del msg
-            # if the event ID is invalid, don't process it at all
-            if client_event_id == EVENT_ID:
-                item = {
-                    'event_id': EVENT_ID,
-                    'queue_position': int(q_start_num),
-                    'entry_time': int(time()), 
-                    'request_id': request_id,
-                    'status': 1
-                }
-                ddb_table.put_item(Item=item)
-                print(f"Item: {item}")
-
-            # sqs has a vpc endpoint
-            response = sqs_client.delete_message(
-                QueueUrl=QUEUE_URL,
-                ReceiptHandle=msg["receiptHandle"]
-            )
-            print(response)
-            q_start_num += 1 
         except Exception as exception: # NOSONAR
             print(exception)
-            return_with_exception = True
-    if return_with_exception:
-        raise Exception("one or more messages failed processing") # NOSONAR
+            batch_item_failures.append({"itemIdentifier": msg['messageId']})
+            continue
+        # if the event ID is invalid, don't process it at all
+        if client_event_id != EVENT_ID:
+            print(f"Invalid event ID for request ID {request_id}")
+            continue
+        valid_msgs.setdefault(request_id, []).append(msg['messageId'])
+
+    if not valid_msgs:
+        return {"batchItemFailures": batch_item_failures}
+
+    # check for existing assignments and reserve exactly one queue number
+    # per new valid request ID in a single round trip
+    request_ids = list(valid_msgs)
+    assignments = allocator.reserve(request_ids) if allocator else reserve_queue_numbers(assign_queue_num_script, request_ids)
+    # count the requests assigned a queue number for the first time
+    record_telemetry(record_telemetry_script, {ENQUEUED: sum(1 for (_, persisted) in assignments if persisted == -1)})
 
-    # return the current count based on this batch process
-    return cur_count
+    # persist the assignments chunk by chunk so memory use stays bounded for large batches
+    for start in range(0, len(request_ids), PERSIST_CHUNK_SIZE):
+        chunk = zip(request_ids[start:start + PERSIST_CHUNK_SIZE], assignments[start:start + PERSIST_CHUNK_SIZE])
+        batch_item_failures.extend(persist_assignments(chunk, valid_msgs))
+
+    print(f"Messages: {len(event['Records'])}. Failed messages: {len(batch_item_failures)}")
+    return {"batchItemFailures": batch_item_failures}
+
+
+
+def persist_assignments(assignments, valid_msgs) -> list:
+    """
+    Persist the (request ID, assignment) pairs that are not persisted yet.
+    Returns the batch item failures for the pairs that could not be written.
+    """
+    (_, failed_request_ids) = queue_assignment.persist_assignments(
+        rc, ddb_resource, QUEUE_POSITION_ENTRYTIME_TABLE, EVENT_ID, ENABLE_QUEUE_POSITION_WRITE_BEHIND, ENABLE_QUEUE_POSITION_EXPIRY, assignments
+    )
+    return [
+        {"itemIdentifier": msg_id}
+        for request_id in failed_request_ids for msg_id in valid_msgs[request_id]
+    ]
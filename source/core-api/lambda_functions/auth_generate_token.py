@@ -15,7 +15,9 @@ from http  import HTTPStatus
 from botocore import config
 from vwr.common.sanitize import deep_clean
 from vwr.common.validate import is_valid_rid
+from vwr.common.events import EventPublisher
 from generate_token_base import generate_token_base_method
+from telemetry import RECORD_TELEMETRY_SCRIPT
 
 # connection info and other globals
 REDIS_HOST = os.environ["REDIS_HOST"]
@@ -30,6 +32,9 @@ QUEUE_POSITION_ENTRYTIME_TABLE = os.environ["QUEUE_POSITION_ENTRYTIME_TABLE"]
 QUEUE_POSITION_EXPIRY_PERIOD = os.environ["QUEUE_POSITION_EXPIRY_PERIOD"]
 SERVING_COUNTER_ISSUEDAT_TABLE = os.environ["SERVING_COUNTER_ISSUEDAT_TABLE"]
 ENABLE_QUEUE_POSITION_EXPIRY = os.environ["ENABLE_QUEUE_POSITION_EXPIRY"]
+ENABLE_QUEUE_POSITION_WRITE_BEHIND = os.environ["ENABLE_QUEUE_POSITION_WRITE_BEHIND"]
+ASYNC_EVENT_PUBLISHING = os.environ["ASYNC_EVENT_PUBLISHING"]
+TOKEN_INDEX_SHARDS = int(os.environ["TOKEN_INDEX_SHARDS"])
 
 boto_session = boto3.session.Session()
 region = boto_session.region_name
@@ -40,11 +45,14 @@ ddb_table_tokens = ddb_resource.Table(DDB_TOKEN_TABLE)
 ddb_table_queue_position_entry_time = ddb_resource.Table(QUEUE_POSITION_ENTRYTIME_TABLE)
 ddb_table_serving_counter_issued_at = ddb_resource.Table(SERVING_COUNTER_ISSUEDAT_TABLE)
 events_client = boto3.client('events', endpoint_url=f'https://events.{region}.amazonaws.com', config=user_config)
+# token_generated events are sent by a background thread if enabled
+event_publisher = EventPublisher(events_client, EVENT_BUS_NAME, asynchronous=ASYNC_EVENT_PUBLISHING == 'true')
 
 secrets_client = boto3.client('secretsmanager', endpoint_url=f'https://secretsmanager.{region}.amazonaws.com', config=user_config)
 response = secrets_client.get_secret_value(SecretId=f"{SECRET_NAME_PREFIX}/redis-auth")
 redis_auth = response.get("SecretString")
 rc = redis.Redis(host=REDIS_HOST, port=REDIS_PORT, ssl=True, decode_responses=True, password=redis_auth)
+record_telemetry_script = rc.register_script(RECORD_TELEMETRY_SCRIPT)
 
 def lambda_handler(event, _):
     """
@@ -77,8 +85,13 @@ def lambda_handler(event, _):
         }
 
     is_key_id_in_header = False
-    return generate_token_base_method(
-        EVENT_ID, request_id, headers, rc, ENABLE_QUEUE_POSITION_EXPIRY, QUEUE_POSITION_EXPIRY_PERIOD, 
-        secrets_client, SECRET_NAME_PREFIX, VALIDITY_PERIOD, issuer, events_client, EVENT_BUS_NAME, is_key_id_in_header,
-        ddb_table_tokens, ddb_table_queue_position_entry_time, ddb_table_serving_counter_issued_at
-    )
+    try:
+        return generate_token_base_method(
+            EVENT_ID, request_id, headers, rc, ENABLE_QUEUE_POSITION_EXPIRY, QUEUE_POSITION_EXPIRY_PERIOD, 
+            secrets_client, SECRET_NAME_PREFIX, VALIDITY_PERIOD, issuer, event_publisher, is_key_id_in_header,
+            ddb_table_tokens, ddb_table_queue_position_entry_time, ddb_table_serving_counter_issued_at,
+            ENABLE_QUEUE_POSITION_WRITE_BEHIND, TOKEN_INDEX_SHARDS, record_telemetry_script
+        )
+    finally:
+        # events sent asynchronously must be sent before the execution environment is frozen
+        event_publisher.flush()
@@ -0,0 +1,76 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: Apache-2.0
+
+"""
+This module provides the bulk write helpers for the DynamoDB tables used by the core API.
+Items are written (or deleted) with BatchWriteItem in chunks of 25 and unprocessed items are retried.
+"""
+
+from time import sleep
+from botocore.exceptions import ClientError
+
+# maximum number of requests accepted by a single BatchWriteItem call
+MAX_BATCH_WRITE_ITEMS = 25
+
+# number of BatchWriteItem calls made for a chunk before giving up on its unprocessed items
+MAX_BATCH_WRITE_ATTEMPTS = 5
+
+# base delay (seconds) for the exponential backoff between retries of unprocessed items
+RETRY_BASE_DELAY = 0.05
+
+
+def batch_put_items(ddb_resource, table_name, items) -> list:
+    """
+    Write items to the table in chunks of 25.
+    Returns the items that could not be written so the caller can report them per record.
+    """
+    failed_items = []
+    for start in range(0, len(items), MAX_BATCH_WRITE_ITEMS):
+        chunk = items[start:start + MAX_BATCH_WRITE_ITEMS]
+        failed_items.extend(write_chunk(ddb_resource, table_name, chunk))
+    return failed_items
+
+
+def batch_delete_items(ddb_resource, table_name, keys) -> list:
+    """
+    Delete the items with the given keys from the table in chunks of 25.
+    Returns the keys of the items that could not be deleted.
+    """
+    failed_keys = []
+    for start in range(0, len(keys), MAX_BATCH_WRITE_ITEMS):
+        delete_requests = [{'DeleteRequest': {'Key': key}} for key in keys[start:start + MAX_BATCH_WRITE_ITEMS]]
+        unprocessed = send_write_requests(ddb_resource, table_name, delete_requests)
+        failed_keys.extend(delete_request['DeleteRequest']['Key'] for delete_request in unprocessed)
+    return failed_keys
+
+
+def write_chunk(ddb_resource, table_name, chunk) -> list:
+    """
+    Write a single chunk (at most 25 items) and retry unprocessed items with exponential backoff.
+    Returns the items that are still unprocessed.
+    """
+    put_requests = send_write_requests(ddb_resource, table_name, [{'PutRequest': {'Item': item}} for item in chunk])
+    return [put_request['PutRequest']['Item'] for put_request in put_requests]
+
+
+def send_write_requests(ddb_resource, table_name, write_requests) -> list:
+    """
+    Send at most 25 write (put or delete) requests and retry unprocessed requests with exponential backoff.
+    Returns the requests that are still unprocessed.
+    """
+    attempt = 0
+    while write_requests:
+        try:
+            response = ddb_resource.batch_write_item(RequestItems={table_name: write_requests})
+        except ClientError as e:
+            print(e)
+            break
+        write_requests = response.get('UnprocessedItems', {}).get(table_name, [])
+        attempt += 1
+        if not write_requests or attempt >= MAX_BATCH_WRITE_ATTEMPTS:
+            break
+        sleep(RETRY_BASE_DELAY * (2 ** attempt))
+
+    if write_requests:
+        print(f'{len(write_requests)} requests not written to {table_name}')
+    return write_requests
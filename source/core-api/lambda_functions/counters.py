@@ -29,3 +29,82 @@ MAX_QUEUE_POSITION_EXPIRED = "max_queue_position_expired"
 
 # indicate if reset in progress
 RESET_IN_PROGRESS = "reset_in_progress"
+
+# prefix of the per request ID records of assigned queue numbers
+ASSIGNED_QUEUE_NUM_PREFIX = "assigned_queue_num"
+
+# prefix of the per request ID queue position records kept by the write-behind store
+QUEUE_POSITION_PREFIX = "queue_position"
+
+# request IDs whose queue position records are not persisted to DynamoDB yet
+# (scored by queue position, records that could not be written are moved behind the others)
+PENDING_QUEUE_POSITIONS = "pending_queue_positions"
+
+# request IDs whose queue position records could not be persisted after several attempts (scored by queue position),
+# their records are kept in Redis without expiry
+FAILED_QUEUE_POSITIONS = "failed_queue_positions"
+
+# entry times of the queue positions pending expiry
+# (member "queue_position:entry_time:generation", scored by queue position)
+QUEUE_POSITION_ENTRY_TIMES = "queue_position_entry_times"
+
+# leases of queue number blocks (scored by lease expiry time)
+QUEUE_NUMBER_LEASES = "queue_number_leases"
+
+# prefix of the per lease records holding the next unassigned and the last position of the block
+QUEUE_NUMBER_LEASE_PREFIX = "queue_number_lease"
+
+# queue positions that were leased but never assigned (tombstones)
+QUEUE_POSITION_GAPS = "queue_position_gaps"
+
+# prefix of the per request ID records of serialized tokens issued by generate_token
+# Bandit B105: not a hardcoded password
+TOKEN_CACHE_PREFIX = "token_cache" # nosec
+
+# issue times of the serving counter values (member "serving_counter:issue_time", scored by serving counter)
+SERVING_COUNTER_ISSUE_TIMES = "serving_counter_issue_times"
+
+# queue time (latest of entry and issue time) of the first serving counter item pending expiry
+# (single member "next", scored by time, +inf when no item is pending)
+QUEUE_POSITION_EXPIRY_SCHEDULE = "queue_position_expiry_schedule"
+
+# request IDs of issued tokens that are not completed or abandoned (scored by token expiry time)
+# Bandit B105: not a hardcoded password
+ACTIVE_TOKENS = "active_tokens" # nosec
+
+# generation of the waiting room state, incremented by each reset in generation mode
+RESET_GENERATION = "reset_generation"
+
+# generation up to which (excluded) the DynamoDB items of previous generations have been purged
+PURGED_GENERATION = "purged_generation"
+
+# ring buffer of the per-second telemetry counts
+TELEMETRY = "telemetry"
+
+# counters returned by get_counters
+SNAPSHOT_COUNTERS = [
+    QUEUE_COUNTER,
+    SERVING_COUNTER,
+    TOKEN_COUNTER,
+    EXPIRED_QUEUE_COUNTER,
+    COMPLETED_SESSION_COUNTER,
+    ABANDONED_SESSION_COUNTER,
+    MAX_QUEUE_POSITION_EXPIRED,
+    RESET_IN_PROGRESS,
+    RESET_GENERATION
+]
+
+
+def get_counters(rc) -> dict:
+    """
+    Returns a consistent snapshot of the counters read in a single MGET (one round trip).
+    Counters that are not set are returned as 0.
+    """
+    return parse_counters(rc.mget(SNAPSHOT_COUNTERS))
+
+
+def parse_counters(values) -> dict:
+    """
+    Returns the counters from the values of a MGET of SNAPSHOT_COUNTERS, e.g. one queued on a pipeline
+    """
+    return {name: int(value or 0) for (name, value) in zip(SNAPSHOT_COUNTERS, values)}
@@ -0,0 +1,144 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: Apache-2.0
+
+"""
+This module is the assign_queue_num API handler used when synchronous enqueue is enabled.
+While the SQS backlog is below the configured threshold, the queue number is assigned
+inline and returned in the response. Under load, the request is sent to the SQS queue
+and assigned a queue number by assign_queue_num as usual.
+"""
+
+# pylint: disable=E0401,C0301,W0703
+
+import os
+import json
+import boto3
+import redis
+from time import time
+from http import HTTPStatus
+from botocore import config
+from vwr.common.sanitize import deep_clean
+from queue_assignment import ASSIGN_QUEUE_NUM_SCRIPT, reserve_queue_numbers, persist_assignments
+from queue_number_lease import QueueNumberAllocator
+from telemetry import RECORD_TELEMETRY_SCRIPT, ENQUEUED, record_telemetry
+
+# connection info and other globals
+SOLUTION_ID = os.environ['SOLUTION_ID']
+REDIS_HOST = os.environ["REDIS_HOST"]
+REDIS_PORT = os.environ["REDIS_PORT"]
+EVENT_ID = os.environ["EVENT_ID"]
+SECRET_NAME_PREFIX = os.environ["STACK_NAME"]
+QUEUE_URL = os.environ["QUEUE_URL"]
+QUEUE_POSITION_ENTRYTIME_TABLE = os.environ["QUEUE_POSITION_ENTRYTIME_TABLE"]
+ENABLE_QUEUE_POSITION_EXPIRY = os.environ["ENABLE_QUEUE_POSITION_EXPIRY"]
+ENABLE_QUEUE_POSITION_WRITE_BEHIND = os.environ["ENABLE_QUEUE_POSITION_WRITE_BEHIND"]
+QUEUE_NUMBER_LEASE_SIZE = int(os.environ["QUEUE_NUMBER_LEASE_SIZE"])
+SYNC_ENQUEUE_MAX_BACKLOG = int(os.environ["SYNC_ENQUEUE_MAX_BACKLOG"])
+
+# seconds the SQS backlog measurement is reused before the queue attributes are read again
+BACKLOG_CACHE_SECONDS = 2
+
+boto_session = boto3.session.Session()
+region = boto_session.region_name
+user_agent_extra = {"user_agent_extra": SOLUTION_ID}
+user_config = config.Config(**user_agent_extra)
+secrets_client = boto3.client('secretsmanager', config=user_config, endpoint_url=f"https://secretsmanager.{region}.amazonaws.com")
+secrets_response = secrets_client.get_secret_value(SecretId=f"{SECRET_NAME_PREFIX}/redis-auth")
+redis_auth = secrets_response.get("SecretString")
+rc = redis.Redis(host=REDIS_HOST, port=REDIS_PORT, ssl=True, decode_responses=True, password=redis_auth)
+ddb_resource = boto3.resource('dynamodb', endpoint_url=f'https://dynamodb.{region}.amazonaws.com', config=user_config)
+sqs_client = boto3.client('sqs', config=user_config, endpoint_url=f"https://sqs.{region}.amazonaws.com")
+
+assign_queue_num_script = rc.register_script(ASSIGN_QUEUE_NUM_SCRIPT)
+record_telemetry_script = rc.register_script(RECORD_TELEMETRY_SCRIPT)
+
+# hand out queue numbers from leased blocks if enabled
+allocator = QueueNumberAllocator(rc, QUEUE_NUMBER_LEASE_SIZE) if QUEUE_NUMBER_LEASE_SIZE > 0 else None
+
+# last backlog measurement and when it was taken
+backlog_cache = {"backlog": 0, "measured_at": 0}
+
+
+def lambda_handler(event, _):
+    """
+    This function is the entry handler for Lambda.
+    """
+    print(event)
+    request_id = event['requestContext']['requestId']
+    headers = {
+        'Content-Type': 'application/json',
+        'Access-Control-Allow-Origin': '*'
+    }
+
+    try:
+        body = json.loads(event['body'])
+        client_event_id = deep_clean(body['event_id'])
+    except Exception as exception: # NOSONAR
+        print(exception)
+        client_event_id = None
+
+    if client_event_id != EVENT_ID:
+        return {
+            "statusCode": HTTPStatus.BAD_REQUEST.value,
+            "headers": headers,
+            "body": json.dumps({"error": "Invalid event ID"})
+        }
+
+    # the client polls /queue_num as usual if the request was queued
+    response_body = {"api_request_id": request_id}
+    if get_backlog() < SYNC_ENQUEUE_MAX_BACKLOG:
+        item = assign_inline(request_id)
+        if item:
+            response_body.update({
+                'queue_number': item['queue_position'],
+                'entry_time': item['entry_time'],
+                'event_id': item['event_id'],
+                'status': item['status']
+            })
+    if 'queue_number' not in response_body:
+        sqs_client.send_message(
+            QueueUrl=QUEUE_URL,
+            MessageBody=event['body'],
+            MessageAttributes={"apig_request_id": {"StringValue": request_id, "DataType": "String"}}
+        )
+
+    return {
+        "statusCode": HTTPStatus.OK.value,
+        "headers": headers,
+        "body": json.dumps(response_body)
+    }
+
+
+def get_backlog() -> int:
+    """
+    Returns the approximate number of requests in the SQS queue waiting for a queue number.
+    The measurement is cached for a few seconds so that the queue attributes are not read on every request.
+    """
+    current_time = time()
+    if current_time - backlog_cache["measured_at"] >= BACKLOG_CACHE_SECONDS:
+        response = sqs_client.get_queue_attributes(
+            QueueUrl=QUEUE_URL,
+            AttributeNames=['ApproximateNumberOfMessages', 'ApproximateNumberOfMessagesNotVisible']
+        )
+        attributes = response['Attributes']
+        backlog_cache["backlog"] = int(attributes['ApproximateNumberOfMessages']) + int(attributes['ApproximateNumberOfMessagesNotVisible'])
+        backlog_cache["measured_at"] = current_time
+        print(f"SQS backlog: {backlog_cache['backlog']}")
+    return backlog_cache["backlog"]
+
+
+def assign_inline(request_id):
+    """
+    Assign a queue number to the request and persist it.
+    Returns the queue position item, or None if it could not be written.
+    The reserved number is kept in the assignment record, so a request that falls back
+    to the SQS queue is persisted with the same queue number by assign_queue_num.
+    """
+    assignments = allocator.reserve([request_id]) if allocator else reserve_queue_numbers(assign_queue_num_script, [request_id])
+    record_telemetry(record_telemetry_script, {ENQUEUED: sum(1 for (_, persisted) in assignments if persisted == -1)})
+    (items, failed_request_ids) = persist_assignments(
+        rc, ddb_resource, QUEUE_POSITION_ENTRYTIME_TABLE, EVENT_ID, ENABLE_QUEUE_POSITION_WRITE_BEHIND, ENABLE_QUEUE_POSITION_EXPIRY, zip([request_id], assignments)
+    )
+    if request_id in failed_request_ids or not items:
+        return None
+    return items[0]
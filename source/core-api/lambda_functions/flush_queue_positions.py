@@ -0,0 +1,58 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: Apache-2.0
+
+"""
+This module runs only if the queue position write-behind store is enabled during core API deployment.
+It persists queue position records staged in Redis by assign_queue_num to the QueuePositionEntryTime table.
+It is invoked every minute and keeps flushing until the invocation is about to time out.
+"""
+
+import os
+import boto3
+import redis
+from time import sleep
+from botocore import config
+from queue_positions import REQUEUE_FAILED_SCRIPT, flush_queue_positions
+
+# connection info and other globals
+SOLUTION_ID = os.environ['SOLUTION_ID']
+REDIS_HOST = os.environ["REDIS_HOST"]
+REDIS_PORT = os.environ["REDIS_PORT"]
+SECRET_NAME_PREFIX = os.environ["STACK_NAME"]
+QUEUE_POSITION_ENTRYTIME_TABLE = os.environ["QUEUE_POSITION_ENTRYTIME_TABLE"]
+
+# number of records taken from the pending set per flush
+FLUSH_BATCH_SIZE = 500
+
+# seconds to wait before flushing again when the pending set has been drained
+FLUSH_INTERVAL = 1
+
+# stop flushing when less than this many milliseconds are left in the invocation
+FLUSH_TIME_MARGIN_MS = 5000
+
+boto_session = boto3.session.Session()
+region = boto_session.region_name
+user_agent_extra = {"user_agent_extra": SOLUTION_ID}
+user_config = config.Config(**user_agent_extra)
+secrets_client = boto3.client('secretsmanager', config=user_config, endpoint_url=f"https://secretsmanager.{region}.amazonaws.com")
+response = secrets_client.get_secret_value(SecretId=f"{SECRET_NAME_PREFIX}/redis-auth")
+redis_auth = response.get("SecretString")
+rc = redis.Redis(host=REDIS_HOST, port=REDIS_PORT, ssl=True, decode_responses=True, password=redis_auth)
+requeue_failed_script = rc.register_script(REQUEUE_FAILED_SCRIPT)
+ddb_resource = boto3.resource('dynamodb', endpoint_url=f'https://dynamodb.{region}.amazonaws.com', config=user_config)
+
+
+def lambda_handler(event, context):
+    """
+    This function is the entry handler for Lambda.
+    """
+    print(event)
+    flushed = 0
+    while context.get_remaining_time_in_millis() > FLUSH_TIME_MARGIN_MS:
+        count = flush_queue_positions(rc, requeue_failed_script, ddb_resource, QUEUE_POSITION_ENTRYTIME_TABLE, FLUSH_BATCH_SIZE)
+        flushed += count
+        # pending set drained, wait for new records
+        if count < FLUSH_BATCH_SIZE:
+            sleep(FLUSH_INTERVAL)
+    print(f"Queue positions flushed: {flushed}")
+    return flushed
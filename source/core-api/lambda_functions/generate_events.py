@@ -5,30 +5,35 @@
 This module runs only if enabled during core API deployment.
 It writes various waiting room metrics to the waiting room's event bus. 
 User can subscribe to the event bus to process the published data and act upon it, if desired. 
+The same metrics are logged in CloudWatch Embedded Metric Format (EMF) as high resolution metrics,
+so they can be graphed and alarmed on without subscribing to the event bus.
 """
 
 import redis
 import json
 import boto3
 import os
+from time import time
 from botocore import config
-from counters import QUEUE_COUNTER, SERVING_COUNTER, TOKEN_COUNTER, ABANDONED_SESSION_COUNTER, COMPLETED_SESSION_COUNTER
+from counters import QUEUE_COUNTER, SERVING_COUNTER, TOKEN_COUNTER, ABANDONED_SESSION_COUNTER, COMPLETED_SESSION_COUNTER, SNAPSHOT_COUNTERS, parse_counters
+from active_tokens import queue_count_active_tokens
 
 # connection info and other globals
 REDIS_HOST = os.environ["REDIS_HOST"]
 REDIS_PORT = os.environ["REDIS_PORT"]
 EVENT_ID = os.environ["EVENT_ID"]
 EVENT_BUS_NAME = os.environ["EVENT_BUS_NAME"]
-GET_NUM_ACTIVE_TOKENS_FN = os.environ["ACTIVE_TOKENS_FN"]
 SOLUTION_ID = os.environ["SOLUTION_ID"]
 SECRET_NAME_PREFIX = os.environ["STACK_NAME"]
 
+# CloudWatch namespace of the metrics logged in EMF, dimensioned by event ID
+METRICS_NAMESPACE = "VirtualWaitingRoom"
+
 user_agent_extra = {"user_agent_extra": SOLUTION_ID}
 user_config = config.Config(**user_agent_extra)
 boto_session = boto3.session.Session()
 region = boto_session.region_name
 events_client = boto3.client('events', endpoint_url=f"https://events.{region}.amazonaws.com", config=user_config)
-lambda_client = boto3.client('lambda', endpoint_url=f"https://lambda.{region}.amazonaws.com", config=user_config)
 secrets_client = boto3.client('secretsmanager', endpoint_url=f"https://secretsmanager.{region}.amazonaws.com", config=user_config)
 response = secrets_client.get_secret_value(SecretId=f"{SECRET_NAME_PREFIX}/redis-auth")
 redis_auth = response.get("SecretString")
@@ -41,47 +46,46 @@ def lambda_handler(event, _):
     This function is the entry handler for Lambda.
     """
     print(event)    
-    input_params = {"queryStringParameters": {"event_id": EVENT_ID}}
-    
-    response = lambda_client.invoke(
-        FunctionName = GET_NUM_ACTIVE_TOKENS_FN,
-        InvocationType = 'RequestResponse',
-        Payload = json.dumps(input_params)
-    )
-    result = response['Payload'].read()
-    out = json.loads(result)
-    body = json.loads(out["body"])
-    num_active_tokens = body["active_tokens"]
-
-    # get current queue_counter value
-    queue_counter_value = rc.get(QUEUE_COUNTER)
+    current_time = time()
 
-    # get current serving_num value
-    serving_number_value = rc.get(SERVING_COUNTER)
+    # read the counters and the number of active tokens in a single transaction (one round trip)
+    pipe = rc.pipeline()
+    pipe.mget(SNAPSHOT_COUNTERS)
+    queue_count_active_tokens(pipe, int(current_time))
+    (counter_values, _, num_active_tokens) = pipe.execute()
+    counters = parse_counters(counter_values)
 
-    # get total tokens generated
-    total_tokens = rc.get(TOKEN_COUNTER)
+    metrics = {
+        "num_active_tokens": int(num_active_tokens),
+        "total_num_tokens": counters[TOKEN_COUNTER],
+        "queue_counter": counters[QUEUE_COUNTER],
+        "serving_number": counters[SERVING_COUNTER],
+        "completed_sessions": counters[COMPLETED_SESSION_COUNTER],
+        "abandoned_sessions": counters[ABANDONED_SESSION_COUNTER]
+    }
 
-    # get tokens marked completed
-    completed_sessions = rc.get(COMPLETED_SESSION_COUNTER)
+    # log the metrics for CloudWatch
+    print(emf_log_line(metrics, int(current_time * 1000)))
 
-    # get tokens marked abandoned
-    abandoned_sessions = rc.get(ABANDONED_SESSION_COUNTER)
-
-    # write to event bus
+    # write to event bus, the counters keep the type of the values read from Redis (strings)
+    # so that the event detail is unchanged for existing consumers
+    raw_counters = dict(zip(SNAPSHOT_COUNTERS, counter_values))
+    detail = {
+        "event_id": EVENT_ID,
+        "num_active_tokens": metrics["num_active_tokens"],
+        "total_num_tokens": raw_counters[TOKEN_COUNTER],
+        "queue_counter": raw_counters[QUEUE_COUNTER],
+        "serving_number": raw_counters[SERVING_COUNTER],
+        "completed_sessions": raw_counters[COMPLETED_SESSION_COUNTER],
+        "abandoned_sessions": raw_counters[ABANDONED_SESSION_COUNTER]
+    }
     try:
         response = events_client.put_events(
             Entries=[
                 {
                     'Source': 'custom.waitingroom',
                     'DetailType': 'waiting_room_metrics',
-                    'Detail': json.dumps({"event_id": EVENT_ID,
-                                "num_active_tokens": num_active_tokens,
-                                "total_num_tokens": total_tokens,
-                                "queue_counter": queue_counter_value,
-                                "serving_number": serving_number_value,
-                                "completed_sessions": completed_sessions,
-                                "abandoned_sessions": abandoned_sessions}),
+                    'Detail': json.dumps(detail),
                     'EventBusName': EVENT_BUS_NAME
                 }
             ]
@@ -91,3 +95,24 @@ def lambda_handler(event, _):
         raise exception
     
     return response
+
+
+def emf_log_line(metrics, timestamp) -> str:
+    """
+    Returns the metrics (name to count) as a CloudWatch Embedded Metric Format log line
+    with 1 second storage resolution. The timestamp is in milliseconds.
+    """
+    return json.dumps({
+        "_aws": {
+            "Timestamp": timestamp,
+            "CloudWatchMetrics": [
+                {
+                    "Namespace": METRICS_NAMESPACE,
+                    "Dimensions": [["EventId"]],
+                    "Metrics": [{"Name": name, "Unit": "Count", "StorageResolution": 1} for name in metrics]
+                }
+            ]
+        },
+        "EventId": EVENT_ID,
+        **metrics
+    })
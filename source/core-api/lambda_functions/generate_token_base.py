@@ -11,20 +11,53 @@ from http import HTTPStatus
 from typing import Tuple
 from jwcrypto import jwk, jwt
 from time import time
-from boto3.dynamodb.conditions import Key
-from counters import MAX_QUEUE_POSITION_EXPIRED, SERVING_COUNTER, TOKEN_COUNTER
+from counters import MAX_QUEUE_POSITION_EXPIRED, SERVING_COUNTER, TOKEN_COUNTER, RESET_GENERATION, get_counters
+from queue_positions import get_queue_position_item
+from token_cache import get_cached_tokens, cache_tokens, queue_cache_tokens
+from serving_counter_index import get_serving_counter_item
+from active_tokens import add_active_token
+from token_index import token_index_shard
+from generations import generation_event_id, parse_generation
+from telemetry import TOKENS_ISSUED, execute_with_telemetry
+
+# seconds the private key is reused before it is read from Secrets Manager again
+JWK_CACHE_SECONDS = 300
+
+# private key and the time it was loaded per secret name prefix, kept for the life of the execution environment
+jwk_cache = {}
 
 
 def generate_token_base_method(
         event_id, request_id, headers, rc, enable_queue_position_expiry, queue_position_expiry_period,   # NOSONAR
-        secrets_client, secret_name_prefix, validity_period, issuer, events_client, event_bus_name, is_key_id_in_header,
-        ddb_table_tokens, ddb_table_queue_position_entry_time, ddb_table_serving_counter_issued_at
+        secrets_client, secret_name_prefix, validity_period, issuer, event_publisher, is_key_id_in_header,
+        ddb_table_tokens, ddb_table_queue_position_entry_time, ddb_table_serving_counter_issued_at,
+        enable_queue_position_write_behind='false', token_index_shards=0, record_telemetry_script=None
     ):
     """
     This function is the base implementation of generate token methods.
     """
 
-    queue_position_item = ddb_table_queue_position_entry_time.get_item(Key={"request_id": request_id})
+    # tokens already issued for the request ID are served from the cache while they are valid
+    (cached_tokens, cached_session_status) = get_cached_tokens(rc, request_id, is_key_id_in_header)
+    if cached_session_status:
+        return {
+            "statusCode": HTTPStatus.GONE.value,
+            "headers": headers,
+            "body": json.dumps({"error": "Token corresponding to request id has expired"})
+        }
+    if cached_tokens:
+        # tokens cached by another execution environment tell if the signing key was rotated
+        drop_stale_jwk_keypair(secret_name_prefix, cached_tokens['kid'], cached_tokens['expires'] - validity_period)
+    if cached_tokens and cached_tokens['kid'] == get_jwk_keypair(secrets_client, secret_name_prefix).key_id:
+        return tokens_response(headers, cached_tokens)
+
+    counters = get_counters(rc)
+    generation = parse_generation(counters[RESET_GENERATION])
+    # token and serving counter items are partitioned by the event ID of the reset generation
+    event_key = generation_event_id(event_id, generation)
+    queue_position_item = get_queue_position_item(
+        rc, ddb_table_queue_position_entry_time, request_id, enable_queue_position_write_behind, generation
+    )
     queue_number = int(queue_position_item['Item']['queue_position']) if 'Item' in queue_position_item else None
 
     if not queue_number:
@@ -34,7 +67,7 @@ def generate_token_base_method(
             "body": json.dumps({"error": "Invalid request ID"})
         }
 
-    if queue_number > int(rc.get(SERVING_COUNTER)):
+    if queue_number > counters[SERVING_COUNTER]:
         return {
             "statusCode": HTTPStatus.ACCEPTED.value,
             "headers": headers,
@@ -47,8 +80,8 @@ def generate_token_base_method(
     # check if queue position is valid and not expired only if token not issued
     if enable_queue_position_expiry == 'true' and not is_requestid_in_token_table:
         queue_position_entry_time = int(queue_position_item['Item']['entry_time'])
-        max_queue_position_expired = int(rc.get(MAX_QUEUE_POSITION_EXPIRED))
-        (is_valid, serving_counter) = validate_queue_position_expiry(event_id, queue_number, queue_position_entry_time, 
+        max_queue_position_expired = counters[MAX_QUEUE_POSITION_EXPIRED]
+        (is_valid, serving_counter) = validate_queue_position_expiry(rc, event_key, queue_number, queue_position_entry_time, 
                                         queue_position_expiry_period, max_queue_position_expired, ddb_table_serving_counter_issued_at)
         if not is_valid:
             return { 
@@ -65,35 +98,21 @@ def generate_token_base_method(
             "body": json.dumps({"error": "Token corresponding to request id has expired"})
         }
 
-    keypair = create_jwk_keypair(secrets_client, secret_name_prefix)
-
     # retrive (create) existing token information form in tokens_table 
     if is_requestid_in_token_table: 
         claims = create_claims_from_record(event_id, token_item)
-        (access_token, refresh_token, id_token) = create_tokens(claims, keypair, is_key_id_in_header)
-        expires = int(token_item['Item']['expires'])
-        cur_time = int(time())
+        tokens = create_signed_tokens(claims, secrets_client, secret_name_prefix, is_key_id_in_header)
+        serialized_tokens = serialize_tokens(tokens, int(token_item['Item']['expires']), secrets_client, secret_name_prefix)
+        cache_tokens(rc, request_id, is_key_id_in_header, serialized_tokens, generation)
 
-        return {
-            "statusCode": HTTPStatus.OK.value, 
-            "headers": headers, 
-            "body": json.dumps(
-                {
-                    "access_token": access_token.serialize(),
-                    "refresh_token": refresh_token.serialize(), 
-                    "id_token": id_token.serialize(), 
-                    "token_type": "Bearer", 
-                    "expires_in": max(expires - cur_time, 0)
-                }
-            )
-        }
+        return tokens_response(headers, serialized_tokens)
 
     # if request_id is not in tokens_table, create and save record to tokens_table
     iat = int(time())  # issued-at and not-before can be the same time (epoch seconds)
     nbf = iat
     exp = iat + validity_period # expiration (exp) is a time after iat and nbf
     token_item = {
-        "event_id": event_id,
+        "event_id": event_key,
         "request_id": request_id,
         "issued_at": iat,
         "not_before": nbf,
@@ -102,6 +121,8 @@ def generate_token_base_method(
         'issuer': issuer,
         "session_status": 0
     }
+    if token_index_shards > 0:
+        token_item["event_shard"] = token_index_shard(event_key, request_id, token_index_shards)
 
     try:
         ddb_table_tokens.put_item(Item=token_item)
@@ -110,28 +131,55 @@ def generate_token_base_method(
         raise e
 
     claims = create_claims(event_id, request_id, issuer, queue_number, iat, nbf, exp)
-    (access_token, refresh_token, id_token) = create_tokens(claims, keypair, True)
-    write_to_eventbus(events_client, event_id, event_bus_name, request_id)
-    rc.incr(TOKEN_COUNTER, 1)
+    tokens = create_signed_tokens(claims, secrets_client, secret_name_prefix, True)
+    serialized_tokens = serialize_tokens(tokens, exp, secrets_client, secret_name_prefix)
+    write_to_eventbus(event_publisher, event_id, request_id)
+    # count the issued token, make it active, cache it and record the telemetry in a single round trip
+    pipe = rc.pipeline(transaction=False)
+    pipe.incr(TOKEN_COUNTER, 1)
+    add_active_token(pipe, request_id, exp)
+    queue_cache_tokens(pipe, request_id, True, serialized_tokens, generation)
+    execute_with_telemetry(pipe, record_telemetry_script, {TOKENS_ISSUED: 1})
 
     if enable_queue_position_expiry == 'true':
-        update_queue_positions_served(event_id, serving_counter, ddb_table_serving_counter_issued_at) 
+        update_queue_positions_served(event_key, serving_counter, ddb_table_serving_counter_issued_at) 
+
+    return tokens_response(headers, serialized_tokens)
+
 
+def serialize_tokens(tokens, expires, secrets_client, secret_name_prefix) -> dict:
+    """
+    Serialize the access, refresh and id tokens along with their expiry and the key ID they were signed with
+    """
+    (access_token, refresh_token, id_token) = tokens
+    return {
+        "access_token": access_token.serialize(),
+        "refresh_token": refresh_token.serialize(),
+        "id_token": id_token.serialize(),
+        "expires": expires,
+        "kid": get_jwk_keypair(secrets_client, secret_name_prefix).key_id
+    }
+
+
+def tokens_response(headers, serialized_tokens) -> dict:
+    """
+    Build the generate token response from serialized tokens
+    """
     return {
         "statusCode": HTTPStatus.OK.value, 
         "headers": headers, 
         "body": json.dumps(
             {
-                "access_token": access_token.serialize(), 
-                "refresh_token": refresh_token.serialize(), 
-                "id_token": id_token.serialize(),
+                "access_token": serialized_tokens['access_token'],
+                "refresh_token": serialized_tokens['refresh_token'],
+                "id_token": serialized_tokens['id_token'],
                 "token_type": "Bearer",
-                "expires_in": validity_period
+                "expires_in": max(serialized_tokens['expires'] - int(time()), 0)
             }
         )
     }
-    
-    
+
+
 def create_jwk_keypair(secrets_client, secret_name_prefix) -> jwk.JWK:
     """
     Create JWK key object
@@ -142,6 +190,46 @@ def create_jwk_keypair(secrets_client, secret_name_prefix) -> jwk.JWK:
     return jwk.JWK.from_json(private_key)
 
 
+def get_jwk_keypair(secrets_client, secret_name_prefix, force_refresh=False) -> jwk.JWK:
+    """
+    Returns the cached JWK key object, the key is read from Secrets Manager again
+    once the cache period has passed or if a refresh is forced
+    """
+    cached = jwk_cache.get(secret_name_prefix)
+    if not force_refresh and cached and time() - cached['loaded_at'] < JWK_CACHE_SECONDS:
+        return cached['keypair']
+
+    keypair = create_jwk_keypair(secrets_client, secret_name_prefix)
+    if cached and cached['keypair'].key_id != keypair.key_id:
+        print(f"Signing key changed from {cached['keypair'].key_id} to {keypair.key_id}")
+    jwk_cache[secret_name_prefix] = {'keypair': keypair, 'loaded_at': time()}
+    return keypair
+
+
+def drop_stale_jwk_keypair(secret_name_prefix, kid, issued_at) -> None:
+    """
+    Drop the cached key pair if tokens were issued with another key ID after it was loaded:
+    the key was rotated, the next get_jwk_keypair reads the new key instead of waiting for the cache period to pass.
+    Tokens issued before the key was loaded do not drop it.
+    """
+    cached = jwk_cache.get(secret_name_prefix)
+    if cached and cached['keypair'].key_id != kid and issued_at >= cached['loaded_at']:
+        print(f"Signing key {cached['keypair'].key_id} replaced by {kid}, dropping the cached key")
+        del jwk_cache[secret_name_prefix]
+
+
+def create_signed_tokens(claims, secrets_client, secret_name_prefix, is_key_id_in_header: bool) -> Tuple[jwt.JWT, jwt.JWT, jwt.JWT]:
+    """
+    Create access, refresh and id tokens signed with the cached key.
+    If signing fails, the key is read again in case it was rotated and signing is retried once.
+    """
+    try:
+        return create_tokens(claims, get_jwk_keypair(secrets_client, secret_name_prefix), is_key_id_in_header)
+    except Exception as e:
+        print(f"Signing failed with the cached key, refreshing key: {e}")
+        return create_tokens(claims, get_jwk_keypair(secrets_client, secret_name_prefix, force_refresh=True), is_key_id_in_header)
+
+
 def create_tokens(claims, keypair, is_key_id_in_header: bool) -> Tuple[jwt.JWT, jwt.JWT, jwt.JWT]:
     """
     Create access, refresh and id tokens 
@@ -159,10 +247,12 @@ def make_jwt_token(claims, keypair, token_use, is_key_id_in_header) -> jwt.JWT:
     """
     # Bandit B105: not a hardcoded password
     claims["token_use"] = token_use  # nosec
+    # sign with the algorithm the key was generated for, keys without one are RSA keys
+    alg = keypair.get('alg', 'RS256')
     if is_key_id_in_header:
-        jwt_token = jwt.JWT(header={"alg": "RS256", "typ": "JWT", "kid": keypair.key_id}, claims=claims)
+        jwt_token = jwt.JWT(header={"alg": alg, "typ": "JWT", "kid": keypair.key_id}, claims=claims)
     else:
-        jwt_token = jwt.JWT(header={"alg": "RS256", "typ": "JWT"}, claims=claims)
+        jwt_token = jwt.JWT(header={"alg": alg, "typ": "JWT"}, claims=claims)
 
     jwt_token.make_signed_token(keypair)
     print(f"{token_use} token header: {jwt_token.serialize().split('.')[0]}")
@@ -201,28 +291,20 @@ def create_claims(event_id, request_id, issuer, queue_number, iat, nbf, exp):
     }
 
 
-def write_to_eventbus(events_client, event_id, event_bus_name, request_id) -> None:
+def write_to_eventbus(event_publisher, event_id, request_id) -> None:
     """
     write to event bus
     """
-    events_client.put_events(
-        Entries=[
-            {
-                'Source': 'custom.waitingroom',
-                'DetailType': 'token_generated',
-                'Detail': json.dumps(
-                    {
-                        "event_id": event_id,
-                        "request_id": request_id
-                    }
-                ),
-                'EventBusName': event_bus_name
-            }
-        ]
+    event_publisher.publish(
+        'token_generated',
+        {
+            "event_id": event_id,
+            "request_id": request_id
+        }
     )
 
 
-def validate_queue_position_expiry(event_id, queue_number, queue_position_entry_time, 
+def validate_queue_position_expiry(rc, event_id, queue_number, queue_position_entry_time, 
     queue_position_expiry_period, max_queue_position_expired, ddb_table_serving_counter_issued_at) -> Tuple[bool, int]:
     """
     Validates the queue position to see if it has expired. Serving counter corresponding to queue position.
@@ -233,11 +315,7 @@ def validate_queue_position_expiry(event_id, queue_number, queue_position_entry_
         return (False, None)
 
     # serving counter gte queue number, should always have atleast 1 result 
-    response = ddb_table_serving_counter_issued_at.query(
-        KeyConditionExpression=Key('event_id').eq(event_id) & Key('serving_counter').gte(queue_number),
-        Limit=1
-    )
-    serving_counter_item = response['Items'][0]
+    serving_counter_item = get_serving_counter_item(rc, ddb_table_serving_counter_issued_at, event_id, queue_number)
     serving_counter_issue_time = int(serving_counter_item['issue_time'])
 
     # queue time should not be greater than the expiry period 
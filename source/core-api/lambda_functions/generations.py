@@ -0,0 +1,52 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: Apache-2.0
+
+"""
+This module provides the reset generations of the waiting room state.
+A reset in generation mode increments the reset generation instead of recreating the DynamoDB tables.
+Token and serving counter items are partitioned by a generation scoped event ID, queue position items
+and cached tokens carry their generation. Readers ignore the items of previous generations and
+the purge_generations function deletes them in the background.
+"""
+
+import os
+from counters import RESET_GENERATION
+
+# the generation is only read from Redis in generation reset mode, it is always 0 in recreate mode
+GENERATION_RESET_MODE = os.environ.get("RESET_MODE") == "generation"
+
+# attribute (and Redis hash field) holding the generation of queue position items and cached tokens
+GENERATION_ATTRIBUTE = "generation"
+
+
+def get_generation(rc) -> int:
+    """
+    Returns the current reset generation, 0 until the first reset in generation mode.
+    Redis is not called in recreate mode.
+    """
+    if not GENERATION_RESET_MODE:
+        return 0
+    return parse_generation(rc.get(RESET_GENERATION))
+
+
+def parse_generation(value) -> int:
+    """
+    Returns the reset generation from a RESET_GENERATION value read along with other keys
+    (e.g. by get_counters or on a pipeline), always 0 in recreate mode
+    """
+    return int(value or 0) if GENERATION_RESET_MODE else 0
+
+
+def generation_event_id(event_id, generation) -> str:
+    """
+    Event ID the items of the generation are partitioned by.
+    Generation 0 uses the event ID as is, so existing items stay in the current generation.
+    """
+    return event_id if generation == 0 else f"{event_id}#g{generation}"
+
+
+def is_current_generation(item, generation) -> bool:
+    """
+    Returns True if the item (or Redis hash) was written in the given generation
+    """
+    return int(item.get(GENERATION_ATTRIBUTE) or 0) == generation
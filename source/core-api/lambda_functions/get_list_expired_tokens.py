@@ -4,19 +4,32 @@
 """
 This module is the get_list_expired_tokens API handler.
 It queries DynamoDB for requests that were issued tokens which have since expired.
+Without paging parameters, the expired request IDs of the event are returned as a list of at most
+MAX_PAGE_SIZE items. If there are more, the cursor of the next page is returned in the X-Next-Cursor header.
+With limit, cursor or expired_since, one page of request IDs is returned along with the
+cursor of the next page and the expired_before watermark to pass as expired_since on the next poll.
 """
 
+import base64
 import json
 import boto3
 import os
 import time
+import redis
 from botocore import config
 from boto3.dynamodb.conditions import Key
 from vwr.common.sanitize import deep_clean
+from token_index import query_token_index_page
+from generations import GENERATION_RESET_MODE, get_generation, generation_event_id
 
 DDB_TOKEN_TABLE_NAME = os.environ["TOKEN_TABLE"]
 EVENT_ID = os.environ["EVENT_ID"]
 SOLUTION_ID = os.environ['SOLUTION_ID']
+TOKEN_INDEX_SHARDS = int(os.environ["TOKEN_INDEX_SHARDS"])
+
+DEFAULT_PAGE_SIZE = 1000
+MAX_PAGE_SIZE = 10000
+PAGING_PARAMETERS = ("limit", "cursor", "expired_since")
 
 user_agent_extra = {"user_agent_extra": SOLUTION_ID}
 user_config = config.Config(**user_agent_extra)
@@ -24,6 +37,18 @@ boto_session = boto3.session.Session()
 region = boto_session.region_name
 ddb_resource = boto3.resource('dynamodb', config=user_config)
 ddb_table = ddb_resource.Table(DDB_TOKEN_TABLE_NAME)
+
+# the reset generation is only read from Redis in generation reset mode,
+# in recreate mode the function does not connect to Redis and runs outside the VPC
+rc = None
+if GENERATION_RESET_MODE:
+    REDIS_HOST = os.environ["REDIS_HOST"]
+    REDIS_PORT = os.environ["REDIS_PORT"]
+    SECRET_NAME_PREFIX = os.environ["STACK_NAME"]
+    secrets_client = boto3.client('secretsmanager', config=user_config, endpoint_url=f"https://secretsmanager.{region}.amazonaws.com")
+    response = secrets_client.get_secret_value(SecretId=f"{SECRET_NAME_PREFIX}/redis-auth")
+    redis_auth = response.get("SecretString")
+    rc = redis.Redis(host=REDIS_HOST, port=REDIS_PORT, ssl=True, decode_responses=True, password=redis_auth)
     
 def lambda_handler(event, _):
     """
@@ -31,30 +56,25 @@ def lambda_handler(event, _):
     """
     
     print(event)
-    client_event_id = deep_clean(event['queryStringParameters']['event_id'])
+    query_parameters = event['queryStringParameters']
+    client_event_id = deep_clean(query_parameters['event_id'])
     headers = {
         'Content-Type': 'application/json',
         'Access-Control-Allow-Origin': '*'
     }
-    if client_event_id == EVENT_ID:
+    if client_event_id == EVENT_ID and any(name in query_parameters for name in PAGING_PARAMETERS):
+        response = get_expired_tokens_page(query_parameters, headers)
+    elif client_event_id == EVENT_ID:
         try:
-            current_time = int(time.time())
-            response = ddb_table.query(
-                IndexName="EventExpiresIndex",
-                ProjectionExpression="request_id",
-                KeyConditionExpression=Key('event_id').eq(EVENT_ID) & Key('expires').lt(current_time))
-            items = [item['request_id'] for item in response['Items']]
-            while "LastEvaluatedKey" in response:
-                response = ddb_table.query(
-                    IndexName="EventExpiresIndex",
-                    ProjectionExpression="request_id",
-                    KeyConditionExpression=Key('event_id').eq(EVENT_ID) & Key('expires').lt(current_time),
-                    ExclusiveStartKey=response["LastEvaluatedKey"])
-                items.extend([item['request_id'] for item in response['Items']])
+            # the list is capped, the rest is read with the paged API
+            (request_ids, next_cursor) = query_expired_tokens(
+                generation_event_id(EVENT_ID, get_generation(rc)), 0, int(time.time()), MAX_PAGE_SIZE, None)
+            if next_cursor:
+                headers = dict(headers, **{'X-Next-Cursor': next_cursor, 'Access-Control-Expose-Headers': 'X-Next-Cursor'})
             response = {
                 "statusCode": 200,
                 "headers": headers,
-                "body": json.dumps(items)
+                "body": json.dumps(request_ids)
             }
         except Exception as e:
             print(e)
@@ -67,3 +87,85 @@ def lambda_handler(event, _):
         }
     print(response)
     return response
+
+
+def get_expired_tokens_page(query_parameters, headers) -> dict:
+    """
+    Returns a page of request IDs with tokens that expired at or after expired_since
+    and before the time the first page was requested
+    """
+    event_key = generation_event_id(EVENT_ID, get_generation(rc))
+    try:
+        limit = int(query_parameters.get('limit') or DEFAULT_PAGE_SIZE)
+        if not 0 < limit <= MAX_PAGE_SIZE:
+            raise ValueError(f"limit must be between 1 and {MAX_PAGE_SIZE}")
+        if query_parameters.get('cursor'):
+            (expired_since, expired_before, position) = decode_cursor(query_parameters['cursor'], event_key)
+        else:
+            expired_since = max(int(query_parameters.get('expired_since') or 0), 0)
+            expired_before = int(time.time())
+            position = None
+    except (ValueError, KeyError, TypeError) as e:
+        print(e)
+        return {
+            "statusCode": 400,
+            "headers": headers,
+            "body": json.dumps({"error": "Invalid limit, cursor or expired_since"})
+        }
+
+    (request_ids, next_cursor) = query_expired_tokens(event_key, expired_since, expired_before, limit, position)
+    return {
+        "statusCode": 200,
+        "headers": headers,
+        "body": json.dumps({
+            "request_ids": request_ids,
+            "expired_before": expired_before,
+            "next_cursor": next_cursor
+        })
+    }
+
+
+def query_expired_tokens(event_key, expired_since, expired_before, limit, position) -> tuple:
+    """
+    Returns at most limit request IDs with tokens that expired at or after expired_since and before expired_before,
+    starting at the query position, and the cursor of the next page (None if there is no next page)
+    """
+    if expired_since >= expired_before:
+        return ([], None)
+    (items, next_position) = query_token_index_page(
+        ddb_table, event_key, TOKEN_INDEX_SHARDS, Key('expires').between(expired_since, expired_before - 1),
+        limit, position, ProjectionExpression="request_id")
+    next_cursor = encode_cursor(expired_since, expired_before, next_position) if next_position else None
+    return ([item['request_id'] for item in items], next_cursor)
+
+
+def encode_cursor(expired_since, expired_before, position) -> str:
+    """
+    Returns the opaque cursor of the next page
+    """
+    (shard, start_key) = position
+    cursor = {"since": expired_since, "before": expired_before, "shard": shard, "key": start_key}
+    # key values read from DynamoDB are Decimal, expires is the only number
+    return base64.urlsafe_b64encode(json.dumps(cursor, default=int).encode('utf-8')).decode('utf-8')
+
+
+def decode_cursor(cursor, event_key) -> tuple:
+    """
+    Returns the expiry range and query position stored in a cursor.
+    Raises ValueError if the cursor is malformed or was not issued for this event and reset generation (event_key).
+    """
+    cursor = json.loads(base64.urlsafe_b64decode(cursor.encode('utf-8')))
+    if not isinstance(cursor, dict) or not all(isinstance(cursor.get(name), int) for name in ("since", "before", "shard")):
+        raise ValueError("cursor is malformed")
+    shard = cursor["shard"]
+    if not 0 <= shard < max(TOKEN_INDEX_SHARDS, 1):
+        raise ValueError("cursor shard is out of range")
+    # the start key must be a key of the index shard the cursor points to
+    start_key = cursor.get("key")
+    if start_key is not None:
+        (partition_name, partition) = ("event_shard", f"{event_key}#{shard}") if TOKEN_INDEX_SHARDS > 0 else ("event_id", event_key)
+        if not isinstance(start_key, dict) or set(start_key) != {partition_name, "expires", "request_id"} \
+                or start_key[partition_name] != partition or not isinstance(start_key["expires"], int) \
+                or not isinstance(start_key["request_id"], str):
+            raise ValueError("cursor is not valid for this event")
+    return (cursor["since"], cursor["before"], (shard, start_key))
@@ -3,28 +3,32 @@
 
 """
 This module is the get_num_active_tokens API handler.
-It queries DynamoDB for number of requests that have yet to expire, have not been completed, 
-and have not been deemed abandoned. 
+It returns the number of requests that have yet to expire, have not been completed, 
+and have not been deemed abandoned, as maintained in Redis by the token functions.
 """
 
 import json
 import os
-import time
 import boto3
+import redis
 from botocore import config
-from boto3.dynamodb.conditions import Key, Attr
 from vwr.common.sanitize import deep_clean
+from active_tokens import count_active_tokens
 
-DDB_TOKEN_TABLE_NAME = os.environ["TOKEN_TABLE"]
+REDIS_HOST = os.environ["REDIS_HOST"]
+REDIS_PORT = os.environ["REDIS_PORT"]
 EVENT_ID = os.environ["EVENT_ID"]
 SOLUTION_ID = os.environ['SOLUTION_ID']
+SECRET_NAME_PREFIX = os.environ["STACK_NAME"]
 
 user_agent_extra = {"user_agent_extra": SOLUTION_ID}
 user_config = config.Config(**user_agent_extra)
 boto_session = boto3.session.Session()
 region = boto_session.region_name
-ddb_resource = boto3.resource('dynamodb', config=user_config)
-ddb_table = ddb_resource.Table(DDB_TOKEN_TABLE_NAME)
+secrets_client = boto3.client('secretsmanager', config=user_config, endpoint_url=f"https://secretsmanager.{region}.amazonaws.com")
+response = secrets_client.get_secret_value(SecretId=f"{SECRET_NAME_PREFIX}/redis-auth")
+redis_auth = response.get("SecretString")
+rc = redis.Redis(host=REDIS_HOST, port=REDIS_PORT, ssl=True, decode_responses=True, password=redis_auth)
     
 def lambda_handler(event, _):
     """
@@ -39,25 +43,10 @@ def lambda_handler(event, _):
             }
     if client_event_id == EVENT_ID:
         try:
-            current_time = int(time.time())
-            response = ddb_table.query(
-                IndexName="EventExpiresIndex",
-                ProjectionExpression="request_id",
-                KeyConditionExpression=Key('event_id').eq(EVENT_ID) & Key('expires').gte(current_time),
-                FilterExpression=Attr('session_status').eq(0))
-            items = response.get("Items", [])
-            while "LastEvaluatedKey" in response:
-                response = ddb_table.query(
-                    IndexName="EventExpiresIndex",
-                    ProjectionExpression="request_id",
-                    KeyConditionExpression=Key('event_id').eq(EVENT_ID) & Key('expires').gte(current_time),
-                    FilterExpression=Attr('session_status').eq(0),
-                    ExclusiveStartKey=response["LastEvaluatedKey"])
-                items.extend(response.get("Items", []))
             response = { 
                         "statusCode": 200,
                         "headers": headers,
-                        "body": json.dumps({"active_tokens": len(items)})
+                        "body": json.dumps({"active_tokens": count_active_tokens(rc)})
                 }
         except Exception as e:
             print(e)
@@ -13,6 +13,8 @@ import boto3
 from botocore import config
 from vwr.common.sanitize import deep_clean
 from vwr.common.validate import is_valid_rid
+from queue_positions import get_queue_position_item
+from generations import get_generation
 
 # connection info
 REDIS_HOST = os.environ["REDIS_HOST"]
@@ -21,6 +23,7 @@ EVENT_ID = os.environ["EVENT_ID"]
 SECRET_NAME_PREFIX = os.environ["STACK_NAME"]
 SOLUTION_ID = os.environ["SOLUTION_ID"]
 QUEUE_POSITION_ENTRYTIME_TABLE = os.environ["QUEUE_POSITION_ENTRYTIME_TABLE"]
+ENABLE_QUEUE_POSITION_WRITE_BEHIND = os.environ["ENABLE_QUEUE_POSITION_WRITE_BEHIND"]
 
 boto_session = boto3.session.Session()
 region = boto_session.region_name
@@ -48,7 +51,7 @@ def lambda_handler(event, _):
     }
 
     if client_event_id == EVENT_ID and is_valid_rid(request_id):
-        queue_position_item = ddb_table_queue_position_entry_time.get_item(Key={"request_id": request_id})
+        queue_position_item = get_queue_position_item(rc, ddb_table_queue_position_entry_time, request_id, ENABLE_QUEUE_POSITION_WRITE_BEHIND, get_generation(rc))
         queue_number = int(queue_position_item['Item']['queue_position']) if 'Item' in queue_position_item else None
 
         if queue_number:
@@ -66,7 +69,7 @@ def lambda_handler(event, _):
                 )
             }
         else:
-            # request wasn't found in dynamodb table but event_id is valid
+            # request wasn't found in redis or dynamodb table but event_id is valid
             response = {
                 "statusCode": 202,
                 "headers": headers,
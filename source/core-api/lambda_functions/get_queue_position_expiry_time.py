@@ -15,10 +15,12 @@ import os
 import boto3
 from time import time
 from botocore import config
-from boto3.dynamodb.conditions import Key
 from vwr.common.sanitize import deep_clean
 from vwr.common.validate import is_valid_rid
-from counters import MAX_QUEUE_POSITION_EXPIRED, SERVING_COUNTER
+from counters import MAX_QUEUE_POSITION_EXPIRED, SERVING_COUNTER, RESET_GENERATION, get_counters
+from generations import generation_event_id, parse_generation
+from queue_positions import get_queue_position_item
+from serving_counter_index import get_serving_counter_item
 
 REDIS_HOST = os.environ["REDIS_HOST"]
 REDIS_PORT = os.environ["REDIS_PORT"]
@@ -29,6 +31,7 @@ QUEUE_POSITION_ENTRYTIME_TABLE = os.environ["QUEUE_POSITION_ENTRYTIME_TABLE"]
 QUEUE_POSITION_EXPIRY_PERIOD = os.environ["QUEUE_POSITION_EXPIRY_PERIOD"]
 SERVING_COUNTER_ISSUEDAT_TABLE = os.environ["SERVING_COUNTER_ISSUEDAT_TABLE"]
 ENABLE_QUEUE_POSITION_EXPIRY = os.environ["ENABLE_QUEUE_POSITION_EXPIRY"]
+ENABLE_QUEUE_POSITION_WRITE_BEHIND = os.environ["ENABLE_QUEUE_POSITION_WRITE_BEHIND"]
 
 boto_session = boto3.session.Session()
 region = boto_session.region_name
@@ -70,7 +73,8 @@ def lambda_handler(event, _):
             "body": json.dumps({"error": "Queue position expiration not enabled"})
         }
 
-    queue_position_item = ddb_table_queue_position_entry_time.get_item(Key={"request_id": request_id})
+    counters = get_counters(rc)
+    queue_position_item = get_queue_position_item(rc, ddb_table_queue_position_entry_time, request_id, ENABLE_QUEUE_POSITION_WRITE_BEHIND, parse_generation(counters[RESET_GENERATION]))
     queue_number = int(queue_position_item['Item']['queue_position']) if 'Item' in queue_position_item else None
     
     if not queue_number:
@@ -82,14 +86,14 @@ def lambda_handler(event, _):
 
     print(f'Queue number: {queue_number}')
 
-    if queue_number > int(rc.get(SERVING_COUNTER)):
+    if queue_number > counters[SERVING_COUNTER]:
         return {
             "statusCode": HTTPStatus.ACCEPTED.value,
             "headers": headers,
             "body": json.dumps({"error": "Request ID not being served yet"})
         }
   
-    if queue_number <= int(rc.get(MAX_QUEUE_POSITION_EXPIRED)):
+    if queue_number <= counters[MAX_QUEUE_POSITION_EXPIRED]:
         return {
             "statusCode": HTTPStatus.GONE.value,
             "headers": headers,
@@ -97,11 +101,9 @@ def lambda_handler(event, _):
         }
 
     # serving counter gte queue number, should always have atleast 1 result 
-    response = ddb_table_serving_counter_issued_at.query(
-        KeyConditionExpression=Key('event_id').eq(EVENT_ID) & Key('serving_counter').gte(queue_number),
-        Limit=1
+    serving_counter_item = get_serving_counter_item(
+        rc, ddb_table_serving_counter_issued_at, generation_event_id(EVENT_ID, parse_generation(counters[RESET_GENERATION])), queue_number
     )
-    serving_counter_item = response['Items'][0]
     serving_counter_issue_time = int(serving_counter_item['issue_time'])
     
     queue_position_entry_time = int(queue_position_item['Item']['entry_time'])    
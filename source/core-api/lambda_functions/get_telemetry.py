@@ -0,0 +1,82 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: Apache-2.0
+
+"""
+This module is the telemetry API handler.
+It returns, for each metric of the telemetry ring buffer (enqueued requests, issued tokens,
+serving counter increments and session updates), the total, the rate per second and the change
+of the rate over the last window seconds, at one second resolution.
+"""
+
+import json
+import os
+import boto3
+import redis
+from time import time
+from botocore import config
+from vwr.common.sanitize import deep_clean
+from telemetry import MAX_TELEMETRY_WINDOW, read_telemetry, summarize
+
+REDIS_HOST = os.environ["REDIS_HOST"]
+REDIS_PORT = os.environ["REDIS_PORT"]
+EVENT_ID = os.environ["EVENT_ID"]
+SOLUTION_ID = os.environ['SOLUTION_ID']
+SECRET_NAME_PREFIX = os.environ["STACK_NAME"]
+
+# window (seconds) used when none is given
+DEFAULT_TELEMETRY_WINDOW = 60
+
+user_agent_extra = {"user_agent_extra": SOLUTION_ID}
+user_config = config.Config(**user_agent_extra)
+boto_session = boto3.session.Session()
+region = boto_session.region_name
+secrets_client = boto3.client('secretsmanager', config=user_config, endpoint_url=f"https://secretsmanager.{region}.amazonaws.com")
+response = secrets_client.get_secret_value(SecretId=f"{SECRET_NAME_PREFIX}/redis-auth")
+redis_auth = response.get("SecretString")
+rc = redis.Redis(host=REDIS_HOST, port=REDIS_PORT, ssl=True, decode_responses=True, password=redis_auth)
+
+
+def lambda_handler(event, _):
+    """
+    This function is the entry handler for Lambda.
+    """
+
+    print(event)
+    query_parameters = event['queryStringParameters']
+    client_event_id = deep_clean(query_parameters['event_id'])
+    headers = {
+        'Content-Type': 'application/json',
+        'Access-Control-Allow-Origin': '*'
+    }
+    if client_event_id != EVENT_ID:
+        return {
+            "statusCode": 400,
+            "headers": headers,
+            "body": json.dumps({"error": "Invalid event ID"})
+        }
+
+    try:
+        window = int(query_parameters.get('window') or DEFAULT_TELEMETRY_WINDOW)
+        if not 0 < window <= MAX_TELEMETRY_WINDOW:
+            raise ValueError(f"window must be between 1 and {MAX_TELEMETRY_WINDOW}")
+    except ValueError as exception:
+        print(exception)
+        return {
+            "statusCode": 400,
+            "headers": headers,
+            "body": json.dumps({"error": f"Invalid window, must be between 1 and {MAX_TELEMETRY_WINDOW} seconds"})
+        }
+
+    end_time = int(time())
+    series = read_telemetry(rc, window, end_time)
+    response = {
+        "statusCode": 200,
+        "headers": headers,
+        "body": json.dumps({
+            "window": window,
+            "end_time": end_time,
+            "metrics": {metric: summarize(counts) for (metric, counts) in series.items()}
+        })
+    }
+    print(response)
+    return response
@@ -12,7 +12,7 @@ import json
 import os
 import boto3
 from botocore import config
-from counters import QUEUE_COUNTER, TOKEN_COUNTER, EXPIRED_QUEUE_COUNTER
+from counters import QUEUE_COUNTER, TOKEN_COUNTER, EXPIRED_QUEUE_COUNTER, QUEUE_POSITION_GAPS, SNAPSHOT_COUNTERS, parse_counters
 from vwr.common.sanitize import deep_clean
 
 # connection info and other globals
@@ -51,10 +51,14 @@ def lambda_handler(event, _):
             "body": json.dumps({"error": "Invalid event ID"})
         }
 
-    queue_count = int(rc.get(QUEUE_COUNTER))
-    token_count = int(rc.get(TOKEN_COUNTER))
-    expired_queue_count = int(rc.get(EXPIRED_QUEUE_COUNTER)) if rc.get(EXPIRED_QUEUE_COUNTER) else 0
-    waiting_num = queue_count - token_count - expired_queue_count
+    # read the counters and the number of leased queue positions that were never assigned
+    # in a single transaction (one round trip)
+    pipe = rc.pipeline()
+    pipe.mget(SNAPSHOT_COUNTERS)
+    pipe.zcard(QUEUE_POSITION_GAPS)
+    (counter_values, gap_count) = pipe.execute()
+    counters = parse_counters(counter_values)
+    waiting_num = counters[QUEUE_COUNTER] - counters[TOKEN_COUNTER] - counters[EXPIRED_QUEUE_COUNTER] - gap_count
 
     return {
         "statusCode": 200,
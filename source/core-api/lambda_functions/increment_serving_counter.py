@@ -14,6 +14,10 @@ import boto3
 from time import time
 from botocore import config
 from counters import SERVING_COUNTER
+from serving_counter_index import index_serving_counter
+from queue_number_lease import reap_expired_leases
+from generations import get_generation, generation_event_id
+from telemetry import RECORD_TELEMETRY_SCRIPT, SERVED, record_telemetry
 from vwr.common.sanitize import deep_clean
 
 # connection info and other globals
@@ -24,6 +28,7 @@ SECRET_NAME_PREFIX = os.environ["STACK_NAME"]
 SOLUTION_ID = os.environ["SOLUTION_ID"]
 SERVING_COUNTER_ISSUEDAT_TABLE = os.environ["SERVING_COUNTER_ISSUEDAT_TABLE"]
 ENABLE_QUEUE_POSITION_EXPIRY = os.environ["ENABLE_QUEUE_POSITION_EXPIRY"]
+QUEUE_NUMBER_LEASE_SIZE = int(os.environ["QUEUE_NUMBER_LEASE_SIZE"])
 
 boto_session = boto3.session.Session()
 region = boto_session.region_name
@@ -33,6 +38,7 @@ secrets_client = boto3.client('secretsmanager', config=user_config, endpoint_url
 response = secrets_client.get_secret_value(SecretId=f"{SECRET_NAME_PREFIX}/redis-auth")
 redis_auth = response.get("SecretString")
 rc = redis.Redis(host=REDIS_HOST, port=REDIS_PORT, ssl=True, decode_responses=True, password=redis_auth)
+record_telemetry_script = rc.register_script(RECORD_TELEMETRY_SCRIPT)
 ddb_resource = boto3.resource('dynamodb', endpoint_url=f'https://dynamodb.{region}.amazonaws.com', config=user_config)
 ddb_table = ddb_resource.Table(SERVING_COUNTER_ISSUEDAT_TABLE)
 
@@ -57,16 +63,23 @@ def lambda_handler(event, _):
             "body": json.dumps({"error": "Invalid event ID"})
         }
 
+    # tombstone the unassigned positions of expired queue number leases before serving past them,
+    # set_max_queue_position_expired only reaps them when queue position expiry is enabled
+    if QUEUE_NUMBER_LEASE_SIZE > 0:
+        reap_expired_leases(rc)
+
     cur_serving = rc.incrby(SERVING_COUNTER, increment_by)
+    record_telemetry(record_telemetry_script, {SERVED: increment_by})
 
     if ENABLE_QUEUE_POSITION_EXPIRY == 'true':
         item = {
-            'event_id': EVENT_ID,
+            'event_id': generation_event_id(EVENT_ID, get_generation(rc)),
             'serving_counter': int(cur_serving),
             'issue_time': int(time()),
             'queue_positions_served': 0
         }
         ddb_table.put_item(Item=item)
+        index_serving_counter(rc, item['serving_counter'], item['issue_time'], item['serving_counter'] - int(increment_by))
         print(f'Item: {item}')
 
     print(f"cur_serving: {cur_serving}")
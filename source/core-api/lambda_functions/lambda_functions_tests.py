@@ -6,15 +6,18 @@ This module is the unit test for the core API Lambda functions.
 """
 # pylint: disable=R0902 
 
+import base64
 import os
 import unittest
 import time
 from unittest.mock import Mock, patch, MagicMock
 
 import json
-from botocore.response import StreamingBody
-from botocore.exceptions import ClientError
-from io import StringIO
+import redis
+from botocore.exceptions import ClientError, EndpointConnectionError
+from boto3.dynamodb.conditions import Key
+from decimal import Decimal
+from jwcrypto import jwk
 
 os.environ["REDIS_HOST"] = "local"
 os.environ["REDIS_PORT"] = "1234"
@@ -25,27 +28,44 @@ os.environ["SOLUTION_ID"] = "SO0166"
 os.environ["STACK_NAME"] = "vwr"
 os.environ["EVENT_BUS_NAME"] = "vwr_event_bus"
 os.environ["VALIDITY_PERIOD"] = "3600"
-os.environ["ACTIVE_TOKENS_FN"] = "get_num_active_tokens"
-os.environ["QUEUE_URL"] = "queue_url"
 os.environ["QUEUE_POSITION_ENTRYTIME_TABLE"] = "queue_position_entry_time_table"
 os.environ["SERVING_COUNTER_ISSUEDAT_TABLE"] = "serving_counter_issuedat_table"
 os.environ["QUEUE_POSITION_EXPIRY_PERIOD"] = "100"
 os.environ["ENABLE_QUEUE_POSITION_EXPIRY"] = "true"
 os.environ["INCR_SVC_ON_QUEUE_POS_EXPIRY"] = "true"
 os.environ["CLOUDFRONT_DISTRIBUTION_ID"] = "my_cloudfront_distribution_id"
+os.environ["ENABLE_QUEUE_POSITION_WRITE_BEHIND"] = "false"
+os.environ["ASYNC_EVENT_PUBLISHING"] = "false"
+os.environ["QUEUE_URL"] = "https://sqs.us-east-1.amazonaws.com/123456789012/vwr-WaitingRoomQueue"
+os.environ["SYNC_ENQUEUE_MAX_BACKLOG"] = "100"
+os.environ["QUEUE_NUMBER_LEASE_SIZE"] = "0"
+os.environ["TOKEN_INDEX_SHARDS"] = "0"
+os.environ["RESET_MODE"] = "recreate"
+os.environ["PURGE_GENERATIONS_FN"] = "purge_generations"
 
 # patch the boto3 client calls before importing all the functions we need to test
 patcher = patch('botocore.client.BaseClient._make_api_call')
 patcher.start()
 # these functions have to be imported after the environment variables have been set
 import assign_queue_num
+import bulk_write
+import queue_positions
+import flush_queue_positions
+import enqueue_request
+import queue_number_lease
 import generate_events
 import auth_generate_token
 import generate_token
+import generate_token_base
+import serving_counter_index
+import token_index
 import get_list_expired_tokens
 import get_num_active_tokens
+import reconcile_active_tokens
 import update_session
 import reset_initial_state
+import purge_generations
+import generations
 import get_public_key
 import get_queue_num
 import get_serving_num
@@ -53,6 +73,8 @@ import get_waiting_num
 import increment_serving_counter
 import get_queue_position_expiry_time
 import set_max_queue_position_expired
+import telemetry
+import get_telemetry
 #patcher.stop()
 
 class CoreApiTestCase(unittest.TestCase):
@@ -72,6 +94,13 @@ class CoreApiTestCase(unittest.TestCase):
         self.invalid_request_id_msg = "Invalid request ID"
         self.expired_queue_position_msg = "Queue position has expired"
         self.validity_period = int(os.environ["VALIDITY_PERIOD"])
+        generate_token_base.jwk_cache.clear()
+        # telemetry recorded by the handlers
+        self.record_telemetry_scripts = {}
+        for module in (assign_queue_num, enqueue_request, generate_token, auth_generate_token, update_session, increment_serving_counter):
+            telemetry_patcher = patch.object(module, 'record_telemetry_script')
+            self.record_telemetry_scripts[module.__name__] = telemetry_patcher.start()
+            self.addCleanup(telemetry_patcher.stop)
 
     def tearDown(self):
         """
@@ -83,9 +112,10 @@ class CoreApiTestCase(unittest.TestCase):
     """
     Start of test methods
     """
-    @patch.object(assign_queue_num.rc, 'incr', return_value=10)
-    @patch.object(assign_queue_num.sqs_client, 'delete_message', return_value={})
-    def test_assign_queue_num(self, mock_incr, mock_delete_message):
+    @patch.object(assign_queue_num.rc, 'get', return_value=None)
+    @patch.object(assign_queue_num.rc, 'pipeline')
+    @patch.object(assign_queue_num, 'assign_queue_num_script', return_value=[[10, -1]])
+    def test_assign_queue_num(self, mock_script, mock_pipeline, mock_get):
         """
         This function tests the assign_queue_num lambda function
         """
@@ -103,20 +133,345 @@ class CoreApiTestCase(unittest.TestCase):
         }
         
         # valid event_id
-        with patch.object(assign_queue_num.ddb_table, 'put_item', return_value=None) as mock_method:
+        with patch.object(assign_queue_num.ddb_resource, 'batch_write_item', return_value={'UnprocessedItems': {}}) as mock_method:
             mock_event["Records"][0]["body"] = json.dumps({"event_id": self.event_id})
             response = assign_queue_num.lambda_handler(mock_event, None)
-            self.assertEqual(response, 10)
+            self.assertEqual(response, {"batchItemFailures": []})
             mock_method.assert_called_once()
-
-        # invalid event_id
-        with patch.object(assign_queue_num.ddb_table, 'put_item', return_value=None) as mock_method:
+            mock_pipeline.return_value.hset.assert_called_once_with("assigned_queue_num:5a571026-3bdd-4c36-aaed-323cb4c37262", 'persisted', 1)
+            # the entry time of the written item is indexed for queue position expiry
+            self.assertEqual(mock_pipeline.return_value.zadd.call_args.args[0], "queue_position_entry_times")
+            self.assertEqual(list(mock_pipeline.return_value.zadd.call_args.args[1].values()), [10])
+            # the new assignment is counted in the telemetry
+            record_telemetry_script = self.record_telemetry_scripts["assign_queue_num"]
+            self.assertEqual(record_telemetry_script.call_args.kwargs["args"][2:], ["enqueued", 1])
+
+        # invalid event_id does not consume a queue number
+        mock_script.reset_mock()
+        with patch.object(assign_queue_num.ddb_resource, 'batch_write_item', return_value={'UnprocessedItems': {}}) as mock_method:
             mock_event["Records"][0]["body"] = json.dumps({"event_id": self.invalid_id})
             response = assign_queue_num.lambda_handler(mock_event, None)
-            self.assertEqual(response, 10)
-            self.assertRaises(Exception)
+            self.assertEqual(response, {"batchItemFailures": []})
+            mock_method.assert_not_called()
+            mock_script.assert_not_called()
+
+        # item could not be written
+        with patch.object(assign_queue_num.ddb_resource, 'batch_write_item',
+                side_effect=ClientError({"Error": {"Code": "500", "Message": "InternalServerError"}}, "BatchWriteItem")):
+            mock_event["Records"][0]["body"] = json.dumps({"event_id": self.event_id})
+            response = assign_queue_num.lambda_handler(mock_event, None)
+            self.assertEqual(response, {"batchItemFailures": [{"itemIdentifier": "ef44b0dc-5184-4cd8-a140-fb9d8a11b8e5"}]})
+
+        # redelivered message that was already written is not written again
+        mock_script.return_value = [[10, 1]]
+        with patch.object(assign_queue_num.ddb_resource, 'batch_write_item', return_value={'UnprocessedItems': {}}) as mock_method:
+            response = assign_queue_num.lambda_handler(mock_event, None)
+            self.assertEqual(response, {"batchItemFailures": []})
             mock_method.assert_not_called()
 
+        # redelivered message that was not written yet keeps its queue number
+        mock_script.return_value = [[10, 0]]
+        with patch.object(assign_queue_num.ddb_resource, 'batch_write_item', return_value={'UnprocessedItems': {}}) as mock_method:
+            response = assign_queue_num.lambda_handler(mock_event, None)
+            self.assertEqual(response, {"batchItemFailures": []})
+            written_item = mock_method.call_args.kwargs['RequestItems'][os.environ["QUEUE_POSITION_ENTRYTIME_TABLE"]][0]['PutRequest']['Item']
+            self.assertEqual(written_item['queue_position'], 10)
+            self.assertEqual(written_item['generation'], 0)
+
+        # the reset generation is not read in recreate mode
+        mock_get.return_value = "2"
+        with patch.object(assign_queue_num.ddb_resource, 'batch_write_item', return_value={'UnprocessedItems': {}}) as mock_method:
+            response = assign_queue_num.lambda_handler(mock_event, None)
+            written_item = mock_method.call_args.kwargs['RequestItems'][os.environ["QUEUE_POSITION_ENTRYTIME_TABLE"]][0]['PutRequest']['Item']
+            self.assertEqual(written_item['generation'], 0)
+            mock_get.assert_not_called()
+
+        # queue positions are tagged with the current reset generation
+        with patch.object(assign_queue_num.ddb_resource, 'batch_write_item', return_value={'UnprocessedItems': {}}) as mock_method, \
+                patch.object(generations, 'GENERATION_RESET_MODE', True):
+            response = assign_queue_num.lambda_handler(mock_event, None)
+            written_item = mock_method.call_args.kwargs['RequestItems'][os.environ["QUEUE_POSITION_ENTRYTIME_TABLE"]][0]['PutRequest']['Item']
+            self.assertEqual(written_item['generation'], 2)
+            mock_get.assert_called_with("reset_generation")
+
+        # malformed message is reported without failing the rest of the batch
+        # and only the valid message consumes a queue number
+        mock_script.return_value = [[10, -1]]
+        malformed_msg = dict(mock_event["Records"][0], messageId="b1a3c0dc-5184-4cd8-a140-fb9d8a11b8e5", body="{")
+        wrong_event_msg = dict(mock_event["Records"][0], messageId="c2a3c0dc-5184-4cd8-a140-fb9d8a11b8e5", body=json.dumps({"event_id": self.invalid_id}),
+                               messageAttributes={"apig_request_id": {"stringValue": self.invalid_id}})
+        mock_event["Records"].extend([malformed_msg, wrong_event_msg])
+        with patch.object(assign_queue_num.ddb_resource, 'batch_write_item', return_value={'UnprocessedItems': {}}) as mock_method:
+            response = assign_queue_num.lambda_handler(mock_event, None)
+            self.assertEqual(response, {"batchItemFailures": [{"itemIdentifier": "b1a3c0dc-5184-4cd8-a140-fb9d8a11b8e5"}]})
+            mock_method.assert_called_once()
+            self.assertEqual(mock_script.call_args.kwargs['keys'], ["queue_counter", "assigned_queue_num:5a571026-3bdd-4c36-aaed-323cb4c37262"])
+
+    @patch.object(assign_queue_num.rc, 'get', return_value=None)
+    @patch.object(assign_queue_num.rc, 'pipeline')
+    @patch.object(assign_queue_num, 'PERSIST_CHUNK_SIZE', 40)
+    def test_assign_queue_num_large_batch(self, mock_pipeline, _):
+        """
+        This function tests that assign_queue_num reserves numbers once and persists large batches in chunks
+        """
+        mock_pipeline.return_value.__len__.return_value = 1
+        num_msg = 100
+        request_ids = [f"5a571026-3bdd-4c36-aaed-{i:012d}" for i in range(num_msg)]
+        mock_event = {
+            "Records": [{
+                "messageId": f"msg-{i}",
+                "receiptHandle": "AQEBzHTDpcozyKFctjEWiT",
+                "body": json.dumps({"event_id": self.event_id}),
+                "messageAttributes": {"apig_request_id": {"stringValue": request_id}}
+            } for (i, request_id) in enumerate(request_ids)]
+        }
+        with patch.object(assign_queue_num, 'assign_queue_num_script', return_value=[[i + 1, -1] for i in range(num_msg)]) as mock_script:
+            with patch.object(assign_queue_num.ddb_resource, 'batch_write_item', return_value={'UnprocessedItems': {}}) as mock_method:
+                response = assign_queue_num.lambda_handler(mock_event, None)
+                self.assertEqual(response, {"batchItemFailures": []})
+                mock_script.assert_called_once()
+                # chunks of 40, 40 and 20 items written at most 25 items at a time
+                self.assertEqual(mock_method.call_count, 5)
+                self.assertEqual(mock_pipeline.return_value.execute.call_count, 3)
+
+    @patch.object(assign_queue_num.rc, 'get', return_value=None)
+    @patch.object(assign_queue_num.rc, 'pipeline')
+    @patch.object(assign_queue_num, 'assign_queue_num_script', return_value=[[10, -1]])
+    @patch.object(assign_queue_num, 'ENABLE_QUEUE_POSITION_WRITE_BEHIND', 'true')
+    def test_assign_queue_num_write_behind(self, mock_script, mock_pipeline, _):
+        """
+        This function tests that assign_queue_num stages queue positions in redis when write-behind is enabled
+        """
+        mock_event = {
+            "Records": [{
+                "messageId": "msg-0",
+                "receiptHandle": "AQEBzHTDpcozyKFctjEWiT",
+                "body": json.dumps({"event_id": self.event_id}),
+                "messageAttributes": {"apig_request_id": {"stringValue": self.request_id}}
+            }]
+        }
+        with patch.object(assign_queue_num.ddb_resource, 'batch_write_item') as mock_method:
+            response = assign_queue_num.lambda_handler(mock_event, None)
+            self.assertEqual(response, {"batchItemFailures": []})
+            mock_method.assert_not_called()
+            mock_pipe = mock_pipeline.return_value
+            self.assertEqual(mock_pipe.hset.call_args_list[0].args[0], f"queue_position:{self.request_id}")
+            self.assertEqual(mock_pipe.hset.call_args_list[0].kwargs['mapping']['queue_position'], 10)
+            mock_pipe.zadd.assert_any_call("pending_queue_positions", {self.request_id: 10})
+            # the entry time is indexed for queue position expiry
+            (index_key, index_entries) = mock_pipe.zadd.call_args_list[1].args
+            self.assertEqual(index_key, "queue_position_entry_times")
+            self.assertEqual(list(index_entries.values()), [10])
+            self.assertTrue(list(index_entries)[0].startswith("10:") and list(index_entries)[0].endswith(":0"))
+            mock_pipe.hset.assert_called_with(f"assigned_queue_num:{self.request_id}", 'persisted', 1)
+            mock_pipe.execute.assert_called_once()
+
+    @patch.object(enqueue_request.rc, 'get', return_value=None)
+    @patch.object(enqueue_request.rc, 'pipeline')
+    @patch.object(enqueue_request, 'assign_queue_num_script', return_value=[[10, -1]])
+    @patch.object(enqueue_request.sqs_client, 'send_message')
+    @patch.object(enqueue_request.sqs_client, 'get_queue_attributes',
+                  return_value={'Attributes': {'ApproximateNumberOfMessages': '10', 'ApproximateNumberOfMessagesNotVisible': '5'}})
+    def test_enqueue_request(self, mock_get_queue_attributes, mock_send_message, mock_script, mock_pipeline, _):
+        """
+        This function tests the enqueue_request lambda function
+        """
+        mock_event = {"body": json.dumps({"event_id": self.event_id}), "requestContext": {"requestId": self.request_id}}
+        enqueue_request.backlog_cache["measured_at"] = 0
+
+        # invalid event_id
+        response = enqueue_request.lambda_handler(dict(mock_event, body=json.dumps({"event_id": self.invalid_id})), None)
+        self.assertEqual(response["statusCode"], 400)
+        self.assertEqual(json.loads(response['body'])["error"], self.invalid_event_id_msg)
+
+        # backlog below the threshold, queue number is assigned inline
+        with patch.object(enqueue_request.ddb_resource, 'batch_write_item', return_value={'UnprocessedItems': {}}):
+            response = enqueue_request.lambda_handler(mock_event, None)
+            self.assertEqual(response["statusCode"], 200)
+            body = json.loads(response['body'])
+            self.assertEqual(body["api_request_id"], self.request_id)
+            self.assertEqual(body["queue_number"], 10)
+            mock_send_message.assert_not_called()
+
+        # queue number could not be written, request falls back to the queue
+        with patch.object(enqueue_request.ddb_resource, 'batch_write_item',
+                side_effect=ClientError({"Error": {"Code": "500", "Message": "InternalServerError"}}, "BatchWriteItem")):
+            response = enqueue_request.lambda_handler(mock_event, None)
+            self.assertEqual(response["statusCode"], 200)
+            self.assertNotIn("queue_number", json.loads(response['body']))
+            mock_send_message.assert_called_once()
+            self.assertEqual(mock_send_message.call_args.kwargs['MessageAttributes']['apig_request_id']['StringValue'], self.request_id)
+
+        # backlog measurement is cached
+        mock_get_queue_attributes.assert_called_once()
+
+        # backlog above the threshold, request is queued
+        mock_send_message.reset_mock()
+        mock_script.reset_mock()
+        enqueue_request.backlog_cache["measured_at"] = 0
+        mock_get_queue_attributes.return_value = {'Attributes': {'ApproximateNumberOfMessages': '100', 'ApproximateNumberOfMessagesNotVisible': '50'}}
+        response = enqueue_request.lambda_handler(mock_event, None)
+        self.assertEqual(response["statusCode"], 200)
+        self.assertEqual(json.loads(response['body']), {"api_request_id": self.request_id})
+        mock_send_message.assert_called_once()
+        mock_script.assert_not_called()
+
+    def test_queue_number_allocator(self):
+        """
+        This function tests the queue number block leasing allocator
+        """
+        rc = MagicMock()
+        lease_script = MagicMock(return_value=[1, 5])
+        assign_script = MagicMock(side_effect=lambda keys, args: [len(keys)] + [[i, -1] for i in range(1, len(keys))])
+        rc.register_script.side_effect = [lease_script, assign_script]
+        allocator = queue_number_lease.QueueNumberAllocator(rc, 5)
+
+        # positions are handed out from one leased block
+        self.assertEqual(allocator.reserve(["a", "b"]), [[1, -1], [2, -1]])
+        self.assertEqual(allocator.reserve(["c"]), [[1, -1]])
+        lease_script.assert_called_once()
+        self.assertEqual(assign_script.call_args.kwargs['keys'], ["queue_number_lease:1", "assigned_queue_num:c"])
+        self.assertEqual(allocator.lease['next'], 2)
+
+        # a new block is leased when the lease expired
+        assign_script.side_effect = [False, [7, [6, -1]]]
+        lease_script.return_value = [6, 10]
+        self.assertEqual(allocator.reserve(["d"]), [[6, -1]])
+        self.assertEqual(lease_script.call_count, 2)
+        self.assertEqual(allocator.lease, dict(allocator.lease, key="queue_number_lease:6", next=7, end=10))
+
+        # batches larger than the remaining positions span leases
+        assign_script.side_effect = lambda keys, args: [11 if keys[0] == "queue_number_lease:6" else 12] + [[0, -1]] * (len(keys) - 1)
+        lease_script.return_value = [11, 15]
+        allocator.reserve(["e", "f", "g", "h", "i"])
+        self.assertEqual(len(assign_script.call_args_list[-2].kwargs['keys']), 5)
+        self.assertEqual(assign_script.call_args_list[-1].kwargs['keys'], ["queue_number_lease:11", "assigned_queue_num:i"])
+        # the used up block is released and the next block is doubled up to the lease size
+        self.assertEqual(lease_script.call_args.kwargs['args'][0], 5)
+        self.assertEqual(lease_script.call_args.kwargs['args'][4], 6)
+
+        # a lease given up before it is used up is released and the next block is shrunk to what was used
+        allocator.lease['use_until'] = 0
+        assign_script.side_effect = lambda keys, args: [17, [16, -1]]
+        lease_script.return_value = [16, 16]
+        allocator.reserve(["j"])
+        self.assertEqual(lease_script.call_args.kwargs['args'][0], 1)
+        self.assertEqual(lease_script.call_args.kwargs['args'][4], 11)
+
+    def test_queue_positions(self):
+        """
+        This function tests the queue position write-behind store
+        """
+        item = {"event_id": self.event_id, "queue_position": "1", "entry_time": "1002", "request_id": self.request_id, "status": "1"}
+        rc = MagicMock()
+        ddb_table = MagicMock()
+        ddb_table.get_item.return_value = {}
+
+        # staged record is read from redis
+        rc.hgetall.return_value = item
+        self.assertEqual(queue_positions.get_queue_position_item(rc, ddb_table, self.request_id, 'true', 0), {'Item': item})
+        ddb_table.get_item.assert_not_called()
+
+        # records of a previous reset generation are ignored
+        self.assertEqual(queue_positions.get_queue_position_item(rc, ddb_table, self.request_id, 'true', 1), {})
+        rc.hgetall.return_value = dict(item, generation="1")
+        self.assertEqual(queue_positions.get_queue_position_item(rc, ddb_table, self.request_id, 'true', 1), {'Item': dict(item, generation="1")})
+
+        # falls back to dynamodb if the record is not in redis or write-behind is disabled
+        rc.hgetall.return_value = {}
+        self.assertEqual(queue_positions.get_queue_position_item(rc, ddb_table, self.request_id, 'true', 0), {})
+        queue_positions.get_queue_position_item(rc, ddb_table, self.request_id, 'false', 0)
+        self.assertEqual(ddb_table.get_item.call_count, 2)
+        self.assertEqual(rc.hgetall.call_count, 4)
+
+        # pending records are persisted and removed from the pending set
+        rc.zrange.return_value = [self.request_id, self.invalid_id]
+        rc.pipeline.return_value.execute.return_value = [item, {}]
+        ddb_resource = MagicMock()
+        ddb_resource.batch_write_item.return_value = {'UnprocessedItems': {}}
+        requeue_failed_script = MagicMock()
+        flushed = queue_positions.flush_queue_positions(rc, requeue_failed_script, ddb_resource, "queue_position_entry_time_table", 500)
+        self.assertEqual(flushed, 2)
+        written_item = ddb_resource.batch_write_item.call_args.kwargs['RequestItems']["queue_position_entry_time_table"][0]['PutRequest']['Item']
+        self.assertEqual(written_item['queue_position'], 1)
+        self.assertEqual(written_item['generation'], 0)
+        rc.pipeline.return_value.zrem.assert_called_once_with("pending_queue_positions", self.request_id, self.invalid_id)
+
+        requeue_failed_script.assert_not_called()
+
+        # records that could not be written stay pending behind the others, or are moved to the failed set
+        rc.pipeline.reset_mock()
+        rc.zrange.return_value = [self.request_id]
+        rc.pipeline.return_value.execute.return_value = [item]
+        ddb_resource.batch_write_item.side_effect = ClientError({"Error": {"Code": "500", "Message": "Internal Server Error"}}, "batch_write_item")
+        flushed = queue_positions.flush_queue_positions(rc, requeue_failed_script, ddb_resource, "queue_position_entry_time_table", 500)
+        self.assertEqual(flushed, 0)
+        rc.pipeline.return_value.zrem.assert_not_called()
+        requeue_failed_script.assert_called_once_with(
+            keys=["pending_queue_positions", "failed_queue_positions"],
+            args=[queue_positions.MAX_FLUSH_ATTEMPTS, "queue_position", self.request_id]
+        )
+
+        # nothing pending
+        rc.zrange.return_value = []
+        self.assertEqual(queue_positions.flush_queue_positions(rc, requeue_failed_script, ddb_resource, "queue_position_entry_time_table", 500), 0)
+
+    @patch.object(flush_queue_positions, 'sleep')
+    @patch.object(flush_queue_positions, 'flush_queue_positions', return_value=3)
+    def test_flush_queue_positions(self, mock_flush, mock_sleep):
+        """
+        This function tests the flush_queue_positions lambda function
+        """
+        mock_context = MagicMock()
+        mock_context.get_remaining_time_in_millis.side_effect = [50000, 40000, 1000]
+        response = flush_queue_positions.lambda_handler({}, mock_context)
+        self.assertEqual(response, 6)
+        self.assertEqual(mock_flush.call_count, 2)
+        self.assertEqual(mock_sleep.call_count, 2)
+
+    def test_batch_put_items(self):
+        """
+        This function tests the bulk write helper used by assign_queue_num
+        """
+        table_name = os.environ["QUEUE_POSITION_ENTRYTIME_TABLE"]
+        items = [{'request_id': str(i), 'queue_position': i} for i in range(60)]
+        ddb_resource = MagicMock()
+
+        # written in chunks of 25
+        ddb_resource.batch_write_item.return_value = {'UnprocessedItems': {}}
+        failed_items = bulk_write.batch_put_items(ddb_resource, table_name, items)
+        self.assertEqual(failed_items, [])
+        self.assertEqual(ddb_resource.batch_write_item.call_count, 3)
+
+        # unprocessed items are retried
+        ddb_resource.reset_mock()
+        ddb_resource.batch_write_item.side_effect = [
+            {'UnprocessedItems': {table_name: [{'PutRequest': {'Item': items[0]}}]}},
+            {'UnprocessedItems': {}}
+        ]
+        with patch.object(bulk_write, 'sleep'):
+            failed_items = bulk_write.batch_put_items(ddb_resource, table_name, items[:25])
+        self.assertEqual(failed_items, [])
+        self.assertEqual(ddb_resource.batch_write_item.call_count, 2)
+
+        # items still unprocessed after all attempts are returned
+        ddb_resource.reset_mock()
+        ddb_resource.batch_write_item.side_effect = None
+        ddb_resource.batch_write_item.return_value = {'UnprocessedItems': {table_name: [{'PutRequest': {'Item': items[1]}}]}}
+        with patch.object(bulk_write, 'sleep'):
+            failed_items = bulk_write.batch_put_items(ddb_resource, table_name, items[:25])
+        self.assertEqual(failed_items, [items[1]])
+        self.assertEqual(ddb_resource.batch_write_item.call_count, bulk_write.MAX_BATCH_WRITE_ATTEMPTS)
+
+        # items are deleted by key in chunks of 25 and the keys still unprocessed are returned
+        ddb_resource.reset_mock()
+        keys = [{'request_id': item['request_id']} for item in items]
+        ddb_resource.batch_write_item.return_value = {'UnprocessedItems': {table_name: [{'DeleteRequest': {'Key': keys[1]}}]}}
+        with patch.object(bulk_write, 'sleep'):
+            failed_keys = bulk_write.batch_delete_items(ddb_resource, table_name, keys[:30])
+        self.assertEqual(failed_keys, [keys[1], keys[1]])
+        self.assertEqual(ddb_resource.batch_write_item.call_args_list[0].kwargs['RequestItems'][table_name][0], {'DeleteRequest': {'Key': keys[0]}})
+
 
     @patch.object(auth_generate_token.ddb_table_tokens, 'query',
                   return_value={"Items": [{"request_id": "fe7a5f04-6ff0-4bd6-9c31-52088cc4e73a", "expires": 1000,
@@ -146,11 +501,10 @@ class CoreApiTestCase(unittest.TestCase):
         """
 
         redis_cache = {'max_queue_position_expired': '2', 'serving_counter': '5' }
-        def get(key):
-            return redis_cache[key]
-
         auth_generate_token.rc = MagicMock()
-        auth_generate_token.rc.get = Mock(side_effect=get)
+        auth_generate_token.rc.mget = Mock(side_effect=lambda keys: [redis_cache.get(key) for key in keys])
+        auth_generate_token.rc.zrangebyscore = Mock(return_value=[])
+        auth_generate_token.rc.pipeline.return_value.execute.return_value = [[None, None, None], None]
 
          # invalid event_id
         mock_event_400 = {
@@ -217,23 +571,40 @@ class CoreApiTestCase(unittest.TestCase):
         # add test for regenerate token
 
 
-    @patch.object(generate_events.rc, 'get', return_value=1)
+    @patch.object(generate_events.rc, 'pipeline')
     @patch.object(generate_events.events_client, 'put_events',
                   return_value={'ResponseMetadata': {'FailedEntryCount': 0, "Entries": [{"EventId": "11710aed-b79e-4468-a20b-bb3c0c3b4860"}]}})
-    def test_generate_events(self, mock_get, mock_put_events):
+    def test_generate_events(self, mock_put_events, mock_pipeline):
         """
         This function tests the generate_events lambda function
         """
-        response_body = json.dumps({"body": json.dumps({"active_tokens": 0})})
-        invoke_response = {"Payload": StreamingBody(StringIO(str(response_body)),
-                                                    len(str(response_body)))}
+        counter_values = ["5", "3", "2", None, "1", None, None, None, None]
+        mock_pipeline.return_value.execute.return_value = [counter_values, 0, 2]
 
-        # both lambda invoke and put_events are succesful
-        with patch.object(generate_events.lambda_client, 'invoke', return_value=invoke_response):
-            # valid event_id
+        with patch('builtins.print') as mock_print:
             response = generate_events.lambda_handler(None, None)
-            self.assertEqual(
-                response['ResponseMetadata']['FailedEntryCount'], 0)
+        self.assertEqual(response['ResponseMetadata']['FailedEntryCount'], 0)
+        # counters and active tokens are read in a single round trip
+        mock_pipeline.return_value.mget.assert_called_once()
+        mock_pipeline.return_value.zcount.assert_called_once()
+        mock_pipeline.return_value.execute.assert_called_once()
+        # counters are written to the event bus as read from Redis
+        detail = json.loads(mock_put_events.call_args.kwargs['Entries'][0]['Detail'])
+        self.assertEqual(detail, {
+            "event_id": self.event_id, "num_active_tokens": 2, "total_num_tokens": "2", "queue_counter": "5",
+            "serving_number": "3", "completed_sessions": "1", "abandoned_sessions": None
+        })
+
+        # metrics are logged in embedded metric format
+        emf = json.loads(mock_print.call_args_list[1].args[0])
+        metric_directive = emf["_aws"]["CloudWatchMetrics"][0]
+        self.assertEqual(metric_directive["Dimensions"], [["EventId"]])
+        self.assertEqual({metric["Name"] for metric in metric_directive["Metrics"]}, set(detail) - {"event_id"})
+        self.assertTrue(all(metric["StorageResolution"] == 1 for metric in metric_directive["Metrics"]))
+        self.assertEqual(emf["EventId"], self.event_id)
+        self.assertEqual(emf["num_active_tokens"], 2)
+        self.assertEqual(emf["queue_counter"], 5)
+        self.assertEqual(emf["abandoned_sessions"], 0)
 
         # put_events throws an exception
         with patch.object(generate_events.events_client, 'put_events', side_effect=Exception):
@@ -267,11 +638,10 @@ class CoreApiTestCase(unittest.TestCase):
         This function tests the generate_token lambda function
         """
         redis_cache = {'max_queue_position_expired': '2', 'serving_counter': '5' }
-        def get(key):
-            return redis_cache[key]
-
         generate_token.rc = MagicMock()
-        generate_token.rc.get = Mock(side_effect=get)
+        generate_token.rc.mget = Mock(side_effect=lambda keys: [redis_cache.get(key) for key in keys])
+        generate_token.rc.zrangebyscore = Mock(return_value=[])
+        generate_token.rc.pipeline.return_value.execute.return_value = [[None, None, None], None]
 
         # invalid event_id
         mock_event_400 = {
@@ -334,9 +704,163 @@ class CoreApiTestCase(unittest.TestCase):
                             response = generate_token.lambda_handler(mock_event, None)
                             self.assertEqual(response["statusCode"], 200)
                             mock_method.assert_called_once()
+                            self.assertEqual(mock_method.call_args.kwargs['Item']['event_id'], self.event_id)
+                            # issued token is counted and active until it expires
+                            mock_pipe = generate_token.rc.pipeline.return_value
+                            cached_mapping = mock_pipe.hset.call_args.kwargs['mapping']
+                            exp = json.loads(cached_mapping['kid'])['expires']
+                            mock_pipe.incr.assert_called_once_with("token_counter", 1)
+                            mock_pipe.zadd.assert_any_call("active_tokens", {self.request_id: exp})
+                            # the telemetry is recorded in the same round trip
+                            record_telemetry_script = self.record_telemetry_scripts["generate_token"]
+                            mock_pipe.evalsha.assert_called_once()
+                            self.assertEqual(mock_pipe.evalsha.call_args.args[:3], (record_telemetry_script.sha, 1, "telemetry"))
+                            self.assertEqual(mock_pipe.evalsha.call_args.args[-2:], ("tokens_issued", 1))
+                            mock_pipe.execute.assert_called_with(raise_on_error=False)
+                            # issued tokens are cached until they expire
+                            generate_token.rc.pipeline.return_value.hset.assert_called_once()
+                            cached_tokens = json.loads(cached_mapping['kid'])
+                            self.assertEqual(cached_mapping['generation'], 0)
+                            self.assertEqual(cached_tokens['access_token'], json.loads(response["body"])['access_token'])
+
+        # tokens are issued to queue positions of the current reset generation only
+        redis_cache['reset_generation'] = '1'
+        with patch.object(generations, 'GENERATION_RESET_MODE', True):
+            with patch.object(generate_token.ddb_table_queue_position_entry_time, 'get_item',
+                    return_value={'Item': {"queue_position": 3, "event_id": "abc123", "entry_time": 1002, "status": 1}}):
+                response = generate_token.lambda_handler(mock_event, None)
+                self.assertEqual(response["statusCode"], 400)
+                self.assertEqual(json.loads(response["body"])["error"], self.invalid_request_id_msg)
+            with patch.object(generate_token.ddb_table_queue_position_entry_time, 'get_item', 
+                    return_value={'Item': {"queue_position": 3, "event_id": "abc123", "entry_time": 1002, "status": 1, "generation": 1}}):
+                with patch.object(generate_token.ddb_table_tokens, 'get_item', return_value={}):
+                    with patch.object(generate_token.ddb_table_tokens, 'put_item', return_value={}) as mock_method:
+                        with patch.object(generate_token.ddb_table_serving_counter_issued_at, 'query', 
+                            return_value={ 'Items': [{'issue_time': int(time.time()) - 50, 'serving_counter': '5', 'queue_positions_served': 1 } ]}):
+                            response = generate_token.lambda_handler(mock_event, None)
+                            self.assertEqual(response["statusCode"], 200)
+                            self.assertEqual(mock_method.call_args.kwargs['Item']['event_id'], f"{self.event_id}#g1")
 
+        # the reset generation is ignored in recreate mode
+        with patch.object(generate_token.ddb_table_queue_position_entry_time, 'get_item', 
+                return_value={'Item': {"queue_position": 3, "event_id": "abc123", "entry_time": 1002, "status": 1}}):
+            with patch.object(generate_token.ddb_table_tokens, 'get_item', return_value={}):
+                with patch.object(generate_token.ddb_table_tokens, 'put_item', return_value={}) as mock_method:
+                    with patch.object(generate_token.ddb_table_serving_counter_issued_at, 'query', 
+                        return_value={ 'Items': [{'issue_time': int(time.time()) - 50, 'serving_counter': '5', 'queue_positions_served': 1 } ]}):
+                        response = generate_token.lambda_handler(mock_event, None)
+                        self.assertEqual(response["statusCode"], 200)
+                        self.assertEqual(mock_method.call_args.kwargs['Item']['event_id'], self.event_id)
+        redis_cache['reset_generation'] = None
+
+        # cached tokens are returned without reading the token table
+        generate_token.rc.pipeline.return_value.execute.return_value = [[json.dumps(cached_tokens), None, None], None]
+        with patch.object(generate_token.ddb_table_tokens, 'get_item') as mock_get_item:
+            response = generate_token.lambda_handler(mock_event, None)
+            self.assertEqual(response["statusCode"], 200)
+            self.assertEqual(json.loads(response["body"])['id_token'], cached_tokens['id_token'])
+            mock_get_item.assert_not_called()
+
+        # tokens signed with another key are not used
+        generate_token.rc.pipeline.return_value.execute.return_value = [[json.dumps(dict(cached_tokens, kid='rotated')), None, None], None]
+        with patch.object(generate_token.ddb_table_queue_position_entry_time, 'get_item', 
+                return_value={'Item': {"queue_position": 3, "event_id": "abc123", "entry_time": 1002, "status": 1}}):
+            with patch.object(generate_token.ddb_table_tokens, 'get_item', 
+                return_value={"Item": {"request_id": "fe7a5f04-6ff0-4bd6-9c31-52088cc4e73a", "session_status" : "0", "expires": 2000, "issued_at": 1000, 
+                                "not_before": 1000, "queue_number": 2, "issuer": "someone"}}) as mock_get_item:
+                response = generate_token.lambda_handler(mock_event, None)
+                self.assertEqual(response["statusCode"], 200)
+                mock_get_item.assert_called_once()
+
+        # session status set by update_session
+        generate_token.rc.pipeline.return_value.execute.return_value = [[json.dumps(cached_tokens), "1", None], None]
+        response = generate_token.lambda_handler(mock_event, None)
+        self.assertEqual(response["statusCode"], 410)
+
+        # tokens cached in a previous reset generation are not used
+        generate_token.rc.pipeline.return_value.execute.return_value = [[json.dumps(cached_tokens), "1", None], "1"]
+        with patch.object(generate_token.ddb_table_queue_position_entry_time, 'get_item', return_value={}):
+            with patch.object(generations, 'GENERATION_RESET_MODE', True):
+                response = generate_token.lambda_handler(mock_event, None)
+            self.assertEqual(response["statusCode"], 400)
+
+    def test_serving_counter_index(self):
+        """
+        This function tests the Redis index of the serving counter issue times
+        """
+        rc = MagicMock()
+        ddb_table = MagicMock()
+
+        # issue time found in the index, the serving counter was incremented from below the queue number
+        rc.zrangebyscore.return_value = ["5:1000:2", "9:1100:5"]
+        item = serving_counter_index.get_serving_counter_item(rc, ddb_table, self.event_id, 3)
+        self.assertEqual(item, {'serving_counter': 5, 'issue_time': 1000})
+        rc.zrangebyscore.assert_called_once_with("serving_counter_issue_times", 3, "+inf", start=0, num=4)
+        ddb_table.query.assert_not_called()
+
+        # another entry of the same serving counter value can be used
+        rc.zrangebyscore.return_value = ["30:1000:29", "30:1000:4", "31:1100:30"]
+        item = serving_counter_index.get_serving_counter_item(rc, ddb_table, self.event_id, 5)
+        self.assertEqual(item, {'serving_counter': 30, 'issue_time': 1000})
+        ddb_table.query.assert_not_called()
+
+        # the index may be missing earlier serving counter values, read from the table and added to the index
+        for members in [["30:1000:29"], ["30:1000"], []]:
+            rc.reset_mock()
+            ddb_table.reset_mock()
+            rc.zrangebyscore.return_value = members
+            ddb_table.query.return_value = {'Items': [{'event_id': self.event_id, 'serving_counter': 8, 'issue_time': 1200, 'queue_positions_served': 0}]}
+            item = serving_counter_index.get_serving_counter_item(rc, ddb_table, self.event_id, 5)
+            self.assertEqual(int(item['serving_counter']), 8)
+            ddb_table.query.assert_called_once()
+            rc.pipeline.return_value.zadd.assert_any_call("serving_counter_issue_times", {"8:1200:4": 8})
+
+        # no serving counter at or above the queue number
+        ddb_table.query.return_value = {'Items': []}
+        self.assertIsNone(serving_counter_index.get_serving_counter_item(rc, ddb_table, self.event_id, 9))
+
+    def test_get_jwk_keypair(self):
+        """
+        This function tests the private key cache shared by the generate token functions
+        """
+        keypair = jwk.JWK.generate(kty='RSA', size=2048, kid='key1')
+        rotated_keypair = jwk.JWK.generate(kty='RSA', size=2048, kid='key2')
+        secrets_client = MagicMock()
+        secrets_client.get_secret_value.return_value = {"SecretString": keypair.export_private()}
+
+        # key is read once and reused
+        self.assertEqual(generate_token_base.get_jwk_keypair(secrets_client, "vwr").key_id, 'key1')
+        self.assertEqual(generate_token_base.get_jwk_keypair(secrets_client, "vwr").key_id, 'key1')
+        secrets_client.get_secret_value.assert_called_once_with(SecretId="vwr/jwk-private")
+
+        # key is read again once the cache period has passed
+        secrets_client.get_secret_value.return_value = {"SecretString": rotated_keypair.export_private()}
+        generate_token_base.jwk_cache["vwr"]['loaded_at'] -= generate_token_base.JWK_CACHE_SECONDS
+        self.assertEqual(generate_token_base.get_jwk_keypair(secrets_client, "vwr").key_id, 'key2')
+        self.assertEqual(secrets_client.get_secret_value.call_count, 2)
+
+        # tokens signed with another key before the key was loaded keep the cached key
+        loaded_at = generate_token_base.jwk_cache["vwr"]['loaded_at']
+        generate_token_base.drop_stale_jwk_keypair("vwr", 'key1', loaded_at - 100)
+        self.assertEqual(generate_token_base.get_jwk_keypair(secrets_client, "vwr").key_id, 'key2')
+        self.assertEqual(secrets_client.get_secret_value.call_count, 2)
+        # tokens signed with another key after the key was loaded drop the cached key
+        generate_token_base.drop_stale_jwk_keypair("vwr", 'key3', loaded_at + 1)
+        self.assertNotIn("vwr", generate_token_base.jwk_cache)
+        self.assertEqual(generate_token_base.get_jwk_keypair(secrets_client, "vwr").key_id, 'key2')
+        self.assertEqual(secrets_client.get_secret_value.call_count, 3)
+
+        # key is read again and signing retried if signing fails
+        claims = generate_token_base.create_claims(self.event_id, self.request_id, "https://example.com", 1, 0, 0, self.validity_period)
+        with patch.object(generate_token_base, 'create_tokens', side_effect=[ValueError("signing failed"), ("access", "refresh", "id")]) as mock_create_tokens:
+            tokens = generate_token_base.create_signed_tokens(claims, secrets_client, "vwr", True)
+            self.assertEqual(tokens, ("access", "refresh", "id"))
+            self.assertEqual(mock_create_tokens.call_count, 2)
+        self.assertEqual(secrets_client.get_secret_value.call_count, 4)
+
+    @patch.object(get_list_expired_tokens, 'rc')
     @patch.object(get_list_expired_tokens.ddb_table, 'query',return_value={"Items": [{"request_id": "fe7a5f04-6ff0-4bd6-9c31-52088cc4e73a"}]})
-    def test_get_list_expired_tokens(self, mock_query):
+    def test_get_list_expired_tokens(self, mock_query, mock_rc):
         """
         This function tests the get_list_expired_tokens lambda function
         """
@@ -413,17 +937,108 @@ class CoreApiTestCase(unittest.TestCase):
             json.dumps(["id1"])
         )
 
-    @patch.object(get_num_active_tokens.ddb_table, 'query',return_value={"Items": [{"request_id": "fe7a5f04-6ff0-4bd6-9c31-52088cc4e73a"}]})
-    def test_get_num_active_tokens(self, mock_query):
+        # the list is capped, the cursor of the rest is returned in a header
+        mock_query.side_effect = [
+            {"Items": [{"request_id": "id1"}, {"request_id": "id2"}],
+             "LastEvaluatedKey": {"request_id": "id2", "event_id": self.event_id, "expires": Decimal(1000)}}
+        ]
+        with patch.object(get_list_expired_tokens, 'MAX_PAGE_SIZE', 2):
+            response = get_list_expired_tokens.lambda_handler(mock_event, None)
+        self.assertEqual(response['body'], json.dumps(["id1", "id2"]))
+        self.assertEqual(mock_query.call_args.kwargs["Limit"], 2)
+        mock_event = {'queryStringParameters': {'event_id': self.event_id, 'cursor': response['headers']['X-Next-Cursor']}}
+        mock_query.side_effect = [{"Items": [{"request_id": "id3"}]}]
+        response = get_list_expired_tokens.lambda_handler(mock_event, None)
+        self.assertEqual(json.loads(response["body"])["request_ids"], ["id3"])
+        mock_event = {'queryStringParameters': {'event_id': self.event_id}}
+
+        # redis is not called in recreate mode
+        mock_rc.get.assert_not_called()
+
+        # tokens of the current reset generation are listed
+        mock_rc.get.return_value = "2"
+        mock_query.side_effect = [{"Items": [{"request_id": "id1"}]}]
+        with patch.object(generations, 'GENERATION_RESET_MODE', True):
+            get_list_expired_tokens.lambda_handler(mock_event, None)
+        key_condition = mock_query.call_args.kwargs["KeyConditionExpression"]
+        self.assertEqual(key_condition.get_expression()["values"][0].get_expression()["values"][1], f"{self.event_id}#g2")
+
+    @patch.object(get_list_expired_tokens, 'rc')
+    @patch.object(get_list_expired_tokens.ddb_table, 'query')
+    def test_get_list_expired_tokens_paged(self, mock_query, mock_rc):
+        """
+        This function tests the cursor pagination of the get_list_expired_tokens lambda function
+        """
+        last_key = {"request_id": "id2", "event_id": self.event_id, "expires": Decimal(1000)}
+        mock_query.side_effect = [
+            {"Items": [{"request_id": "id1"}, {"request_id": "id2"}], "LastEvaluatedKey": last_key},
+            {"Items": [{"request_id": "id3"}]}
+        ]
+        mock_event = {'queryStringParameters': {'event_id': self.event_id, 'limit': '2', 'expired_since': '500'}}
+        response = get_list_expired_tokens.lambda_handler(mock_event, None)
+        self.assertEqual(response["statusCode"], 200)
+        first_page = json.loads(response["body"])
+        self.assertEqual(first_page["request_ids"], ["id1", "id2"])
+        self.assertIsNotNone(first_page["next_cursor"])
+        self.assertEqual(mock_query.call_args.kwargs["Limit"], 2)
+        self.assertEqual(mock_query.call_args.kwargs["IndexName"], "EventExpiresIndex")
+
+        # the next page continues from the last key with the same expiry range
+        mock_event = {'queryStringParameters': {'event_id': self.event_id, 'limit': '2', 'cursor': first_page["next_cursor"]}}
+        response = get_list_expired_tokens.lambda_handler(mock_event, None)
+        second_page = json.loads(response["body"])
+        self.assertEqual(second_page["request_ids"], ["id3"])
+        self.assertIsNone(second_page["next_cursor"])
+        self.assertEqual(second_page["expired_before"], first_page["expired_before"])
+        self.assertEqual(mock_query.call_args.kwargs["ExclusiveStartKey"], {"request_id": "id2", "event_id": self.event_id, "expires": 1000})
+
+        # nothing newer than the watermark
+        mock_query.reset_mock()
+        mock_event = {'queryStringParameters': {'event_id': self.event_id, 'expired_since': str(int(time.time()) + 100)}}
+        response = get_list_expired_tokens.lambda_handler(mock_event, None)
+        self.assertEqual(json.loads(response["body"])["request_ids"], [])
+        mock_query.assert_not_called()
+
+        # invalid paging parameters
+        for parameters in [{'limit': '0'}, {'limit': 'abc'}, {'cursor': 'not-a-cursor'}]:
+            mock_event = {'queryStringParameters': dict(parameters, event_id=self.event_id)}
+            response = get_list_expired_tokens.lambda_handler(mock_event, None)
+            self.assertEqual(response["statusCode"], 400)
+
+        # tampered cursors are rejected before querying
+        mock_query.reset_mock()
+        encode = lambda cursor: base64.urlsafe_b64encode(json.dumps(cursor).encode('utf-8')).decode('utf-8')
+        valid_key = {"request_id": "id2", "event_id": self.event_id, "expires": 1000}
+        for cursor in [[1, 2], {"since": 0, "before": 10, "shard": 1, "key": None}, {"since": 0, "before": 10, "shard": "0", "key": None},
+                       {"since": 0, "before": 10, "shard": 0, "key": ["id2"]}, {"since": 0, "before": 10, "shard": 0, "key": dict(valid_key, event_id="other")},
+                       {"since": 0, "before": 10, "shard": 0, "key": dict(valid_key, expires="1000")}, {"since": 0, "before": 10, "shard": 0, "key": dict(valid_key, extra=1)}]:
+            mock_event = {'queryStringParameters': {'event_id': self.event_id, 'cursor': encode(cursor)}}
+            response = get_list_expired_tokens.lambda_handler(mock_event, None)
+            self.assertEqual(response["statusCode"], 400)
+        mock_query.assert_not_called()
+
+        # cursors issued before a reset are not valid
+        mock_rc.get.return_value = "1"
+        mock_event = {'queryStringParameters': {'event_id': self.event_id, 'cursor': first_page["next_cursor"]}}
+        with patch.object(generations, 'GENERATION_RESET_MODE', True):
+            response = get_list_expired_tokens.lambda_handler(mock_event, None)
+        self.assertEqual(response["statusCode"], 400)
+
+    @patch.object(get_num_active_tokens.rc, 'pipeline')
+    def test_get_num_active_tokens(self, mock_pipeline):
         """
         This function tests the get_num_active_tokens lambda function
         """
         # valid event_id
+        mock_pipeline.return_value.execute.return_value = [2, 1]
         mock_event_200 = {'queryStringParameters': {'event_id': self.event_id}}
         response = get_num_active_tokens.lambda_handler(mock_event_200, None)
         self.assertEqual(response["statusCode"], 200)
         response_body = json.loads(response["body"])
         self.assertEqual(response_body["active_tokens"], 1)
+        # expired tokens are pruned and the remaining ones counted
+        current_time = mock_pipeline.return_value.zcount.call_args.args[1]
+        mock_pipeline.return_value.zremrangebyscore.assert_called_once_with("active_tokens", "-inf", f"({current_time}")
 
         # invalid event_id
         mock_event_400 = {'queryStringParameters': {'event_id': self.invalid_id}}
@@ -432,66 +1047,154 @@ class CoreApiTestCase(unittest.TestCase):
         response_body = json.loads(response["body"])
         self.assertEqual(response_body["error"], self.invalid_event_id_msg)
 
-        # query failed with an exception
-        # repatch the output of query call to return an exception
-        response = {}
-        with patch.object(get_num_active_tokens.ddb_table, 'query', side_effect=Exception):
-            with self.assertRaises(Exception):
-                get_num_active_tokens.lambda_handler(mock_event_200, None)
+        # count failed with an exception
+        mock_pipeline.return_value.execute.side_effect = Exception
+        with self.assertRaises(Exception):
+            get_num_active_tokens.lambda_handler(mock_event_200, None)
 
-        # last_evaluated_key exists 
-        mock_query.side_effect = [
-            {
-                "Items": [
-                    {"request_id": "id1"},
-                    {"request_id": "id2"},
-                ],
-                "LastEvaluatedKey": {"request_id": "id2"}
-            },
-            {
-                "Items": [{"request_id": "id3"}]
-            }
-        ]
-        mock_event = {'queryStringParameters': {'event_id': self.event_id}}
-        response = get_num_active_tokens.lambda_handler(mock_event, None)
-        self.assertEqual(
-            response['body'], 
-            json.dumps({"active_tokens": 3})
-        )
+    def test_telemetry(self):
+        """
+        This function tests the telemetry ring buffer
+        """
+        # counts are recorded in a single script call, zero counts are left out
+        mock_script = MagicMock()
+        telemetry.record_telemetry(mock_script, {"enqueued": 3, "served": 0}, 1000)
+        mock_script.assert_called_once_with(keys=["telemetry"], args=[1000, telemetry.TELEMETRY_SLOTS, "enqueued", 3])
+        mock_script.reset_mock()
+        telemetry.record_telemetry(mock_script, {"served": 0}, 1000)
+        mock_script.assert_not_called()
+        # failures do not fail the request
+        mock_script.side_effect = redis.exceptions.ConnectionError
+        telemetry.record_telemetry(mock_script, {"enqueued": 1}, 1000)
+
+        # counts recorded in the round trip of a pipeline, by script SHA
+        mock_script.reset_mock(side_effect=True)
+        mock_pipe = MagicMock()
+        mock_pipe.execute.return_value = [5, 1]
+        self.assertEqual(telemetry.execute_with_telemetry(mock_pipe, mock_script, {"enqueued": 2}, 1000), [5])
+        mock_pipe.evalsha.assert_called_once_with(mock_script.sha, 1, "telemetry", 1000, telemetry.TELEMETRY_SLOTS, "enqueued", 2)
+        mock_script.assert_not_called()
+        # the script is loaded by a separate call when Redis does not have it
+        mock_pipe.execute.return_value = [5, redis.exceptions.NoScriptError()]
+        self.assertEqual(telemetry.execute_with_telemetry(mock_pipe, mock_script, {"enqueued": 2}, 1000), [5])
+        mock_script.assert_called_once_with(keys=["telemetry"], args=[1000, telemetry.TELEMETRY_SLOTS, "enqueued", 2])
+        # telemetry failures are logged, failures of the other commands are raised
+        mock_pipe.execute.return_value = [5, redis.exceptions.ResponseError()]
+        self.assertEqual(telemetry.execute_with_telemetry(mock_pipe, mock_script, {"enqueued": 2}, 1000), [5])
+        mock_pipe.execute.return_value = [redis.exceptions.ResponseError(), 1]
+        with self.assertRaises(redis.exceptions.ResponseError):
+            telemetry.execute_with_telemetry(mock_pipe, mock_script, {"enqueued": 2}, 1000)
+
+        # buckets from a previous turn of the ring are read as 0
+        mock_rc = MagicMock()
+        slot = 998 % telemetry.TELEMETRY_SLOTS
+        buckets = {f"enqueued:{slot}": "4", f"enqueued:{slot}:t": "998", f"served:{slot + 1}": "2", f"served:{slot + 1}:t": "398"}
+        mock_rc.hmget.side_effect = lambda key, fields: [buckets.get(field) for field in fields]
+        series = telemetry.read_telemetry(mock_rc, 3, 1000)
+        self.assertEqual(mock_rc.hmget.call_count, 1)
+        self.assertEqual(series["enqueued"], [0, 4, 0])
+        self.assertEqual(series["served"], [0, 0, 0])
+
+        # rate and change of the rate
+        self.assertEqual(telemetry.summarize([1, 2, 3, 4]), {"total": 10, "rate": 2.5, "rate_change": 1.0})
+        self.assertEqual(telemetry.summarize([5]), {"total": 5, "rate": 5.0, "rate_change": 0.0})
+
+    @patch.object(get_telemetry.rc, 'hmget', side_effect=lambda key, fields: [None] * len(fields))
+    def test_get_telemetry(self, mock_hmget):
+        """
+        This function tests the get_telemetry lambda function
+        """
+        mock_event = {'queryStringParameters': {'event_id': self.event_id, 'window': '10'}}
+        response = get_telemetry.lambda_handler(mock_event, None)
+        self.assertEqual(response["statusCode"], 200)
+        response_body = json.loads(response["body"])
+        self.assertEqual(response_body["window"], 10)
+        self.assertEqual(set(response_body["metrics"]), {"enqueued", "tokens_issued", "served", "sessions_updated"})
+        self.assertEqual(response_body["metrics"]["enqueued"], {"total": 0, "rate": 0.0, "rate_change": 0.0})
+        # count and second of each bucket of each metric
+        self.assertEqual(len(mock_hmget.call_args.args[1]), 10 * 2 * 4)
+
+        # invalid window
+        for window in ['0', '601', 'abc']:
+            mock_event = {'queryStringParameters': {'event_id': self.event_id, 'window': window}}
+            response = get_telemetry.lambda_handler(mock_event, None)
+            self.assertEqual(response["statusCode"], 400)
 
-        # empty last_evaluated_key 
-        mock_query.side_effect = [
-            {
-                "Items": [
-                    {"request_id": "id1"},
-                ],
-                "LastEvaluatedKey": {"request_id": "id1"}
-            },
-            {
-                "Items": []
-            }
-        ]
-        mock_event = {'queryStringParameters': {'event_id': self.event_id}}
-        response = get_num_active_tokens.lambda_handler(mock_event, None)
-        self.assertEqual(
-            response['body'], 
-            json.dumps({"active_tokens": 1})
-        )
+        # invalid event_id
+        mock_event = {'queryStringParameters': {'event_id': self.invalid_id}}
+        response = get_telemetry.lambda_handler(mock_event, None)
+        self.assertEqual(response["statusCode"], 400)
 
-        # no last_evaluated_key 
-        mock_query.side_effect = [
-            {
-                "Items": [
-                    {"request_id": "id1"},
-                ]
-            }
-        ]
-        mock_event = {'queryStringParameters': {'event_id': self.event_id}}
-        response = get_num_active_tokens.lambda_handler(mock_event, None)
-        self.assertEqual(
-            response['body'], 
-            json.dumps({"active_tokens": 1})
-        )
+    @patch.object(reconcile_active_tokens.rc, 'get', return_value=None)
+    @patch.object(reconcile_active_tokens.rc, 'pipeline')
+    @patch.object(reconcile_active_tokens.rc, 'zadd')
+    @patch.object(reconcile_active_tokens.rc, 'zrem')
+    def test_reconcile_active_tokens(self, mock_zrem, mock_zadd, mock_pipeline, _):
+        """
+        This function tests the reconcile_active_tokens lambda function
+        """
+        current_time = int(time.time())
+        expires = current_time + 1000
+        mock_pipeline.return_value.execute.return_value = [0, 3]
+        # id1 is missing from Redis, id4 was completed but not removed, id5 was issued after the table was read
+        redis_tokens = {"id2": expires, "id3": expires, "id4": expires, "id5": current_time + self.validity_period}
+        table_tokens = [{"request_id": "id1", "expires": expires}, {"request_id": "id2", "expires": expires}, {"request_id": "id3", "expires": expires}]
+        def mock_zrangebyscore(_, expires_from, expires_before, **__):
+            return [(request_id, score) for (request_id, score) in redis_tokens.items() if expires_from <= score < int(expires_before[1:])]
+        def mock_table_query(**kwargs):
+            (expires_from, expires_to) = kwargs["KeyConditionExpression"].get_expression()["values"][1].get_expression()["values"][1:]
+            items = [item for item in table_tokens if expires_from <= item["expires"] <= expires_to]
+            # the window of id1 to id3 is read in two pages
+            if len(items) > 1 and "ExclusiveStartKey" not in kwargs:
+                return {"Items": items[:2], "LastEvaluatedKey": {"request_id": "id2"}}
+            return {"Items": items[2:] if "ExclusiveStartKey" in kwargs else items}
+        with patch.object(reconcile_active_tokens.rc, 'zrangebyscore', side_effect=mock_zrangebyscore) as mock_zrange:
+            with patch.object(reconcile_active_tokens.ddb_table, 'query', side_effect=mock_table_query) as mock_query:
+                result = reconcile_active_tokens.lambda_handler({}, None)
+                # the tokens are compared one expiry window at a time
+                windows = len(range(current_time, current_time + self.validity_period + 1, reconcile_active_tokens.RECONCILE_WINDOW_SECONDS))
+                self.assertEqual(mock_zrange.call_count, windows)
+                self.assertEqual(mock_query.call_count, windows + 1)
+        self.assertEqual(result, {"redis_count": 3, "table_count": 3, "added": 1, "removed": 1})
+        mock_zadd.assert_called_once_with("active_tokens", {"id1": expires})
+        mock_zrem.assert_called_once_with("active_tokens", "id4")
+
+    def test_token_index(self):
+        """
+        This function tests the sharded queries of the token table by expiry time
+        """
+        shard = token_index.token_index_shard(self.event_id, self.request_id, 4)
+        self.assertEqual(shard, token_index.token_index_shard(self.event_id, self.request_id, 4))
+        (event_id, shard_number) = shard.split("#")
+        self.assertEqual(event_id, self.event_id)
+        self.assertIn(int(shard_number), range(4))
+
+        ddb_table = MagicMock()
+        ddb_table.name = "token_table"
+        pages = {
+            f"{self.event_id}#0": [{"Items": [{"request_id": "id1"}], "LastEvaluatedKey": {"request_id": "id1"}}, {"Items": [{"request_id": "id2"}]}],
+            f"{self.event_id}#1": [{"Items": []}],
+            f"{self.event_id}#2": [{"Items": [{"request_id": "id3"}]}]
+        }
+        def query(**kwargs):
+            event_shard = kwargs["KeyConditionExpression"].get_expression()["values"][0].get_expression()["values"][1]
+            return pages[event_shard].pop(0)
+        ddb_table.meta.client.query = Mock(side_effect=query)
+
+        items = token_index.query_token_index(ddb_table, self.event_id, 3, Key('expires').lt(1000), ProjectionExpression="request_id")
+        self.assertEqual(sorted(item["request_id"] for item in items), ["id1", "id2", "id3"])
+        self.assertEqual(ddb_table.meta.client.query.call_count, 4)
+        for call in ddb_table.meta.client.query.call_args_list:
+            self.assertEqual(call.kwargs["TableName"], "token_table")
+            self.assertEqual(call.kwargs["IndexName"], "EventShardExpiresIndex")
+            self.assertEqual(call.kwargs["ProjectionExpression"], "request_id")
+        ddb_table.query.assert_not_called()
+
+        # unsharded tokens are read from the event partition
+        ddb_table.query.return_value = {"Items": [{"request_id": "id4"}]}
+        items = token_index.query_token_index(ddb_table, self.event_id, 0, Key('expires').lt(1000))
+        self.assertEqual(items, [{"request_id": "id4"}])
+        self.assertEqual(ddb_table.query.call_args.kwargs["IndexName"], "EventExpiresIndex")
 
     def test_get_public_key(self):
         """
@@ -504,10 +1207,11 @@ class CoreApiTestCase(unittest.TestCase):
             response = get_public_key.lambda_handler(mock_event_200, None)
             self.assertEqual(response["statusCode"], 200)
 
+    @patch.object(get_queue_num.rc, 'get', return_value=None)
     @patch.object(get_queue_num.rc, 'hget', return_value=1)
     @patch.object(get_queue_num.ddb_table_queue_position_entry_time, 'get_item', 
         return_value={'Item': {"queue_position": 1, "event_id": "abc123", "entry_time": 1002, "status": 1}})
-    def test_get_queue_num(self, mock_hget, mock_hgetall):
+    def test_get_queue_num(self, mock_hget, mock_hgetall, mock_get):
         """
         This function tests the get_queue_num lambda function
         """
@@ -530,6 +1234,12 @@ class CoreApiTestCase(unittest.TestCase):
             response = get_queue_num.lambda_handler(mock_event_202, None)
             self.assertEqual(response["statusCode"], 202)
             self.assertEqual(json.loads(response['body'])["error"], "Request ID not found")
+
+        # request_id was assigned a queue number before the reset
+        mock_get.return_value = "1"
+        with patch.object(generations, 'GENERATION_RESET_MODE', True):
+            response = get_queue_num.lambda_handler(mock_event_200, None)
+        self.assertEqual(response["statusCode"], 202)
             
 
     @patch.object(get_serving_num.rc, 'get', return_value=1)
@@ -569,28 +1279,57 @@ class CoreApiTestCase(unittest.TestCase):
             'event_id': self.event_id, 'request_id': self.request_id}}
         
         redis_cache = {'queue_counter': '2', 'token_counter': '1', 'expired_queue_counter': '1'}
-        def get(key):
-            return redis_cache[key]
-        get_waiting_num.rc = MagicMock()
-        get_waiting_num.rc.get = Mock(side_effect=get)
-
-        response = get_waiting_num.lambda_handler(mock_event_200, None)
-        self.assertEqual(response["statusCode"], 200)
-        # waiting num = queue_count - token_count - expired_queue_count
-        body = json.loads(response['body'])
-        self.assertEqual(int(body['waiting_num']), 0)
+        gap_count = 0
+        with patch.object(get_waiting_num.rc, 'pipeline') as mock_pipeline:
+            mock_pipeline.return_value.execute.side_effect = lambda: [
+                [redis_cache.get(key) for key in mock_pipeline.return_value.mget.call_args.args[0]], gap_count]
 
+            response = get_waiting_num.lambda_handler(mock_event_200, None)
+            self.assertEqual(response["statusCode"], 200)
+            # waiting num = queue_count - token_count - expired_queue_count - gap_count
+            body = json.loads(response['body'])
+            self.assertEqual(int(body['waiting_num']), 0)
+            # the counters and the gaps are read in a single round trip
+            mock_pipeline.return_value.zcard.assert_called_once_with("queue_position_gaps")
+            mock_pipeline.return_value.execute.assert_called_once()
+
+            # leased positions that were never assigned are not waiting
+            redis_cache['queue_counter'] = '12'
+            gap_count = 4
+            response = get_waiting_num.lambda_handler(mock_event_200, None)
+            self.assertEqual(int(json.loads(response['body'])['waiting_num']), 6)
+
+    @patch.object(generations, 'GENERATION_RESET_MODE', True)
+    @patch.object(increment_serving_counter.rc, 'get', return_value="3")
+    @patch.object(increment_serving_counter.rc, 'pipeline')
     @patch.object(increment_serving_counter.rc, 'incrby', return_value=1)
-    def test_increment_serving_counter(self, mock_incrby):
+    def test_increment_serving_counter(self, mock_incrby, mock_pipeline, _):
         """
         This function tests the increment_serving_counter lambda function
         """
         # event_id is valid
         mock_event_200 = {"body": json.dumps(
             {"event_id": self.event_id, "increment_by": 1})}
-        response = increment_serving_counter.lambda_handler(
-            mock_event_200, None)
-        self.assertEqual(response["statusCode"], 200)
+        with patch.object(increment_serving_counter.ddb_table, 'put_item') as mock_put_item:
+            response = increment_serving_counter.lambda_handler(
+                mock_event_200, None)
+            self.assertEqual(response["statusCode"], 200)
+            # issue time is written to the table (in the partition of the reset generation) and the index
+            self.assertEqual(mock_put_item.call_args.kwargs['Item']['event_id'], f"{self.event_id}#g3")
+            issue_time = mock_put_item.call_args.kwargs['Item']['issue_time']
+            mock_zadd = mock_pipeline.return_value.zadd
+            mock_zadd.assert_any_call("serving_counter_issue_times", {f"1:{issue_time}:0": 1})
+            # the expiry schedule is brought forward to the issue time if it is earlier, in the same round trip
+            mock_zadd.assert_any_call("queue_position_expiry_schedule", {"next": issue_time}, lt=True)
+            mock_pipeline.return_value.execute.assert_called_once()
+
+        # expired queue number leases are reaped before serving, whether queue position expiry is enabled or not
+        with patch.object(increment_serving_counter, 'reap_expired_leases') as mock_reap, \
+                patch.object(increment_serving_counter, 'QUEUE_NUMBER_LEASE_SIZE', 5), \
+                patch.object(increment_serving_counter, 'ENABLE_QUEUE_POSITION_EXPIRY', 'false'):
+            response = increment_serving_counter.lambda_handler(mock_event_200, None)
+            self.assertEqual(response["statusCode"], 200)
+            mock_reap.assert_called_once_with(increment_serving_counter.rc)
 
         # event_id is invalid
         mock_event_400 = {"body": json.dumps(
@@ -601,11 +1340,15 @@ class CoreApiTestCase(unittest.TestCase):
         body = json.loads(response['body'])
         self.assertEqual(body["error"], self.invalid_event_id_msg)
 
+    @patch.object(reset_initial_state.rc, 'mset', return_value=True)
     @patch.object(reset_initial_state.rc, 'getset', return_value=0)
     @patch.object(reset_initial_state.ddb_client, 'get_waiter', return_value=MagicMock().wait)
     @patch.object(reset_initial_state.rc, 'set', return_value=0)
     @patch.object(reset_initial_state, 'create_cloudfront_invalidation')
-    def test_reset_initial_state(self, mock_cfn_invalidation, mock_rc_set, mock_waiter, mock_rc_getset):
+    @patch.object(reset_initial_state.rc, 'delete', return_value=1)
+    @patch.object(reset_initial_state.rc, 'scan_iter', side_effect=lambda match, count: iter([match.replace("*", "1")]))
+    @patch.object(reset_initial_state.rc, 'unlink', return_value=1)
+    def test_reset_initial_state(self, mock_unlink, mock_scan_iter, mock_delete, mock_cfn_invalidation, mock_rc_set, mock_waiter, mock_rc_getset, mock_rc_mset):
         """
         This function tests the reset_initial_state lambda function
         """
@@ -615,6 +1358,21 @@ class CoreApiTestCase(unittest.TestCase):
 
         # Assert invalidation for all paths
         mock_cfn_invalidation.assert_called_once_with(paths=["/*"])
+        # counters are reset in a single write
+        mock_rc_mset.assert_called_once()
+        self.assertEqual(set(mock_rc_mset.call_args.args[0].values()), {0})
+        # staged queue positions are dropped
+        mock_delete.assert_any_call("pending_queue_positions", "failed_queue_positions")
+        mock_unlink.assert_any_call("queue_position:1")
+        # queue number leases and gaps are dropped
+        mock_delete.assert_any_call("queue_number_leases")
+        mock_unlink.assert_any_call("queue_number_lease:1")
+        # queue number assignments are dropped
+        mock_unlink.assert_any_call("assigned_queue_num:1")
+        # the recreated tables start over at generation 0
+        mock_delete.assert_any_call("reset_generation", "purged_generation")
+        # gaps, serving counter issue time index, active tokens and telemetry are dropped
+        mock_delete.assert_any_call("queue_position_gaps", "queue_position_entry_times", "serving_counter_issue_times", "queue_position_expiry_schedule", "active_tokens", "telemetry")
         self.assertEqual(response["statusCode"], 200)
 
         # invalid event_id
@@ -622,6 +1380,115 @@ class CoreApiTestCase(unittest.TestCase):
         response = reset_initial_state.lambda_handler(mock_event_400, None)
         self.assertEqual(response["statusCode"], 400)
 
+    @patch.object(reset_initial_state, 'RESET_MODE', 'generation')
+    @patch.object(reset_initial_state.rc, 'mset', return_value=True)
+    @patch.object(reset_initial_state.rc, 'getset', return_value=0)
+    @patch.object(reset_initial_state.rc, 'set', return_value=0)
+    @patch.object(reset_initial_state.rc, 'incr', return_value=2)
+    @patch.object(reset_initial_state.rc, 'delete', return_value=1)
+    @patch.object(reset_initial_state.rc, 'zrange', side_effect=lambda key, start, end: ["1"])
+    @patch.object(reset_initial_state.rc, 'unlink', return_value=1)
+    @patch.object(reset_initial_state.rc, 'scan_iter')
+    @patch.object(reset_initial_state, 'create_cloudfront_invalidation')
+    @patch.object(reset_initial_state, 'recreate_tables')
+    @patch.object(reset_initial_state.lambda_client, 'invoke')
+    def test_reset_initial_state_generation(self, mock_invoke, mock_recreate_tables, mock_cfn_invalidation, mock_scan_iter, mock_unlink, mock_zrange, mock_delete, mock_incr, *_):
+        """
+        This function tests the reset_initial_state lambda function in generation mode
+        """
+        response = reset_initial_state.lambda_handler({"event_id": self.event_id}, None)
+        self.assertEqual(response["statusCode"], 200)
+
+        # a new generation is started instead of recreating the tables
+        mock_incr.assert_called_once_with("reset_generation")
+        mock_recreate_tables.assert_not_called()
+        mock_cfn_invalidation.assert_called_once_with(paths=["/*"])
+        # pending queue positions and leases are dropped without scanning the keyspace
+        mock_scan_iter.assert_not_called()
+        mock_unlink.assert_any_call("queue_position:1")
+        mock_unlink.assert_any_call("queue_number_lease:1")
+        mock_delete.assert_any_call("pending_queue_positions", "failed_queue_positions")
+        mock_delete.assert_any_call("queue_number_leases")
+        # previous generations are purged in the background
+        mock_invoke.assert_called_once_with(FunctionName="purge_generations", InvocationType='Event', Payload=json.dumps({}))
+
+    @patch.object(purge_generations.rc, 'set')
+    @patch.object(purge_generations.rc, 'mget')
+    @patch.object(purge_generations.lambda_client, 'invoke')
+    @patch.object(purge_generations.ddb_resource, 'batch_write_item', return_value={"UnprocessedItems": {}})
+    @patch.object(purge_generations.ddb_table_queue_position_entry_time, 'scan')
+    @patch.object(purge_generations.ddb_table_serving_counter_issued_at, 'query')
+    @patch.object(purge_generations.ddb_table_tokens, 'query')
+    def test_purge_generations(self, mock_token_query, mock_serving_query, mock_scan, mock_batch_write, mock_invoke, mock_mget, mock_set):
+        """
+        This function tests the purge_generations lambda function
+        """
+        counters = {"reset_generation": "2", "purged_generation": None}
+        mock_mget.side_effect = lambda *keys: [counters.get(key) for key in keys]
+        mock_token_query.side_effect = lambda **kwargs: {"Items": [{"request_id": "r1"}]}
+        mock_serving_query.side_effect = lambda **kwargs: {"Items": [{"event_id": "e", "serving_counter": 1}]}
+        mock_scan.side_effect = [
+            {"Items": [{"request_id": "q1"}], "LastEvaluatedKey": {"request_id": "q1"}},
+            {"Items": [{"request_id": "q2"}]}
+        ]
+        context = MagicMock(function_name="purge_generations")
+        context.get_remaining_time_in_millis.return_value = 600000
+
+        purge_generations.lambda_handler({}, context)
+        # partitions of generations 0 and 1 are purged
+        token_partitions = [call.kwargs["KeyConditionExpression"].get_expression()["values"][1] for call in mock_token_query.call_args_list]
+        self.assertEqual(token_partitions, [self.event_id, f"{self.event_id}#g1"])
+        self.assertEqual(mock_token_query.call_args.kwargs["IndexName"], "EventExpiresIndex")
+        self.assertEqual(mock_serving_query.call_count, 2)
+        # queue position items of previous generations are scanned page by page
+        self.assertEqual(mock_scan.call_args.kwargs["ExclusiveStartKey"], {"request_id": "q1"})
+        self.assertEqual(mock_batch_write.call_count, 6)
+        mock_set.assert_called_once_with("purged_generation", 2)
+        mock_invoke.assert_not_called()
+
+        # the scan continues in a new invocation before the function times out
+        mock_set.reset_mock()
+        mock_scan.side_effect = [{"Items": [{"request_id": "q3"}], "LastEvaluatedKey": {"request_id": "q3"}}]
+        context.get_remaining_time_in_millis.return_value = 1000
+        purge_generations.lambda_handler({"scan_start_key": {"request_id": "q2"}, "failed": 0}, context)
+        self.assertEqual(mock_scan.call_args.kwargs["ExclusiveStartKey"], {"request_id": "q2"})
+        mock_invoke.assert_called_once_with(
+            FunctionName="purge_generations", InvocationType='Event',
+            Payload=json.dumps({"scan_start_key": {"request_id": "q3"}, "failed": 0})
+        )
+        mock_set.assert_not_called()
+
+        # a partition continues in a new invocation before the function times out
+        mock_invoke.reset_mock()
+        mock_scan.reset_mock()
+        mock_token_query.reset_mock()
+        last_key = {"request_id": "r2", "event_id": f"{self.event_id}#g1", "expires": Decimal(1000)}
+        mock_token_query.side_effect = lambda **kwargs: {"Items": [{"request_id": "r2"}], "LastEvaluatedKey": last_key}
+        purge_generations.lambda_handler({"partition": [1, 0, dict(last_key, request_id="r1", expires=900)], "failed": 0}, context)
+        self.assertEqual(mock_token_query.call_args.kwargs["ExclusiveStartKey"], dict(last_key, request_id="r1", expires=900))
+        mock_invoke.assert_called_once_with(
+            FunctionName="purge_generations", InvocationType='Event',
+            Payload=json.dumps({"partition": [1, 0, dict(last_key, expires=1000)], "failed": 0})
+        )
+        mock_scan.assert_not_called()
+
+        # the invocation continues from the partition it was given, then scans the queue positions
+        mock_token_query.reset_mock()
+        mock_serving_query.reset_mock()
+        context.get_remaining_time_in_millis.return_value = 600000
+        mock_scan.side_effect = [{"Items": []}]
+        purge_generations.lambda_handler({"partition": [1, 1, {"event_id": f"{self.event_id}#g1", "serving_counter": 5}], "failed": 0}, context)
+        mock_token_query.assert_not_called()
+        self.assertEqual(mock_serving_query.call_args.kwargs["ExclusiveStartKey"], {"event_id": f"{self.event_id}#g1", "serving_counter": 5})
+        mock_scan.assert_called_once()
+        mock_set.assert_called_once_with("purged_generation", 2)
+
+        # nothing to purge
+        counters["purged_generation"] = "2"
+        mock_scan.reset_mock()
+        purge_generations.lambda_handler({}, context)
+        mock_scan.assert_not_called()
+
     def test_reset_initial_state_create_cloudfront_invalidation(self):
         # Arrange
         invalidation_paths = ["/*"]
@@ -638,19 +1505,30 @@ class CoreApiTestCase(unittest.TestCase):
             }
             assert mock_client.create_invalidation.call_args.kwargs['InvalidationBatch']['CallerReference'] is not None
 
-    @patch.object(update_session.rc, 'incr', return_value=1)
+    @patch.object(update_session.rc, 'get', return_value=None)
+    @patch.object(update_session.rc, 'pipeline')
     @patch.object(update_session.ddb_table, 'update_item',
                   return_value={"Items": [{"request_id": "fe7a5f04-6ff0-4bd6-9c31-52088cc4e73a"}]})
     @patch.object(update_session.events_client, 'put_events',
                   return_value={'ResponseMetadata': {'FailedEntryCount': 0, "Entries": [{"EventId": "11710aed-b79e-4468-a20b-bb3c0c3b4860"}]}})
-    def test_update_session(self, mock_rcincr, mock_update, mock_put_events):
+    def test_update_session(self, mock_put_events, mock_update, mock_pipeline, _):
         """
         This function tests the update_session lambda function
         """
         # valid event_id
+        # delete, hset and expire of the cached tokens, zrem, incr and the telemetry
+        mock_pipeline.return_value.execute.return_value = [1, 1, 1, 1, 1, 1]
         mock_event_200 = {"body": json.dumps({"event_id": self.event_id, "request_id": self.request_id, "status": 1})}
         response = update_session.lambda_handler(mock_event_200, None)
         self.assertEqual(response["statusCode"], 200)
+        # cached tokens are replaced by the session status
+        mock_pipeline.return_value.delete.assert_called_once_with(f"token_cache:{self.request_id}")
+        mock_pipeline.return_value.hset.assert_called_once_with(f"token_cache:{self.request_id}", mapping={"session_status": 1, "generation": 0})
+        # session is no longer active and is counted as completed, in the same round trip as the telemetry
+        mock_pipeline.return_value.zrem.assert_called_once_with("active_tokens", self.request_id)
+        mock_pipeline.return_value.incr.assert_called_once_with("completed_counter", 1)
+        mock_pipeline.return_value.evalsha.assert_called_once()
+        mock_pipeline.return_value.execute.assert_called_once_with(raise_on_error=False)
 
         # invalid event_id
         mock_event_400 = {"body": json.dumps({"event_id": self.invalid_id, "request_id": self.request_id, "status": 1})}
@@ -679,6 +1557,66 @@ class CoreApiTestCase(unittest.TestCase):
                     update_session.lambda_handler(mock_event_200, None)
 
 
+    @patch.object(update_session.rc, 'get', return_value=None)
+    @patch.object(update_session.rc, 'pipeline')
+    @patch.object(update_session.events_client, 'put_events', return_value={'FailedEntryCount': 0, 'Entries': []})
+    def test_update_sessions_batch(self, mock_put_events, mock_pipeline, _):
+        """
+        This function tests the batch update of the update_session lambda function
+        """
+        completed_id = "11111111-3bdd-4c36-aaed-323cb4c37262"
+        abandoned_id = "22222222-3bdd-4c36-aaed-323cb4c37262"
+        missing_id = "33333333-3bdd-4c36-aaed-323cb4c37262"
+        unreachable_id = "44444444-3bdd-4c36-aaed-323cb4c37262"
+        sessions = [
+            {"request_id": completed_id, "status": 1},
+            {"request_id": abandoned_id, "status": -1},
+            {"request_id": missing_id, "status": 1},
+            {"request_id": unreachable_id, "status": -1},
+            {"request_id": "not-a-request-id", "status": 1},
+            {"request_id": self.request_id, "status": 5}
+        ]
+        def update_item(**kwargs):
+            self.assertEqual(kwargs["TableName"], update_session.ddb_table.name)
+            if kwargs["Key"]["request_id"] == missing_id:
+                raise ClientError({"Error": {"Code": "ConditionalCheckFailedException", "Message": "failed"}}, "UpdateItem")
+            if kwargs["Key"]["request_id"] == unreachable_id:
+                raise EndpointConnectionError(endpoint_url="https://dynamodb.us-east-1.amazonaws.com")
+            return {}
+        # cached tokens of both sessions, zrem, both incrby and the telemetry
+        mock_pipeline.return_value.execute.return_value = [1] * 10
+        with patch.object(update_session.ddb_table.meta.client, 'update_item', side_effect=update_item) as mock_update:
+            mock_event = {"body": json.dumps({"event_id": self.event_id, "sessions": sessions})}
+            response = update_session.lambda_handler(mock_event, None)
+            self.assertEqual(mock_update.call_count, 4)
+        self.assertEqual(response["statusCode"], 200)
+        # a failure other than the condition check is reported for that session only
+        self.assertEqual(json.loads(response["body"])["results"], [
+            {"request_id": completed_id, "result": "updated"},
+            {"request_id": abandoned_id, "result": "updated"},
+            {"request_id": missing_id, "result": "not_found"},
+            {"request_id": unreachable_id, "result": "error"},
+            {"request_id": "not-a-request-id", "result": "invalid"},
+            {"request_id": self.request_id, "result": "invalid"}
+        ])
+        # one increment per counter, one command for the active tokens, all in one round trip, and one batch of events
+        mock_pipe = mock_pipeline.return_value
+        mock_pipe.incrby.assert_any_call("completed_counter", 1)
+        mock_pipe.incrby.assert_any_call("abandoned_counter", 1)
+        self.assertEqual(mock_pipe.incrby.call_count, 2)
+        mock_pipe.zrem.assert_called_once_with("active_tokens", completed_id, abandoned_id)
+        mock_pipe.hset.assert_any_call(f"token_cache:{abandoned_id}", mapping={"session_status": -1, "generation": 0})
+        self.assertEqual(mock_pipe.evalsha.call_args.args[-2:], ("sessions_updated", 2))
+        mock_pipe.execute.assert_called_once_with(raise_on_error=False)
+        mock_put_events.assert_called_once()
+        self.assertEqual(len(mock_put_events.call_args.kwargs["Entries"]), 2)
+
+        # invalid event_id or too many sessions
+        for body in [{"event_id": self.invalid_id, "sessions": sessions},
+                     {"event_id": self.event_id, "sessions": sessions * 101}]:
+            response = update_session.lambda_handler({"body": json.dumps(body)}, None)
+            self.assertEqual(response["statusCode"], 400)
+
     @patch.object(get_queue_position_expiry_time.ddb_table_queue_position_entry_time, 'get_item', 
         return_value={'Item': {"queue_position": 2, "event_id": "abc123", "entry_time": 1002, "status": 1}})
     def test_get_queue_position_expiry_time(self, mock_table):
@@ -686,11 +1624,9 @@ class CoreApiTestCase(unittest.TestCase):
         This function tests the get_queue_position_expiry_time lambda function
         """
         redis_cache = {'max_queue_position_expired': '3', 'serving_counter': '5', 'queue_position_expiry_time': '200' }
-        def get(key):
-            return redis_cache[key]
-
         get_queue_position_expiry_time.rc = MagicMock()
-        get_queue_position_expiry_time.rc.get = Mock(side_effect=get)
+        get_queue_position_expiry_time.rc.mget = Mock(side_effect=lambda keys: [redis_cache.get(key) for key in keys])
+        get_queue_position_expiry_time.rc.zrangebyscore = Mock(return_value=[])
 
         # event_id is invalid
         mock_event_400 = {'queryStringParameters': {'event_id': self.invalid_id, 'request_id': self.request_id}}
@@ -723,7 +1659,7 @@ class CoreApiTestCase(unittest.TestCase):
         redis_cache['max_queue_position_expired'] = '1'
         with patch.object(get_queue_position_expiry_time.ddb_table_queue_position_entry_time, 'query', 
             return_value={'Items': [{"queue_position": 2, "event_id": "abc123", "entry_time": 1002, "status": 1}]}):
-            with patch.object(get_queue_position_expiry_time.ddb_table_serving_counter_issued_at, 'query', return_value= { 'Items': [{'issue_time': 1000}] }):
+            with patch.object(get_queue_position_expiry_time.ddb_table_serving_counter_issued_at, 'query', return_value= { 'Items': [{'serving_counter': 5, 'issue_time': 1000}] }):
                 mock_event = {'queryStringParameters': {'event_id': self.event_id, 'request_id': self.request_id}}
                 response = get_queue_position_expiry_time.lambda_handler(mock_event, None)
                 self.assertEqual(response["statusCode"], 410)
@@ -733,7 +1669,7 @@ class CoreApiTestCase(unittest.TestCase):
         redis_cache['max_queue_position_expired'] = '1'
         with patch.object(get_queue_position_expiry_time.ddb_table_queue_position_entry_time, 'query', 
             return_value={'Items': [{"queue_position": 2, "event_id": "abc123", "entry_time": 1002, "status": 1}]}):
-            with patch.object(get_queue_position_expiry_time.ddb_table_serving_counter_issued_at, 'query', return_value= { 'Items': [{'issue_time': int(time.time()) - 10}] }):
+            with patch.object(get_queue_position_expiry_time.ddb_table_serving_counter_issued_at, 'query', return_value= { 'Items': [{'serving_counter': 5, 'issue_time': int(time.time()) - 10}] }):
                 mock_event = {'queryStringParameters': {'event_id': self.event_id, 'request_id': self.request_id}}
                 response = get_queue_position_expiry_time.lambda_handler(mock_event, None)
                 self.assertEqual(response["statusCode"], 200)
@@ -751,9 +1687,6 @@ class CoreApiTestCase(unittest.TestCase):
         This function tests the get_queue_position_expiry_time lambda function
         """
         mock_redis_cache = {'max_queue_position_expired': '0', 'serving_counter': '0', 'expired_queue_counter': '0' }
-        def mock_get(key):
-            return mock_redis_cache[key]
-
         def mock_set(key, value):
             if mock_redis_cache:
                 mock_redis_cache[key] = value
@@ -768,9 +1701,23 @@ class CoreApiTestCase(unittest.TestCase):
             return None
 
         set_max_queue_position_expired.rc = MagicMock()
-        set_max_queue_position_expired.rc.get = Mock(side_effect=mock_get)
+        set_max_queue_position_expired.rc.mget = Mock(side_effect=lambda keys: [mock_redis_cache.get(key) for key in keys])
         set_max_queue_position_expired.rc.set = Mock(side_effect=mock_set)
         set_max_queue_position_expired.rc.incrby = Mock(side_effect=mock_incr)
+        set_max_queue_position_expired.rc.zscore = Mock(return_value=None)
+        set_max_queue_position_expired.rc.zcount = Mock(return_value=0)
+        set_max_queue_position_expired.rc.zrangebyscore = Mock(return_value=[])
+        # pipelined commands are answered by the mocked Redis methods
+        def mock_pipeline(**_):
+            pipe = MagicMock()
+            results = []
+            pipe.zrangebyscore = Mock(side_effect=lambda *args, **kwargs: results.append(set_max_queue_position_expired.rc.zrangebyscore(*args, **kwargs)))
+            pipe.zscore = Mock(side_effect=lambda *args: results.append(set_max_queue_position_expired.rc.zscore(*args)))
+            pipe.zcount = Mock(side_effect=lambda *args: results.append(set_max_queue_position_expired.rc.zcount(*args)))
+            pipe.execute = Mock(side_effect=lambda: list(results))
+            return pipe
+        set_max_queue_position_expired.rc.pipeline = Mock(side_effect=mock_pipeline)
+        entry_time_client = set_max_queue_position_expired.ddb_table_queue_position_entry_time.meta.client
 
         mock_event = {'id': '3475893474', 'detail-type': 'Scheduled Event', 'source': 'aws.events', 'account': 'dummy123' }
 
@@ -782,7 +1729,7 @@ class CoreApiTestCase(unittest.TestCase):
         mock_redis_cache['reset_in_progress'] = 0
 
         # no queue positions eligible
-        with patch.object(set_max_queue_position_expired.ddb_table_queue_position_entry_time, 'query', return_value={'Items': [] }):
+        with patch.object(entry_time_client, 'query', return_value={'Items': [] }):
             with patch('builtins.print') as mocked_print:
                 mock_redis_cache['queue_counter'] = 6
                 set_max_queue_position_expired.lambda_handler(mock_event, None)
@@ -797,15 +1744,97 @@ class CoreApiTestCase(unittest.TestCase):
         #         mock_method.assert_not_called()
 
         # set max queue position expired (with svc increment)
-        with patch.object(set_max_queue_position_expired.ddb_table_queue_position_entry_time, 'query', 
-            return_value={'Items': [{"queue_position": 12, "event_id": "abc123", "entry_time": int(time.time()) - 150, "status": 1}] }):
+        with patch.object(entry_time_client, 'query', 
+            return_value={'Items': [{"entry_time": int(time.time()) - 150}] }) as mock_query:
             with patch.object(set_max_queue_position_expired.ddb_table_serving_counter_issued_at, 'put_item', return_value=None) as mock_svc_table:
-                with patch.object(set_max_queue_position_expired.events_client, 'put_events', return_value=None) as mock_events_client:
+                with patch.object(set_max_queue_position_expired.events_client, 'put_events', return_value={'FailedEntryCount': 0, 'Entries': []}) as mock_events_client:
                     set_max_queue_position_expired.lambda_handler(mock_event, None)
                     self.assertEqual(mock_redis_cache['max_queue_position_expired'], 25)
                     self.assertEqual(mock_redis_cache['serving_counter'], 2 + 4)      
-                    mock_events_client.assert_called()
-                    mock_svc_table.assert_called()  
+                    # serving counter increments are aggregated and sent in a single batch
+                    mock_events_client.assert_called_once()
+                    mock_svc_table.assert_called_once()
+                    self.assertEqual(sorted(call.kwargs["KeyConditionExpression"].get_expression()["values"][1]
+                                            for call in mock_query.call_args_list), [10, 25])
+
+        # leased positions that were never assigned expire with the serving counter and are not counted as expired
+        mock_redis_cache.update({'max_queue_position_expired': '0', 'serving_counter': '0', 'expired_queue_counter': '0'})
+        set_max_queue_position_expired.rc.zscore = Mock(return_value=10)
+        set_max_queue_position_expired.rc.zcount = Mock(return_value=2)
+        with patch.object(entry_time_client, 'query') as mock_query:
+            with patch.object(set_max_queue_position_expired.ddb_table_serving_counter_issued_at, 'put_item', return_value=None):
+                with patch.object(set_max_queue_position_expired.events_client, 'put_events', return_value={'FailedEntryCount': 0, 'Entries': []}):
+                    set_max_queue_position_expired.lambda_handler(mock_event, None)
+                    mock_query.assert_not_called()
+                    self.assertEqual(mock_redis_cache['max_queue_position_expired'], 25)
+                    self.assertEqual(mock_redis_cache['serving_counter'], 2 + 4)
+                    self.assertEqual(mock_redis_cache['expired_queue_counter'], 0 + 2)
+
+        # serving counter items are read across pages and evaluation stops at the first position not expired
+        mock_redis_cache.update({'max_queue_position_expired': '0', 'serving_counter': '0', 'expired_queue_counter': '0'})
+        set_max_queue_position_expired.rc.zscore = Mock(return_value=None)
+        set_max_queue_position_expired.rc.zcount = Mock(return_value=0)
+        now = int(time.time())
+        mock_table.side_effect = [
+            {'Items': [{'serving_counter': 10, 'queue_positions_served': 8, 'issue_time': now - 1000}], 'LastEvaluatedKey': {'serving_counter': 10}},
+            {'Items': [{'serving_counter': 25, 'queue_positions_served': 11, 'issue_time': now - 500},
+                       {'serving_counter': 40, 'queue_positions_served': 0, 'issue_time': now - 400}]}
+        ]
+        def query_entry_time(**kwargs):
+            position = kwargs["KeyConditionExpression"].get_expression()["values"][1]
+            return {'Items': [{"entry_time": now - 50 if position == 40 else now - 150}]}
+        with patch.object(entry_time_client, 'query', side_effect=query_entry_time):
+            with patch.object(set_max_queue_position_expired.ddb_table_serving_counter_issued_at, 'put_item', return_value=None):
+                with patch.object(set_max_queue_position_expired.events_client, 'put_events', return_value={'FailedEntryCount': 0, 'Entries': []}):
+                    set_max_queue_position_expired.lambda_handler(mock_event, None)
+                    self.assertEqual(mock_table.call_args.kwargs['ExclusiveStartKey'], {'serving_counter': 10})
+                    self.assertEqual(mock_redis_cache['max_queue_position_expired'], 25)
+                    self.assertEqual(mock_redis_cache['serving_counter'], 2 + 4)
+                    # the next run is due when the position of serving counter item 40 expires
+                    set_max_queue_position_expired.rc.zadd.assert_called_with("queue_position_expiry_schedule", {"next": now - 50})
+
+        # no evaluation until the next serving counter item is due
+        mock_table.reset_mock()
+        set_max_queue_position_expired.rc.zscore = Mock(return_value=float(now - 50))
+        set_max_queue_position_expired.lambda_handler(mock_event, None)
+        mock_table.assert_not_called()
+
+        # staged and failed queue positions of the write-behind store are evaluated without their dynamodb items
+        mock_redis_cache.update({'max_queue_position_expired': '0', 'serving_counter': '0', 'expired_queue_counter': '0'})
+        set_max_queue_position_expired.rc.zscore = Mock(return_value=None)
+        mock_table.side_effect = None
+        mock_table.return_value = {'Items': [{'serving_counter': 10, 'queue_positions_served': 8, 'issue_time': now - 1000},
+                                             {'serving_counter': 25, 'queue_positions_served': 11, 'issue_time': now - 500}]}
+        def mock_zrangebyscore(key, *_, **__):
+            # the entry time of another reset generation is ignored
+            if key == "queue_position_entry_times":
+                return [f"10:{now - 150}:0", f"25:{now - 50}:1"]
+            return [("request-25", 25.0)]
+        set_max_queue_position_expired.rc.zrangebyscore = Mock(side_effect=mock_zrangebyscore)
+        with patch.object(entry_time_client, 'query') as mock_query:
+            with patch.object(set_max_queue_position_expired.ddb_table_serving_counter_issued_at, 'put_item', return_value=None):
+                with patch.object(set_max_queue_position_expired.events_client, 'put_events', return_value={'FailedEntryCount': 0, 'Entries': []}):
+                    set_max_queue_position_expired.lambda_handler(mock_event, None)
+                    mock_query.assert_not_called()
+                    self.assertEqual(mock_redis_cache['max_queue_position_expired'], 25)
+                    self.assertEqual(mock_redis_cache['serving_counter'], 2 + 4)
+                    self.assertEqual(mock_redis_cache['expired_queue_counter'], 2 + 4)
+                    set_max_queue_position_expired.rc.zremrangebyscore.assert_any_call("queue_position_entry_times", "-inf", 25)
+
+        # the entry times of a batch are read from the index in one lookup, only the missing positions are queried
+        mock_redis_cache.update({'max_queue_position_expired': '0', 'serving_counter': '0', 'expired_queue_counter': '0'})
+        mock_table.return_value = {'Items': [{'serving_counter': position, 'queue_positions_served': 0, 'issue_time': now - 1000}
+                                             for position in range(10, 60, 10)]}
+        set_max_queue_position_expired.rc.zrangebyscore = Mock(side_effect=lambda key, *_, **__:
+            [f"{position}:{now - 150}:0" for position in (10, 20, 40, 50)] if key == "queue_position_entry_times" else [])
+        with patch.object(entry_time_client, 'query', return_value={'Items': [{"entry_time": now - 150}]}) as mock_query:
+            with patch.object(set_max_queue_position_expired.ddb_table_serving_counter_issued_at, 'put_item', return_value=None):
+                with patch.object(set_max_queue_position_expired.events_client, 'put_events', return_value={'FailedEntryCount': 0, 'Entries': []}):
+                    set_max_queue_position_expired.lambda_handler(mock_event, None)
+                    self.assertEqual(mock_redis_cache['max_queue_position_expired'], 50)
+                    mock_query.assert_called_once()
+                    self.assertEqual(mock_query.call_args.kwargs["KeyConditionExpression"].get_expression()["values"][1], 30)
+                    set_max_queue_position_expired.rc.zrangebyscore.assert_any_call("queue_position_entry_times", 10, 50)
         
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,152 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: Apache-2.0
+
+"""
+This module is invoked by reset_initial_state when the waiting room is reset in generation mode.
+It deletes the DynamoDB items of previous reset generations: the token and serving counter items
+partitioned by the event ID of a previous generation, and the queue position items tagged with one.
+When the invocation is about to time out, it invokes itself again to continue from the partition
+or the queue position scan page it has reached.
+"""
+
+import os
+import json
+import boto3
+import redis
+from botocore import config
+from boto3.dynamodb.conditions import Attr, Key
+from counters import PURGED_GENERATION, RESET_GENERATION
+from bulk_write import batch_delete_items
+from generations import GENERATION_ATTRIBUTE, generation_event_id
+from token_index import EVENT_EXPIRES_INDEX
+
+# connection info and other globals
+SOLUTION_ID = os.environ['SOLUTION_ID']
+REDIS_HOST = os.environ["REDIS_HOST"]
+REDIS_PORT = os.environ["REDIS_PORT"]
+SECRET_NAME_PREFIX = os.environ["STACK_NAME"]
+EVENT_ID = os.environ["EVENT_ID"]
+TOKEN_TABLE = os.environ["TOKEN_TABLE"]
+QUEUE_POSITION_ENTRYTIME_TABLE = os.environ["QUEUE_POSITION_ENTRYTIME_TABLE"]
+SERVING_COUNTER_ISSUEDAT_TABLE = os.environ["SERVING_COUNTER_ISSUEDAT_TABLE"]
+
+# continue in a new invocation when less than this many milliseconds are left in the invocation
+PURGE_TIME_MARGIN_MS = 30000
+
+boto_session = boto3.session.Session()
+region = boto_session.region_name
+user_agent_extra = {"user_agent_extra": SOLUTION_ID}
+user_config = config.Config(**user_agent_extra)
+secrets_client = boto3.client('secretsmanager', config=user_config, endpoint_url=f"https://secretsmanager.{region}.amazonaws.com")
+response = secrets_client.get_secret_value(SecretId=f"{SECRET_NAME_PREFIX}/redis-auth")
+redis_auth = response.get("SecretString")
+rc = redis.Redis(host=REDIS_HOST, port=REDIS_PORT, ssl=True, decode_responses=True, password=redis_auth)
+ddb_resource = boto3.resource('dynamodb', endpoint_url=f'https://dynamodb.{region}.amazonaws.com', config=user_config)
+ddb_table_tokens = ddb_resource.Table(TOKEN_TABLE)
+ddb_table_queue_position_entry_time = ddb_resource.Table(QUEUE_POSITION_ENTRYTIME_TABLE)
+ddb_table_serving_counter_issued_at = ddb_resource.Table(SERVING_COUNTER_ISSUEDAT_TABLE)
+lambda_client = boto3.client('lambda', endpoint_url=f"https://lambda.{region}.amazonaws.com", config=user_config)
+
+
+def lambda_handler(event, context):
+    """
+    This function is the entry handler for Lambda.
+    """
+    print(event)
+    (generation, purged_generation) = [int(value or 0) for value in rc.mget(RESET_GENERATION, PURGED_GENERATION)]
+    if purged_generation >= generation:
+        print(f"No previous generations to purge. Generation: {generation}")
+        return
+
+    # items that could not be deleted are purged again on the next run
+    failed = event.get('failed', 0)
+    scan_start_key = event.get('scan_start_key')
+    if scan_start_key is None:
+        # the partitions are purged first, an invocation may continue from a partition of a generation
+        (first_generation, first_partition, start_key) = event.get('partition', [purged_generation, 0, None])
+        for previous_generation in range(first_generation, generation):
+            partitions = generation_partitions(previous_generation)
+            for index in range(first_partition if previous_generation == first_generation else 0, len(partitions)):
+                (ddb_table, key_condition, key_attributes, query_args) = partitions[index]
+                (partition_failed, start_key) = purge_partition(ddb_table, key_condition, key_attributes, context, start_key, **query_args)
+                failed += partition_failed
+                if start_key:
+                    continue_purge(context, {'partition': [previous_generation, index, start_key], 'failed': failed})
+                    print(f"Purge of generation {previous_generation} continues from {start_key} in a new invocation")
+                    return
+            print(f"Token and serving counter items of generation {previous_generation} purged")
+
+    scan_args = {
+        "FilterExpression": Attr(GENERATION_ATTRIBUTE).not_exists() | Attr(GENERATION_ATTRIBUTE).lt(generation),
+        "ProjectionExpression": "request_id"
+    }
+    while True:
+        if scan_start_key:
+            scan_args["ExclusiveStartKey"] = scan_start_key
+        response = ddb_table_queue_position_entry_time.scan(**scan_args)
+        failed += delete_items(ddb_table_queue_position_entry_time, response['Items'], ['request_id'])
+        scan_start_key = response.get('LastEvaluatedKey')
+        if not scan_start_key:
+            break
+        if context.get_remaining_time_in_millis() < PURGE_TIME_MARGIN_MS:
+            continue_purge(context, {'scan_start_key': scan_start_key, 'failed': failed})
+            print(f"Queue position scan continues from {scan_start_key} in a new invocation")
+            return
+
+    if failed:
+        print(f"{failed} items of generations {purged_generation} to {generation - 1} not purged")
+        return
+    rc.set(PURGED_GENERATION, generation)
+    print(f"Generations {purged_generation} to {generation - 1} purged")
+
+
+def generation_partitions(generation) -> list:
+    """
+    Returns the (table, key condition, key attributes, query arguments) of the partitions of a reset generation
+    """
+    event_key = generation_event_id(EVENT_ID, generation)
+    return [
+        (ddb_table_tokens, Key('event_id').eq(event_key), ['request_id'], {"IndexName": EVENT_EXPIRES_INDEX}),
+        (ddb_table_serving_counter_issued_at, Key('event_id').eq(event_key), ['event_id', 'serving_counter'], {})
+    ]
+
+
+def purge_partition(ddb_table, key_condition, key_attributes, context, start_key=None, **query_args) -> tuple:
+    """
+    Delete the items of a partition (of the table or one of its indexes) page by page, starting after start_key.
+    Returns the number of items that could not be deleted, and the key to continue from
+    if the invocation is about to time out (None once the partition is purged).
+    """
+    query_args.update({
+        "KeyConditionExpression": key_condition,
+        "ProjectionExpression": ", ".join(key_attributes)
+    })
+    failed = 0
+    while True:
+        if start_key:
+            query_args["ExclusiveStartKey"] = start_key
+        response = ddb_table.query(**query_args)
+        failed += delete_items(ddb_table, response['Items'], key_attributes)
+        start_key = response.get('LastEvaluatedKey')
+        if not start_key or context.get_remaining_time_in_millis() < PURGE_TIME_MARGIN_MS:
+            return (failed, start_key)
+
+
+def continue_purge(context, payload) -> None:
+    """
+    Invoke the function again with the position to continue the purge from
+    """
+    lambda_client.invoke(
+        FunctionName=context.function_name,
+        InvocationType='Event',
+        # key values read from DynamoDB are Decimal, the key attributes are strings or integers
+        Payload=json.dumps(payload, default=int)
+    )
+
+
+def delete_items(ddb_table, items, key_attributes) -> int:
+    """
+    Delete the items by their key attributes. Returns the number of items that could not be deleted.
+    """
+    keys = [{attribute: item[attribute] for attribute in key_attributes} for item in items]
+    return len(batch_delete_items(ddb_resource, ddb_table.name, keys))
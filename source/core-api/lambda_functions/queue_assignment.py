@@ -0,0 +1,120 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: Apache-2.0
+
+"""
+This module provides the queue number assignment shared by assign_queue_num and enqueue_request.
+Queue numbers are reserved in redis once per request ID and the resulting queue positions
+are persisted to DynamoDB, or staged in redis when the write-behind store is enabled.
+"""
+
+from time import time
+from typing import Tuple
+from counters import QUEUE_COUNTER, ASSIGNED_QUEUE_NUM_PREFIX, RESET_GENERATION
+from bulk_write import batch_put_items
+from queue_positions import stage_queue_positions, index_entry_times
+from generations import GENERATION_ATTRIBUTE, get_generation
+
+# seconds an assignment is remembered so that redelivered messages keep their queue number
+ASSIGNED_QUEUE_NUM_TTL = 3600
+
+# Lua script that checks the assignment record of every request ID in the batch and
+# reserves queue numbers only for request IDs that have not been assigned one yet.
+# KEYS[1] is the queue counter, KEYS[2..n] are the assignment records, ARGV[1] is the record TTL
+# and ARGV[2] the reset generation key. Records from a previous reset generation are replaced.
+# Returns a {queue_position, persisted} pair per request ID, persisted is -1 for a new assignment.
+ASSIGN_QUEUE_NUM_SCRIPT = """
+local generation = redis.call('GET', ARGV[2]) or '0'
+local results = {}
+local unassigned = {}
+for i = 2, #KEYS do
+    local assigned = redis.call('HMGET', KEYS[i], 'queue_position', 'persisted', 'generation')
+    if assigned[1] and (assigned[3] or '0') == generation then
+        results[i - 1] = {tonumber(assigned[1]), tonumber(assigned[2])}
+    else
+        table.insert(unassigned, i)
+    end
+end
+if #unassigned > 0 then
+    local queue_position = redis.call('INCRBY', KEYS[1], #unassigned) - #unassigned
+    for _, i in ipairs(unassigned) do
+        queue_position = queue_position + 1
+        redis.call('HSET', KEYS[i], 'queue_position', queue_position, 'persisted', 0, 'generation', generation)
+        redis.call('EXPIRE', KEYS[i], ARGV[1])
+        results[i - 1] = {queue_position, -1}
+    end
+end
+return results
+"""
+
+
+def assigned_queue_num_key(request_id) -> str:
+    """
+    Key of the record holding the queue number assigned to a request ID
+    """
+    return f"{ASSIGNED_QUEUE_NUM_PREFIX}:{request_id}"
+
+
+def reserve_queue_numbers(assign_queue_num_script, request_ids) -> list:
+    """
+    Check for existing assignments and reserve exactly one queue number per new request ID in a single round trip.
+    Returns a [queue_position, persisted] pair per request ID.
+    """
+    return assign_queue_num_script(
+        keys=[QUEUE_COUNTER] + [assigned_queue_num_key(request_id) for request_id in request_ids],
+        args=[ASSIGNED_QUEUE_NUM_TTL, RESET_GENERATION]
+    )
+
+
+def persist_assignments(rc, ddb_resource, table_name, event_id, enable_write_behind, enable_expiry, assignments) -> Tuple[list, set]:
+    """
+    Write the (request ID, assignment) pairs that are not persisted yet in bulk and mark them as persisted.
+    The entry times are indexed for set_max_queue_position_expired if enable_expiry is true.
+    Returns the queue position items and the request IDs whose items could not be written.
+    """
+    items = []
+    for (request_id, (queue_position, persisted)) in assignments:
+        # write the assigned number unless it was already written
+        if persisted == 1:
+            print(f"Request ID {request_id} already assigned queue number {queue_position}")
+        else:
+            items.append({
+                'event_id': event_id,
+                'queue_position': int(queue_position),
+                'entry_time': int(time()),
+                'request_id': request_id,
+                'status': 1
+            })
+    if not items:
+        return ([], set())
+
+    # tag the items with the reset generation they are assigned in
+    generation = get_generation(rc)
+    for item in items:
+        item[GENERATION_ATTRIBUTE] = generation
+
+    # stage the items in redis, flush_queue_positions persists them to dynamodb
+    if enable_write_behind == 'true':
+        pipe = rc.pipeline(transaction=False)
+        stage_queue_positions(pipe, items)
+        if enable_expiry == 'true':
+            index_entry_times(pipe, items)
+        for item in items:
+            pipe.hset(assigned_queue_num_key(item['request_id']), 'persisted', 1)
+        pipe.execute()
+        print(f"Items staged: {len(items)}, queue positions {items[0]['queue_position']} to {items[-1]['queue_position']}")
+        return (items, set())
+
+    # write all items with as few round trips as possible
+    failed_request_ids = {item['request_id'] for item in batch_put_items(ddb_resource, table_name, items)}
+    pipe = rc.pipeline(transaction=False)
+    for item in items:
+        if item['request_id'] in failed_request_ids:
+            print(f"Failed to write item for request ID {item['request_id']}")
+        else:
+            pipe.hset(assigned_queue_num_key(item['request_id']), 'persisted', 1)
+    if enable_expiry == 'true':
+        index_entry_times(pipe, [item for item in items if item['request_id'] not in failed_request_ids])
+    if len(pipe):
+        pipe.execute()
+    print(f"Items written: {len(items) - len(failed_request_ids)}, queue positions {items[0]['queue_position']} to {items[-1]['queue_position']}")
+    return (items, failed_request_ids)
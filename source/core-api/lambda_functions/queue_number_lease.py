@@ -0,0 +1,185 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: Apache-2.0
+
+"""
+This module provides the block leasing allocator for queue numbers.
+A worker leases a contiguous block of queue positions with a single INCRBY on the queue counter
+and hands them out for a short period. The size of the blocks follows the rate at which the worker
+assigns positions, up to the configured lease size.
+Positions of a lease that were not handed out when the worker moves to a new block or the lease expires
+are released: they are returned to the queue counter if no position was leased after them, otherwise
+they are tombstoned in the queue position gaps set, so that the waiting number and the queue position
+expiry can account for positions that will never be assigned.
+"""
+
+from time import time
+from counters import QUEUE_COUNTER, QUEUE_NUMBER_LEASES, QUEUE_NUMBER_LEASE_PREFIX, QUEUE_POSITION_GAPS, RESET_GENERATION
+from queue_assignment import ASSIGNED_QUEUE_NUM_TTL, assigned_queue_num_key
+
+# seconds a lease is valid for
+LEASE_SECONDS = 10
+
+# stop handing out positions of a lease this many seconds before it expires
+LEASE_MARGIN_SECONDS = 2
+
+# size of the first block leased by an allocator
+INITIAL_LEASE_SIZE = 10
+
+# Lua script that releases the unassigned tail of expired leases and of the lease given up by the caller,
+# and leases a new block. Tails are released from the highest lease down, so that contiguous tails
+# at the end of the queue are all returned to the queue counter.
+# KEYS[1] is the queue counter, KEYS[2] the leases, KEYS[3] the queue position gaps.
+# ARGV[1] is the block size (0 only releases leases), ARGV[2] the current time, ARGV[3] the lease period,
+# ARGV[4] the lease record prefix and ARGV[5] the start of the lease given up by the caller (empty if none).
+# The lease records are not declared in KEYS as the Redis replication group is not clustered.
+# Returns the first and last position of the new block.
+LEASE_SCRIPT = """
+local released = redis.call('ZRANGEBYSCORE', KEYS[2], '-inf', ARGV[2])
+if ARGV[5] ~= '' then
+    table.insert(released, ARGV[5])
+end
+table.sort(released, function(a, b) return tonumber(a) > tonumber(b) end)
+for _, lease_start in ipairs(released) do
+    local lease_key = ARGV[4] .. ':' .. lease_start
+    local lease = redis.call('HMGET', lease_key, 'next', 'end')
+    if lease[1] and tonumber(lease[1]) <= tonumber(lease[2]) then
+        if tonumber(redis.call('GET', KEYS[1]) or 0) == tonumber(lease[2]) then
+            redis.call('SET', KEYS[1], tonumber(lease[1]) - 1)
+        else
+            for position = tonumber(lease[1]), tonumber(lease[2]) do
+                redis.call('ZADD', KEYS[3], position, position)
+            end
+        end
+    end
+    redis.call('DEL', lease_key)
+    redis.call('ZREM', KEYS[2], lease_start)
+end
+local size = tonumber(ARGV[1])
+if size == 0 then
+    return {}
+end
+local lease_end = redis.call('INCRBY', KEYS[1], size)
+local lease_start = lease_end - size + 1
+redis.call('HSET', ARGV[4] .. ':' .. lease_start, 'next', lease_start, 'end', lease_end)
+redis.call('ZADD', KEYS[2], tonumber(ARGV[2]) + tonumber(ARGV[3]), lease_start)
+return {lease_start, lease_end}
+"""
+
+# Lua script that works like the assign queue number script but hands out positions of a lease
+# instead of incrementing the queue counter.
+# KEYS[1] is the lease record, KEYS[2..n] are the assignment records, ARGV[1] is the record TTL
+# and ARGV[2] the reset generation key.
+# Returns false if the lease expired or has too few positions left, otherwise the next unassigned
+# position of the lease followed by a {queue_position, persisted} pair per request ID.
+ASSIGN_LEASED_QUEUE_NUM_SCRIPT = """
+local lease = redis.call('HMGET', KEYS[1], 'next', 'end')
+if not lease[1] then
+    return false
+end
+local generation = redis.call('GET', ARGV[2]) or '0'
+local results = {}
+local unassigned = {}
+for i = 2, #KEYS do
+    local assigned = redis.call('HMGET', KEYS[i], 'queue_position', 'persisted', 'generation')
+    if assigned[1] and (assigned[3] or '0') == generation then
+        results[i] = {tonumber(assigned[1]), tonumber(assigned[2])}
+    else
+        table.insert(unassigned, i)
+    end
+end
+local next_position = tonumber(lease[1])
+if #unassigned > tonumber(lease[2]) - next_position + 1 then
+    return false
+end
+for _, i in ipairs(unassigned) do
+    redis.call('HSET', KEYS[i], 'queue_position', next_position, 'persisted', 0, 'generation', generation)
+    redis.call('EXPIRE', KEYS[i], ARGV[1])
+    results[i] = {next_position, -1}
+    next_position = next_position + 1
+end
+redis.call('HSET', KEYS[1], 'next', next_position)
+results[1] = next_position
+return results
+"""
+
+
+def queue_number_lease_key(lease_start) -> str:
+    """
+    Key of the record of the lease starting at the given position
+    """
+    return f"{QUEUE_NUMBER_LEASE_PREFIX}:{lease_start}"
+
+
+def reap_expired_leases(rc) -> None:
+    """
+    Release the unassigned positions of expired leases
+    """
+    rc.register_script(LEASE_SCRIPT)(
+        keys=[QUEUE_COUNTER, QUEUE_NUMBER_LEASES, QUEUE_POSITION_GAPS],
+        args=[0, int(time()), LEASE_SECONDS, QUEUE_NUMBER_LEASE_PREFIX, ""]
+    )
+
+
+class QueueNumberAllocator:
+    """
+    Hands out queue numbers from leased blocks.
+    A Lambda execution environment processes one invocation at a time,
+    so the allocator is kept at module level and owns its lease exclusively.
+    """
+
+    def __init__(self, rc, lease_size):
+        self.lease_script = rc.register_script(LEASE_SCRIPT)
+        self.assign_script = rc.register_script(ASSIGN_LEASED_QUEUE_NUM_SCRIPT)
+        self.lease_size = lease_size
+        self.block_size = min(INITIAL_LEASE_SIZE, lease_size)
+        self.lease = None
+
+    def reserve(self, request_ids) -> list:
+        """
+        Check for existing assignments and reserve exactly one queue number per new request ID.
+        Returns a [queue_position, persisted] pair per request ID.
+        """
+        results = []
+        pending = list(request_ids)
+        while pending:
+            lease = self.current_lease()
+            chunk = pending[:lease['end'] - lease['next'] + 1]
+            response = self.assign_script(
+                keys=[lease['key']] + [assigned_queue_num_key(request_id) for request_id in chunk],
+                args=[ASSIGNED_QUEUE_NUM_TTL, RESET_GENERATION]
+            )
+            if not response:
+                # the lease expired, continue with a new block
+                self.lease = None
+                continue
+            lease['next'] = int(response[0])
+            results.extend(response[1:])
+            pending = pending[len(chunk):]
+        return results
+
+    def current_lease(self) -> dict:
+        """
+        Returns the current lease, a new block is leased if it is used up or about to expire.
+        The lease given up is released and the size of the new block follows the use of the previous one.
+        """
+        current_time = time()
+        if self.lease is None or self.lease['next'] > self.lease['end'] or current_time >= self.lease['use_until']:
+            released = ""
+            if self.lease is not None:
+                released = self.lease['start']
+                used = self.lease['next'] - self.lease['start']
+                # a block used up before it expires is doubled, otherwise shrunk to what was used
+                self.block_size = min(self.block_size * 2 if self.lease['next'] > self.lease['end'] else max(used, 1), self.lease_size)
+            (lease_start, lease_end) = self.lease_script(
+                keys=[QUEUE_COUNTER, QUEUE_NUMBER_LEASES, QUEUE_POSITION_GAPS],
+                args=[self.block_size, int(current_time), LEASE_SECONDS, QUEUE_NUMBER_LEASE_PREFIX, released]
+            )
+            self.lease = {
+                'key': queue_number_lease_key(lease_start),
+                'start': int(lease_start),
+                'next': int(lease_start),
+                'end': int(lease_end),
+                'use_until': current_time + LEASE_SECONDS - LEASE_MARGIN_SECONDS
+            }
+            print(f"Leased queue positions {lease_start} to {lease_end}")
+        return self.lease
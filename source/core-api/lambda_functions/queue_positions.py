@@ -0,0 +1,169 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: Apache-2.0
+
+"""
+This module provides the write-behind store for queue positions.
+When enabled, queue position records are written to a Redis hash first and persisted
+to the QueuePositionEntryTime table in bulk by the flush_queue_positions function.
+Records that could not be written are retried behind the other pending records and moved
+to a dead-letter set after MAX_FLUSH_ATTEMPTS.
+Readers look up the Redis hash first and fall back to DynamoDB.
+When queue position expiry is enabled, the entry times of all the queue positions, staged or written directly,
+are also indexed by queue position, so that set_max_queue_position_expired reads the entry times of a batch
+of positions in one lookup, whether they are persisted yet or not.
+"""
+
+from typing import Tuple
+from counters import QUEUE_POSITION_PREFIX, PENDING_QUEUE_POSITIONS, FAILED_QUEUE_POSITIONS, QUEUE_POSITION_ENTRY_TIMES
+from bulk_write import batch_put_items
+from generations import GENERATION_ATTRIBUTE, is_current_generation
+
+# seconds a queue position record is kept in Redis once it has been persisted to DynamoDB
+PERSISTED_QUEUE_POSITION_TTL = 3600
+
+# attempts to persist a queue position record before it is moved to the failed queue positions
+MAX_FLUSH_ATTEMPTS = 5
+
+# hash field counting the failed attempts to persist a queue position record
+FLUSH_ATTEMPTS_FIELD = "flush_attempts"
+
+# Lua script that moves the records that could not be persisted behind the other pending records,
+# so that they do not block the flush, or to the failed queue positions once they failed MAX_FLUSH_ATTEMPTS.
+# KEYS[1] is the pending set, KEYS[2] the failed set. ARGV[1] is the maximum number of attempts,
+# ARGV[2] the record prefix and ARGV[3..n] the request IDs.
+# The records are not declared in KEYS as the Redis replication group is not clustered.
+# Returns the number of records moved to the failed set.
+REQUEUE_FAILED_SCRIPT = """
+local last = redis.call('ZRANGE', KEYS[1], -1, -1, 'WITHSCORES')
+local back = (tonumber(last[2]) or 0) + 1
+local failed = 0
+for i = 3, #ARGV do
+    local record_key = ARGV[2] .. ':' .. ARGV[i]
+    local attempts = redis.call('HINCRBY', record_key, 'flush_attempts', 1)
+    if attempts >= tonumber(ARGV[1]) then
+        redis.call('ZREM', KEYS[1], ARGV[i])
+        redis.call('ZADD', KEYS[2], redis.call('HGET', record_key, 'queue_position') or 0, ARGV[i])
+        failed = failed + 1
+    else
+        redis.call('ZADD', KEYS[1], back, ARGV[i])
+    end
+end
+return failed
+"""
+
+
+def queue_position_key(request_id) -> str:
+    """
+    Key of the Redis hash holding the queue position record of a request ID
+    """
+    return f"{QUEUE_POSITION_PREFIX}:{request_id}"
+
+
+def stage_queue_positions(pipe, items) -> None:
+    """
+    Add the commands that write queue position items to Redis and mark them pending to the pipeline
+    """
+    for item in items:
+        pipe.hset(queue_position_key(item['request_id']), mapping=item)
+        pipe.zadd(PENDING_QUEUE_POSITIONS, {item['request_id']: item['queue_position']})
+
+
+def index_entry_times(pipe, items) -> None:
+    """
+    Add the command that indexes the entry times of queue position items by queue position to the pipeline
+    """
+    if items:
+        pipe.zadd(QUEUE_POSITION_ENTRY_TIMES, {
+            f"{item['queue_position']}:{item['entry_time']}:{item[GENERATION_ATTRIBUTE]}": item['queue_position']
+            for item in items
+        })
+
+
+def queue_entry_time_lookup(pipe, first_position, last_position) -> None:
+    """
+    Add the commands that read the indexed entry times and the failed queue positions
+    from first_position to last_position to the pipeline, see get_indexed_entry_times
+    """
+    pipe.zrangebyscore(QUEUE_POSITION_ENTRY_TIMES, first_position, last_position)
+    pipe.zrangebyscore(FAILED_QUEUE_POSITIONS, first_position, last_position, withscores=True)
+
+
+def get_indexed_entry_times(lookup_results, generation) -> Tuple[dict, set]:
+    """
+    Returns the entry time of each indexed queue position of the reset generation,
+    and the failed queue positions, from the results of queue_entry_time_lookup
+    """
+    (members, failed) = lookup_results
+    entry_times = {}
+    for member in members:
+        (position, entry_time, member_generation) = member.split(":")
+        if int(member_generation) == int(generation):
+            entry_times[int(position)] = int(entry_time)
+    return (entry_times, {int(score) for (_, score) in failed})
+
+
+def trim_entry_time_index(rc, max_queue_position_expired) -> None:
+    """
+    Drop the entry times up to the max expired queue position, those queue positions are never looked up again
+    """
+    rc.zremrangebyscore(QUEUE_POSITION_ENTRY_TIMES, "-inf", max_queue_position_expired)
+
+
+def get_queue_position_item(rc, ddb_table, request_id, enable_write_behind, generation) -> dict:
+    """
+    Returns the queue position record of a request ID in the same shape as a DynamoDB get_item response.
+    Records of previous reset generations are not returned.
+    """
+    response = {}
+    if enable_write_behind == 'true':
+        item = rc.hgetall(queue_position_key(request_id))
+        if item:
+            response = {'Item': item}
+    if not response:
+        response = ddb_table.get_item(Key={"request_id": request_id})
+    if 'Item' in response and not is_current_generation(response['Item'], generation):
+        return {}
+    return response
+
+
+def flush_queue_positions(rc, requeue_failed_script, ddb_resource, table_name, limit) -> int:
+    """
+    Persist up to limit pending queue position records to DynamoDB in bulk.
+    Records that could not be written stay pending behind the others, until they failed MAX_FLUSH_ATTEMPTS.
+    Returns the number of records persisted.
+    """
+    request_ids = rc.zrange(PENDING_QUEUE_POSITIONS, 0, limit - 1)
+    if not request_ids:
+        return 0
+
+    pipe = rc.pipeline(transaction=False)
+    for request_id in request_ids:
+        pipe.hgetall(queue_position_key(request_id))
+    items = [
+        {
+            'event_id': record['event_id'],
+            'queue_position': int(record['queue_position']),
+            'entry_time': int(record['entry_time']),
+            'request_id': record['request_id'],
+            'status': int(record['status']),
+            GENERATION_ATTRIBUTE: int(record.get(GENERATION_ATTRIBUTE) or 0)
+        }
+        for record in pipe.execute() if record
+    ]
+
+    failed_request_ids = {item['request_id'] for item in batch_put_items(ddb_resource, table_name, items)}
+    persisted_request_ids = [request_id for request_id in request_ids if request_id not in failed_request_ids]
+    if persisted_request_ids:
+        pipe = rc.pipeline(transaction=False)
+        pipe.zrem(PENDING_QUEUE_POSITIONS, *persisted_request_ids)
+        for request_id in persisted_request_ids:
+            pipe.expire(queue_position_key(request_id), PERSISTED_QUEUE_POSITION_TTL)
+        pipe.execute()
+    dead_lettered = 0
+    if failed_request_ids:
+        dead_lettered = requeue_failed_script(
+            keys=[PENDING_QUEUE_POSITIONS, FAILED_QUEUE_POSITIONS],
+            args=[MAX_FLUSH_ATTEMPTS, QUEUE_POSITION_PREFIX, *sorted(failed_request_ids)]
+        )
+    print(f"Queue positions persisted: {len(persisted_request_ids)}. Failed: {len(failed_request_ids)}. Moved to {FAILED_QUEUE_POSITIONS}: {dead_lettered}")
+    return len(persisted_request_ids)
@@ -0,0 +1,95 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: Apache-2.0
+
+"""
+This module runs only if active token reconciliation is enabled during core API deployment.
+It checks the active tokens kept in Redis against the token table and repairs the difference,
+for example after a Redis failover.
+Tokens are compared one expiry window at a time, so that only the tokens of a window are held in memory.
+"""
+
+import os
+import boto3
+import redis
+from time import time
+from botocore import config
+from counters import ACTIVE_TOKENS
+from active_tokens import count_active_tokens, query_active_tokens
+from generations import get_generation, generation_event_id
+
+# connection info and other globals
+SOLUTION_ID = os.environ['SOLUTION_ID']
+REDIS_HOST = os.environ["REDIS_HOST"]
+REDIS_PORT = os.environ["REDIS_PORT"]
+SECRET_NAME_PREFIX = os.environ["STACK_NAME"]
+EVENT_ID = os.environ["EVENT_ID"]
+DDB_TOKEN_TABLE_NAME = os.environ["TOKEN_TABLE"]
+VALIDITY_PERIOD = int(os.environ["VALIDITY_PERIOD"])
+TOKEN_INDEX_SHARDS = int(os.environ["TOKEN_INDEX_SHARDS"])
+
+# tokens issued less than this many seconds before the table is read may not be in the index yet
+RECONCILE_MARGIN_SECONDS = 60
+
+# seconds of token expiry times compared at a time
+RECONCILE_WINDOW_SECONDS = 60
+
+boto_session = boto3.session.Session()
+region = boto_session.region_name
+user_agent_extra = {"user_agent_extra": SOLUTION_ID}
+user_config = config.Config(**user_agent_extra)
+secrets_client = boto3.client('secretsmanager', config=user_config, endpoint_url=f"https://secretsmanager.{region}.amazonaws.com")
+response = secrets_client.get_secret_value(SecretId=f"{SECRET_NAME_PREFIX}/redis-auth")
+redis_auth = response.get("SecretString")
+rc = redis.Redis(host=REDIS_HOST, port=REDIS_PORT, ssl=True, decode_responses=True, password=redis_auth)
+ddb_resource = boto3.resource('dynamodb', endpoint_url=f'https://dynamodb.{region}.amazonaws.com', config=user_config)
+ddb_table = ddb_resource.Table(DDB_TOKEN_TABLE_NAME)
+
+
+def lambda_handler(event, _):
+    """
+    This function is the entry handler for Lambda.
+    """
+    print(event)
+    current_time = int(time())
+    event_key = generation_event_id(EVENT_ID, get_generation(rc))
+    active_count = count_active_tokens(rc)
+
+    # tokens issued from now on expire after the last window
+    (table_count, added, removed) = (0, 0, 0)
+    for window_start in range(current_time, current_time + VALIDITY_PERIOD + 1, RECONCILE_WINDOW_SECONDS):
+        (window_table_count, window_added, window_removed) = reconcile_window(
+            event_key, current_time, window_start, min(window_start + RECONCILE_WINDOW_SECONDS, current_time + VALIDITY_PERIOD + 1))
+        table_count += window_table_count
+        added += window_added
+        removed += window_removed
+    print(f"Active tokens: {active_count} in Redis, {table_count} in the token table")
+    print(f"Active tokens added: {added}, removed: {removed}")
+
+    return {
+        "redis_count": active_count,
+        "table_count": table_count,
+        "added": added,
+        "removed": removed
+    }
+
+
+def reconcile_window(event_key, current_time, expires_from, expires_before) -> tuple:
+    """
+    Repair the active tokens in Redis that expire at or after expires_from and before expires_before.
+    Returns the number of active tokens of the window in the token table, and the number of tokens added and removed.
+    """
+    table_tokens = {item['request_id']: int(item['expires']) for item in query_active_tokens(
+        ddb_table, event_key, TOKEN_INDEX_SHARDS, expires_from, expires_before)}
+    redis_tokens = dict(rc.zrangebyscore(ACTIVE_TOKENS, expires_from, f"({expires_before}", withscores=True, score_cast_func=int))
+
+    missing_tokens = {request_id: expires for (request_id, expires) in table_tokens.items() if request_id not in redis_tokens}
+    # only tokens issued before the table was read can be told apart from tokens issued meanwhile
+    issued_before = current_time - RECONCILE_MARGIN_SECONDS + VALIDITY_PERIOD
+    stale_tokens = [request_id for (request_id, expires) in redis_tokens.items()
+                    if request_id not in table_tokens and expires < issued_before]
+
+    if missing_tokens:
+        rc.zadd(ACTIVE_TOKENS, missing_tokens)
+    if stale_tokens:
+        rc.zrem(ACTIVE_TOKENS, *stale_tokens)
+    return (len(table_tokens), len(missing_tokens), len(stale_tokens))
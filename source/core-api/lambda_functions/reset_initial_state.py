@@ -3,6 +3,8 @@
 
 """
 This module is the used to reset the counters and DynamoDB table used by the core API.
+With RESET_MODE set to generation, the DynamoDB tables are not recreated: the reset starts a new
+reset generation and the items of previous generations are purged in the background.
 """
 
 import redis
@@ -10,7 +12,9 @@ import json
 import os
 import boto3
 from botocore import config
-from counters import QUEUE_COUNTER, SERVING_COUNTER, TOKEN_COUNTER, EXPIRED_QUEUE_COUNTER, ABANDONED_SESSION_COUNTER, COMPLETED_SESSION_COUNTER, MAX_QUEUE_POSITION_EXPIRED, RESET_IN_PROGRESS
+from counters import QUEUE_COUNTER, SERVING_COUNTER, TOKEN_COUNTER, EXPIRED_QUEUE_COUNTER, ABANDONED_SESSION_COUNTER, COMPLETED_SESSION_COUNTER, MAX_QUEUE_POSITION_EXPIRED, RESET_IN_PROGRESS, QUEUE_POSITION_PREFIX, PENDING_QUEUE_POSITIONS, FAILED_QUEUE_POSITIONS, QUEUE_POSITION_ENTRY_TIMES, QUEUE_NUMBER_LEASES, QUEUE_NUMBER_LEASE_PREFIX, QUEUE_POSITION_GAPS, TOKEN_CACHE_PREFIX, SERVING_COUNTER_ISSUE_TIMES, ACTIVE_TOKENS, QUEUE_POSITION_EXPIRY_SCHEDULE, RESET_GENERATION, PURGED_GENERATION, TELEMETRY, ASSIGNED_QUEUE_NUM_PREFIX
+from queue_positions import queue_position_key
+from queue_number_lease import queue_number_lease_key
 from vwr.common.sanitize import deep_clean
 from datetime import datetime
 
@@ -23,6 +27,8 @@ SECRET_NAME_PREFIX = os.environ["STACK_NAME"]
 QUEUE_POSITION_ENTRYTIME_TABLE = os.environ["QUEUE_POSITION_ENTRYTIME_TABLE"]
 SERVING_COUNTER_ISSUEDAT_TABLE = os.environ["SERVING_COUNTER_ISSUEDAT_TABLE"]
 CLOUDFRONT_DISTRIBUTION_ID = os.environ["CLOUDFRONT_DISTRIBUTION_ID"]
+RESET_MODE = os.environ["RESET_MODE"]
+PURGE_GENERATIONS_FN = os.environ["PURGE_GENERATIONS_FN"]
 
 user_agent_extra = {"user_agent_extra": SOLUTION_ID}
 user_config = config.Config(**user_agent_extra)
@@ -34,6 +40,7 @@ response = secrets_client.get_secret_value(SecretId=f"{SECRET_NAME_PREFIX}/redis
 redis_auth = response.get("SecretString")
 rc = redis.Redis(host=REDIS_HOST, port=REDIS_PORT, ssl=True, decode_responses=True, password=redis_auth)
 cloudfront_client = boto3.client('cloudfront', config=user_config)
+lambda_client = boto3.client('lambda', endpoint_url=f"https://lambda.{region}.amazonaws.com", config=user_config)
 
 
 def lambda_handler(event, _):
@@ -53,77 +60,14 @@ def lambda_handler(event, _):
         rc.getset(RESET_IN_PROGRESS, 1)
         print('Reset in progress')
 
-        # reset counters
-        rc.getset(SERVING_COUNTER, 0)
-        rc.getset(QUEUE_COUNTER, 0)
-        rc.getset(TOKEN_COUNTER, 0)
-        rc.getset(EXPIRED_QUEUE_COUNTER, 0)
-        rc.getset(COMPLETED_SESSION_COUNTER, 0)
-        rc.getset(ABANDONED_SESSION_COUNTER, 0)
-        rc.getset(MAX_QUEUE_POSITION_EXPIRED, 0)
-        print("Counters reset")
-
-        try:                       
-            create_cloudfront_invalidation(paths=['/*'])
-
-            response = ddb_client.delete_table(TableName=TOKEN_TABLE)
-            waiter = ddb_client.get_waiter('table_not_exists')
-            # wait for table to get deleted
-            waiter.wait(TableName=TOKEN_TABLE)
-            print("Token table deleted")
-            # recreate table
-            create_token_table()
-            waiter = ddb_client.get_waiter('table_exists')
-            # wait for table to get created
-            waiter.wait(TableName=TOKEN_TABLE)
-            print("Token table recreated")
-            # enable PITR
-            ddb_client.update_continuous_backups(
-                TableName=TOKEN_TABLE,
-                PointInTimeRecoverySpecification={
-                    'PointInTimeRecoveryEnabled': True
-                }
-            )
-
-            response = ddb_client.delete_table(TableName=QUEUE_POSITION_ENTRYTIME_TABLE)
-            waiter = ddb_client.get_waiter('table_not_exists')
-            # wait for table to get deleted
-            waiter.wait(TableName=QUEUE_POSITION_ENTRYTIME_TABLE)
-            print("QueuePositionEntryTimeTable table deleted")
-            # recreate table
-            create_queueposition_issuedat_table()
-            waiter = ddb_client.get_waiter('table_exists')
-            # wait for table to get created
-            waiter.wait(TableName=QUEUE_POSITION_ENTRYTIME_TABLE)
-            print("QueuePositionEntryTimeTable recreated")
-            # enable PITR
-            ddb_client.update_continuous_backups(
-                TableName=QUEUE_POSITION_ENTRYTIME_TABLE,
-                PointInTimeRecoverySpecification={
-                    'PointInTimeRecoveryEnabled': True
-                }
-            )
-
-            response = ddb_client.delete_table(TableName=SERVING_COUNTER_ISSUEDAT_TABLE)
-            waiter = ddb_client.get_waiter('table_not_exists')
-            # wait for table to get deleted
-            waiter.wait(TableName=SERVING_COUNTER_ISSUEDAT_TABLE)
-            print("ServingCounterIssuedAt table deleted")
-            # recreate table
-            create_servingcounter_issuedat_table()
-            waiter = ddb_client.get_waiter('table_exists')
-            # wait for table to get created
-            waiter.wait(TableName=SERVING_COUNTER_ISSUEDAT_TABLE)
-            print("ServingCounterIssuedAt recreated")
-            # enable PITR
-            ddb_client.update_continuous_backups(
-                TableName=SERVING_COUNTER_ISSUEDAT_TABLE,
-                PointInTimeRecoverySpecification={
-                    'PointInTimeRecoveryEnabled': True
-                }
-            )
-            print("DynamoDB tables recreated")
-            
+        try:
+            if RESET_MODE == 'generation':
+                reset_generation()
+            else:
+                reset_redis_state()
+                create_cloudfront_invalidation(paths=['/*'])
+                recreate_tables()
+
             rc.set(RESET_IN_PROGRESS, 0)
             print('Reset completed')
             
@@ -146,6 +90,167 @@ def lambda_handler(event, _):
     return response
 
 
+def reset_counters() -> None:
+    """
+    Reset the counters and drop the Redis keys that are not scoped by request ID
+    """
+    # reset counters in a single write
+    rc.mset({
+        SERVING_COUNTER: 0,
+        QUEUE_COUNTER: 0,
+        TOKEN_COUNTER: 0,
+        EXPIRED_QUEUE_COUNTER: 0,
+        COMPLETED_SESSION_COUNTER: 0,
+        ABANDONED_SESSION_COUNTER: 0,
+        MAX_QUEUE_POSITION_EXPIRED: 0
+    })
+    print("Counters reset")
+
+    # drop the queue number gaps, the serving counter issue time index, the expiry schedule, the active tokens and the telemetry
+    rc.delete(QUEUE_POSITION_GAPS, QUEUE_POSITION_ENTRY_TIMES, SERVING_COUNTER_ISSUE_TIMES, QUEUE_POSITION_EXPIRY_SCHEDULE, ACTIVE_TOKENS, TELEMETRY)
+
+
+def reset_redis_state() -> None:
+    """
+    Reset the counters and delete every staged queue position, queue number lease and cached token
+    """
+    reset_counters()
+
+    # drop queue positions staged by the write-behind store
+    rc.delete(PENDING_QUEUE_POSITIONS, FAILED_QUEUE_POSITIONS)
+    delete_keys(f"{QUEUE_POSITION_PREFIX}:*")
+    print("Staged queue positions deleted")
+
+    # drop queue number leases
+    rc.delete(QUEUE_NUMBER_LEASES)
+    delete_keys(f"{QUEUE_NUMBER_LEASE_PREFIX}:*")
+    print("Queue number leases deleted")
+
+    # drop cached tokens
+    delete_keys(f"{TOKEN_CACHE_PREFIX}:*")
+    print("Cached tokens deleted")
+
+    # drop the queue numbers assigned to request IDs, so that redelivered requests are assigned a new one
+    delete_keys(f"{ASSIGNED_QUEUE_NUM_PREFIX}:*")
+    print("Queue number assignments deleted")
+
+    # the recreated tables hold generation 0 items only
+    rc.delete(RESET_GENERATION, PURGED_GENERATION)
+
+
+def reset_generation() -> None:
+    """
+    Start a new reset generation instead of recreating the DynamoDB tables.
+    Items, cached tokens and queue number assignments of previous generations are ignored by the core API,
+    the purge_generations function deletes the DynamoDB items in the background.
+    """
+    generation = rc.incr(RESET_GENERATION)
+    print(f"Reset generation: {generation}")
+    reset_counters()
+
+    # drop queue positions staged by the write-behind store that are not persisted yet or could not be,
+    # persisted records are kept until they expire
+    for staged_queue_positions in (PENDING_QUEUE_POSITIONS, FAILED_QUEUE_POSITIONS):
+        unlink_keys([queue_position_key(request_id) for request_id in rc.zrange(staged_queue_positions, 0, -1)])
+    rc.delete(PENDING_QUEUE_POSITIONS, FAILED_QUEUE_POSITIONS)
+    print("Staged queue positions deleted")
+
+    # drop the live queue number leases
+    unlink_keys([queue_number_lease_key(lease_start) for lease_start in rc.zrange(QUEUE_NUMBER_LEASES, 0, -1)])
+    rc.delete(QUEUE_NUMBER_LEASES)
+    print("Queue number leases deleted")
+
+    create_cloudfront_invalidation(paths=['/*'])
+
+    lambda_client.invoke(FunctionName=PURGE_GENERATIONS_FN, InvocationType='Event', Payload=json.dumps({}))
+    print("Purge of previous generations started")
+
+
+def recreate_tables() -> None:
+    """
+    Delete and recreate the DynamoDB tables
+    """
+    ddb_client.delete_table(TableName=TOKEN_TABLE)
+    waiter = ddb_client.get_waiter('table_not_exists')
+    # wait for table to get deleted
+    waiter.wait(TableName=TOKEN_TABLE)
+    print("Token table deleted")
+    # recreate table
+    create_token_table()
+    waiter = ddb_client.get_waiter('table_exists')
+    # wait for table to get created
+    waiter.wait(TableName=TOKEN_TABLE)
+    print("Token table recreated")
+    # enable PITR
+    ddb_client.update_continuous_backups(
+        TableName=TOKEN_TABLE,
+        PointInTimeRecoverySpecification={
+            'PointInTimeRecoveryEnabled': True
+        }
+    )
+
+    ddb_client.delete_table(TableName=QUEUE_POSITION_ENTRYTIME_TABLE)
+    waiter = ddb_client.get_waiter('table_not_exists')
+    # wait for table to get deleted
+    waiter.wait(TableName=QUEUE_POSITION_ENTRYTIME_TABLE)
+    print("QueuePositionEntryTimeTable table deleted")
+    # recreate table
+    create_queueposition_issuedat_table()
+    waiter = ddb_client.get_waiter('table_exists')
+    # wait for table to get created
+    waiter.wait(TableName=QUEUE_POSITION_ENTRYTIME_TABLE)
+    print("QueuePositionEntryTimeTable recreated")
+    # enable PITR
+    ddb_client.update_continuous_backups(
+        TableName=QUEUE_POSITION_ENTRYTIME_TABLE,
+        PointInTimeRecoverySpecification={
+            'PointInTimeRecoveryEnabled': True
+        }
+    )
+
+    ddb_client.delete_table(TableName=SERVING_COUNTER_ISSUEDAT_TABLE)
+    waiter = ddb_client.get_waiter('table_not_exists')
+    # wait for table to get deleted
+    waiter.wait(TableName=SERVING_COUNTER_ISSUEDAT_TABLE)
+    print("ServingCounterIssuedAt table deleted")
+    # recreate table
+    create_servingcounter_issuedat_table()
+    waiter = ddb_client.get_waiter('table_exists')
+    # wait for table to get created
+    waiter.wait(TableName=SERVING_COUNTER_ISSUEDAT_TABLE)
+    print("ServingCounterIssuedAt recreated")
+    # enable PITR
+    ddb_client.update_continuous_backups(
+        TableName=SERVING_COUNTER_ISSUEDAT_TABLE,
+        PointInTimeRecoverySpecification={
+            'PointInTimeRecoveryEnabled': True
+        }
+    )
+    print("DynamoDB tables recreated")
+
+
+def delete_keys(pattern) -> None:
+    """
+    Delete all keys matching the pattern without blocking redis
+    """
+    keys = []
+    for key in rc.scan_iter(match=pattern, count=1000):
+        keys.append(key)
+        if len(keys) == 1000:
+            rc.unlink(*keys)
+            keys = []
+    if keys:
+        rc.unlink(*keys)
+
+
+def unlink_keys(keys) -> None:
+    """
+    Delete the keys in chunks of 1000 without blocking redis
+    """
+    for start in range(0, len(keys), 1000):
+        rc.unlink(*keys[start:start + 1000])
+
+
 def create_token_table():
     """
     Create TOKEN_TABLE
@@ -165,6 +270,10 @@ def create_token_table():
             {
                 "AttributeName": "event_id",
                 "AttributeType": "S"
+            },
+            {
+                "AttributeName": "event_shard",
+                "AttributeType": "S"
             }
         ],
         KeySchema = [
@@ -189,6 +298,22 @@ def create_token_table():
                 "Projection": {
                     "ProjectionType": "ALL"
                 }
+            },
+            {
+                "IndexName": "EventShardExpiresIndex",
+                "KeySchema": [
+                    {
+                        "AttributeName": "event_shard",
+                        "KeyType": "HASH"
+                    },
+                    {
+                        "AttributeName": "expires",
+                        "KeyType": "RANGE"
+                    }
+                ],
+                "Projection": {
+                    "ProjectionType": "ALL"
+                }
             }
         ],
         SSESpecification = {
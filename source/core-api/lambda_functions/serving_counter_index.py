@@ -0,0 +1,87 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: Apache-2.0
+
+"""
+This module provides the Redis index of the serving counter issue times.
+Each serving counter value written to the ServingCounterIssuedAt table is also added to a sorted set
+scored by the serving counter, so finding the first serving counter at or above a queue number
+is a single ZRANGEBYSCORE. Each entry also holds the serving counter value it was incremented from:
+an entry is only used for queue numbers above that value, since no serving counter value was issued in between.
+Otherwise the index may be missing the entry of an earlier serving counter value (e.g. after an upgrade or
+the loss of Redis data), so the table, which remains the durable record, is queried.
+Indexing a serving counter value also brings the queue position expiry schedule forward to its issue time
+if it is earlier, so that set_max_queue_position_expired evaluates it when it is due.
+"""
+
+from boto3.dynamodb.conditions import Key
+from counters import SERVING_COUNTER_ISSUE_TIMES, QUEUE_POSITION_EXPIRY_SCHEDULE
+
+# member of the queue position expiry schedule sorted set
+NEXT_EXPIRY_MEMBER = "next"
+
+# index entries read per lookup, a serving counter value can have several entries
+INDEX_LOOKUP_ENTRIES = 4
+
+
+def index_serving_counter(rc, serving_counter, issue_time, previous_serving_counter) -> None:
+    """
+    Add the issue time of a serving counter value, incremented from previous_serving_counter, to the index
+    """
+    pipe = rc.pipeline()
+    pipe.zadd(SERVING_COUNTER_ISSUE_TIMES, {f"{serving_counter}:{issue_time}:{previous_serving_counter}": serving_counter})
+    pipe.zadd(QUEUE_POSITION_EXPIRY_SCHEDULE, {NEXT_EXPIRY_MEMBER: issue_time}, lt=True)
+    pipe.execute()
+
+
+def get_serving_counter_item(rc, ddb_table, event_id, queue_number) -> dict:
+    """
+    Returns the first serving counter item (serving_counter, issue_time) at or above the queue number, or None
+    """
+    members = rc.zrangebyscore(SERVING_COUNTER_ISSUE_TIMES, queue_number, "+inf", start=0, num=INDEX_LOOKUP_ENTRIES)
+    for member in members:
+        (serving_counter, issue_time, previous_serving_counter) = (member.split(":") + [None])[:3]
+        if int(serving_counter) != int(members[0].split(":")[0]):
+            break
+        # entries without the previous value (written before it was recorded) are not used
+        if previous_serving_counter is not None and int(previous_serving_counter) < queue_number:
+            return {'serving_counter': int(serving_counter), 'issue_time': int(issue_time)}
+
+    response = ddb_table.query(
+        KeyConditionExpression=Key('event_id').eq(event_id) & Key('serving_counter').gte(queue_number),
+        Limit=1
+    )
+    if not response['Items']:
+        return None
+    item = response['Items'][0]
+    # the table has no serving counter value from the queue number up to this one
+    index_serving_counter(rc, int(item['serving_counter']), int(item['issue_time']), queue_number - 1)
+    return item
+
+
+def trim_serving_counter_index(rc, max_queue_position_expired) -> None:
+    """
+    Drop the serving counter values up to the max expired queue position, those queue positions are never looked up again
+    """
+    rc.zremrangebyscore(SERVING_COUNTER_ISSUE_TIMES, "-inf", max_queue_position_expired)
+
+
+def get_next_expiry_time(rc):
+    """
+    Returns the queue time of the first serving counter item pending expiry,
+    +inf if no item is pending, or None if it is not known (evaluate all the items)
+    """
+    return rc.zscore(QUEUE_POSITION_EXPIRY_SCHEDULE, NEXT_EXPIRY_MEMBER)
+
+
+def set_next_expiry_time(rc, queue_time, max_queue_position_expired) -> None:
+    """
+    Record the queue time of the first serving counter item pending expiry, or None if no item is pending
+    """
+    if queue_time is not None:
+        rc.zadd(QUEUE_POSITION_EXPIRY_SCHEDULE, {NEXT_EXPIRY_MEMBER: queue_time})
+        return
+
+    rc.zadd(QUEUE_POSITION_EXPIRY_SCHEDULE, {NEXT_EXPIRY_MEMBER: "+inf"})
+    # a serving counter value indexed since the items were read may not have brought +inf forward yet
+    if rc.zcount(SERVING_COUNTER_ISSUE_TIMES, f"({max_queue_position_expired}", "+inf"):
+        rc.zrem(QUEUE_POSITION_EXPIRY_SCHEDULE, NEXT_EXPIRY_MEMBER)
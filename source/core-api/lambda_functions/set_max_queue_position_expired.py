@@ -4,16 +4,29 @@
 """
 This module is the set_max_queue_position_expired API handler.
 It sets the MAX_QUEUE_POSITION_EXPIRED value and optionally increments the serving counter.
+Serving counter items are read page by page and evaluated in batches: the gaps of a batch and the entry times
+of its queue positions are read from Redis in one pipeline. Only positions missing from the entry time index
+(e.g. assigned before an upgrade or the loss of Redis data) are queried concurrently in DynamoDB.
+Queue positions that could not be persisted by the write-behind store and have no indexed entry time
+expire with the serving counter.
+MAX_QUEUE_POSITION_EXPIRED is the cursor of the evaluation. The queue time of the first item that has not
+expired is kept in Redis, so that runs before it is due do not read the serving counter items.
+Only the serving counter and queue position items of the current reset generation are evaluated.
 """
 
 import boto3
 import os
 import redis
-import json
+from concurrent.futures import ThreadPoolExecutor
 from botocore import config
 from time import time
 from boto3.dynamodb.conditions import Key
-from counters import MAX_QUEUE_POSITION_EXPIRED, QUEUE_COUNTER, RESET_IN_PROGRESS, SERVING_COUNTER, EXPIRED_QUEUE_COUNTER
+from counters import MAX_QUEUE_POSITION_EXPIRED, QUEUE_COUNTER, RESET_IN_PROGRESS, SERVING_COUNTER, EXPIRED_QUEUE_COUNTER, QUEUE_POSITION_GAPS, RESET_GENERATION, get_counters
+from generations import GENERATION_ATTRIBUTE, generation_event_id, is_current_generation, parse_generation
+from queue_number_lease import reap_expired_leases
+from queue_positions import queue_entry_time_lookup, get_indexed_entry_times, trim_entry_time_index
+from serving_counter_index import index_serving_counter, trim_serving_counter_index, get_next_expiry_time, set_next_expiry_time
+from vwr.common.events import EventPublisher
 
 SECRET_NAME_PREFIX = os.environ["STACK_NAME"]
 SOLUTION_ID = os.environ['SOLUTION_ID']
@@ -38,133 +51,246 @@ response = secrets_client.get_secret_value(SecretId=f"{SECRET_NAME_PREFIX}/redis
 redis_auth = response.get("SecretString")
 rc = redis.Redis(host=REDIS_HOST, port=REDIS_PORT, ssl=True, decode_responses=True, password=redis_auth)
 events_client = boto3.client('events', endpoint_url=f'https://events.{region}.amazonaws.com', config=user_config)
+# serving counter increments are sent in batches at the end of the invocation
+event_publisher = EventPublisher(events_client, EVENT_BUS_NAME, deferred=True)
+
+# number of serving counter items evaluated together and maximum number of concurrent entry time queries
+EVALUATION_BATCH_SIZE = 100
+MAX_QUERY_WORKERS = 16
 
 def lambda_handler(event, _):
     """
     This function is the entry handler for Lambda.
     """
     print(event)
-    if _is_reset_in_progress():
+    counters = _get_current_counters()
+    if _is_reset_in_progress(counters):
         return
 
-    counters = _get_current_counters()
+    # tombstone the unassigned positions of expired queue number leases
+    reap_expired_leases(rc)
+
     print(f'Queue counter: {counters["queue"]}. Max position expired: {counters["max_expired"]}. Serving counter: {counters["serving"]}')
 
-    serving_items = _get_eligible_serving_items(counters["max_expired"])
-    if not serving_items:
+    expiry_cutoff = int(time()) - int(QUEUE_POSITION_EXPIRY_PERIOD)
+    next_expiry_time = get_next_expiry_time(rc)
+    if next_expiry_time is not None and next_expiry_time > expiry_cutoff:
+        if next_expiry_time == float("inf"):
+            print('No serving counter items pending expiry')
+        else:
+            print(f'Next serving counter item expires at {int(next_expiry_time) + int(QUEUE_POSITION_EXPIRY_PERIOD)}. Skipping evaluation')
         return
 
-    _process_serving_items(serving_items, counters["max_expired"])
+    (expired_items, next_queue_time) = _get_expired_serving_items(counters["max_expired"], expiry_cutoff, counters["generation"])
+    max_expired = int(expired_items[-1]['serving_counter']) if expired_items else counters["max_expired"]
+    try:
+        if expired_items:
+            _process_expired_items(expired_items, counters["max_expired"], counters["generation"])
+    finally:
+        event_publisher.flush()
+    set_next_expiry_time(rc, next_queue_time, max_expired)
 
 
-def _is_reset_in_progress():
-    if int(rc.get(RESET_IN_PROGRESS) or 0) != 0:
+def _is_reset_in_progress(counters):
+    if counters["reset_in_progress"] != 0:
         print('Reset in progress. Skipping execution')
         return True
     return False
 
 
 def _get_current_counters():
+    counters = get_counters(rc)
     return {
-        "max_expired": int(rc.get(MAX_QUEUE_POSITION_EXPIRED) or 0),
-        "serving": int(rc.get(SERVING_COUNTER) or 0),
-        "queue": int(rc.get(QUEUE_COUNTER) or 0)
+        "max_expired": counters[MAX_QUEUE_POSITION_EXPIRED],
+        "serving": counters[SERVING_COUNTER],
+        "queue": counters[QUEUE_COUNTER],
+        "reset_in_progress": counters[RESET_IN_PROGRESS],
+        "generation": parse_generation(counters[RESET_GENERATION])
     }
 
 
-def _get_eligible_serving_items(max_expired):
-    response = ddb_table_serving_counter_issued_at.query(
-        KeyConditionExpression=Key('event_id').eq(EVENT_ID) & Key('serving_counter').gt(max_expired),
-    )
-    items = response['Items']
-    if not items:
+def _get_eligible_serving_items(max_expired, generation):
+    """
+    Yields the serving counter items above max_expired in serving counter order, one page at a time
+    """
+    query_args = {
+        "KeyConditionExpression": Key('event_id').eq(generation_event_id(EVENT_ID, generation)) & Key('serving_counter').gt(max_expired)
+    }
+    response = ddb_table_serving_counter_issued_at.query(**query_args)
+    if not response['Items']:
         print('No serving counter items eligible')
-    return items
+    yield from response['Items']
+    while 'LastEvaluatedKey' in response:
+        response = ddb_table_serving_counter_issued_at.query(ExclusiveStartKey=response['LastEvaluatedKey'], **query_args)
+        yield from response['Items']
 
 
-def _process_serving_items(serving_items, initial_max_expired):
-    previous_position = initial_max_expired
-    current_time = int(time())
-    
-    for item in serving_items:
-        if not _should_process_item(item, current_time):
-            break
-            
-        position = int(item['serving_counter'])
-        _update_max_expired_position(position)
-        
-        if INCR_SVC_ON_QUEUE_POS_EXPIRY == 'true':
-            queue_positions_served = int(item['queue_positions_served'])
-            incr_serving_counter(rc, queue_positions_served, position, previous_position)
-            
-        previous_position = position
+def _get_expired_serving_items(max_expired, expiry_cutoff, generation):
+    """
+    Returns the leading serving counter items whose queue positions have expired,
+    i.e. entered the queue and were served at or before the expiry cutoff,
+    and the queue time of the first item that has not expired (None if there is no such item).
+    Items are evaluated in batches and evaluation stops at the first item that has not expired.
+    """
+    expired_items = []
+    batch = []
+    for item in _get_eligible_serving_items(max_expired, generation):
+        # an item served after the cutoff has not expired, whatever its entry time
+        if int(item['issue_time']) > expiry_cutoff:
+            (expired_batch, next_queue_time) = _get_expired_batch_items(batch, expiry_cutoff, generation)
+            return (expired_items + expired_batch, next_queue_time if next_queue_time is not None else int(item['issue_time']))
+        batch.append(item)
+        if len(batch) == EVALUATION_BATCH_SIZE:
+            (expired_batch, next_queue_time) = _get_expired_batch_items(batch, expiry_cutoff, generation)
+            expired_items.extend(expired_batch)
+            if next_queue_time is not None:
+                return (expired_items, next_queue_time)
+            batch = []
+    (expired_batch, next_queue_time) = _get_expired_batch_items(batch, expiry_cutoff, generation)
+    return (expired_items + expired_batch, next_queue_time)
 
 
-def _should_process_item(serving_item, current_time):
-    position = int(serving_item['serving_counter'])
-    issue_time = int(serving_item['issue_time'])
-    
-    response = ddb_table_queue_position_entry_time.query(
-        KeyConditionExpression=Key('queue_position').eq(position),
-        IndexName='QueuePositionIndex',
-    )
-    
-    if not response['Items']:
-        print('No queue postions items eligible')
-        return False
-        
-    entry_time = int(response['Items'][0]['entry_time'])
-    queue_time = max(entry_time, issue_time)
-    
-    return current_time - queue_time >= int(QUEUE_POSITION_EXPIRY_PERIOD)
+def _get_expired_batch_items(serving_items, expiry_cutoff, generation):
+    """
+    Returns the leading items of the batch whose queue positions entered the queue at or before the expiry cutoff,
+    and the queue time of the first item that has not expired (None if they all have)
+    """
+    if not serving_items:
+        return ([], None)
+
+    positions = [int(item['serving_counter']) for item in serving_items]
+    pipe = rc.pipeline(transaction=False)
+    for position in positions:
+        pipe.zscore(QUEUE_POSITION_GAPS, position)
+    queue_entry_time_lookup(pipe, positions[0], positions[-1])
+    results = pipe.execute()
+    gap_scores = results[:len(positions)]
+    (entry_times, failed_positions) = get_indexed_entry_times(results[len(positions):], generation)
+    # leased positions that were never assigned and failed positions expire with the serving counter
+    expire_with_serving_counter = [
+        gap_score is not None or (position not in entry_times and position in failed_positions)
+        for (position, gap_score) in zip(positions, gap_scores)
+    ]
+    entry_times.update(_get_entry_times(
+        [position for (position, expire) in zip(positions, expire_with_serving_counter) if not expire and position not in entry_times], generation
+    ))
+
+    for (index, (item, expire)) in enumerate(zip(serving_items, expire_with_serving_counter)):
+        if expire:
+            continue
+        entry_time = entry_times.get(int(item['serving_counter']))
+        if entry_time is None:
+            # the queue position may not be persisted yet, evaluate it again on the next run
+            print('No queue postions items eligible')
+            return (serving_items[:index], int(item['issue_time']))
+        if int(entry_time) > expiry_cutoff:
+            return (serving_items[:index], max(int(entry_time), int(item['issue_time'])))
+    return (serving_items, None)
+
+
+def _get_entry_times(positions, generation):
+    """
+    Returns the entry time of each queue position of the reset generation found in the QueuePositionEntryTime table.
+    The table is keyed by request ID, so the positions missing from the entry time index are looked up
+    concurrently on QueuePositionIndex.
+    """
+    if not positions:
+        return {}
+
+    # the low-level client is thread safe, the table resource is not
+    client = ddb_table_queue_position_entry_time.meta.client
+    def query_entry_time(position):
+        response = client.query(
+            TableName=ddb_table_queue_position_entry_time.name,
+            IndexName='QueuePositionIndex',
+            KeyConditionExpression=Key('queue_position').eq(position),
+            ProjectionExpression=f'entry_time, {GENERATION_ATTRIBUTE}'
+        )
+        # positions of previous generations are kept until they are purged
+        items = [item for item in response['Items'] if is_current_generation(item, generation)]
+        return items[0]['entry_time'] if items else None
+
+    with ThreadPoolExecutor(max_workers=min(len(positions), MAX_QUERY_WORKERS)) as executor:
+        entry_times = dict(zip(positions, executor.map(query_entry_time, positions)))
+    return {position: entry_time for (position, entry_time) in entry_times.items() if entry_time is not None}
+
+
+def _process_expired_items(expired_items, initial_max_expired, generation):
+    _update_max_expired_position(int(expired_items[-1]['serving_counter']))
+
+    if INCR_SVC_ON_QUEUE_POS_EXPIRY == 'true':
+        (increment_by, expired_count) = _get_serving_counter_increment(expired_items, initial_max_expired)
+        incr_serving_counter(rc, increment_by, expired_count, generation)
 
 
 def _update_max_expired_position(position):
     if rc.set(MAX_QUEUE_POSITION_EXPIRED, position):
         print(f'Max queue expiry position set to: {position}')
+        trim_serving_counter_index(rc, position)
+        trim_entry_time_index(rc, position)
     else:
         print(f'Failed to set max queue position served: Current value: {position}')
 
 
-def incr_serving_counter(rc, queue_positions_served, serving_counter_item_position, previous_serving_counter_position):
+def _get_serving_counter_increment(expired_items, initial_max_expired):
+    """
+    Returns the serving counter increment for the queue positions served indirectly (expired) up to the
+    last expired item, and how many of them are expired queue positions rather than unassigned leased positions
+    """
+    pipe = rc.pipeline(transaction=False)
+    previous_position = initial_max_expired
+    for item in expired_items:
+        position = int(item['serving_counter'])
+        pipe.zcount(QUEUE_POSITION_GAPS, f"({previous_position}", position)
+        previous_position = position
+    gap_counts = pipe.execute()
+
+    increment_by = 0
+    expired_count = 0
+    previous_position = initial_max_expired
+    for (item, gap_count) in zip(expired_items, gap_counts):
+        position = int(item['serving_counter'])
+        # [(Current counter - Previous counter) - (Queue positions served in that range)]
+        item_increment = (position - previous_position) - int(item['queue_positions_served'])
+        previous_position = position
+        # should never happen, addl guard
+        if item_increment <= 0:
+            print(f'Increment value calculated as {item_increment} for serving counter item {position}, skipped')
+            continue
+        increment_by += item_increment
+        # leased positions that were never assigned are already accounted for as gaps
+        expired_count += max(item_increment - int(gap_count), 0)
+    return (increment_by, expired_count)
+
+
+def incr_serving_counter(rc, increment_by, expired_count, generation):
     """
     Function to increment the serving counter based on queue postions served (indirectly expired positions)
     """
-    # increment the serving counter by taking the difference of counter item entries and subtract positions served in that range
-    # [(Current counter - Previous counter) - (Queue positions served in that range)]
-    increment_by = (serving_counter_item_position - previous_serving_counter_position) - queue_positions_served
-    
-    # should never happen, addl guard
     if increment_by <= 0:
         print(f'Increment value calculated as {increment_by}, incrementing serving counter skipped')
         return
 
-    rc.incrby(EXPIRED_QUEUE_COUNTER, int(increment_by))
-    
+    if expired_count > 0:
+        rc.incrby(EXPIRED_QUEUE_COUNTER, int(expired_count))
+
     cur_serving = int(rc.incrby(SERVING_COUNTER, int(increment_by)))
     item = {
-        'event_id': EVENT_ID,
+        'event_id': generation_event_id(EVENT_ID, generation),
         'serving_counter': cur_serving,
         'issue_time': int(time()),
         'queue_positions_served': 0
     }
     ddb_table_serving_counter_issued_at.put_item(Item=item)
+    index_serving_counter(rc, cur_serving, item['issue_time'], cur_serving - int(increment_by))
     print(f'Item: {item}')
     print(f'Serving counter incremented by {increment_by}. Current value: {cur_serving}')
 
-    events_client.put_events(
-        Entries=[
-            {
-                'Source': 'custom.waitingroom',
-                'DetailType': 'automatic_serving_counter_incr',
-                'Detail': json.dumps(
-                    {
-                        'previous_serving_counter_position': cur_serving - increment_by,
-                        'increment_by': increment_by,
-                        'current_serving_counter_position': cur_serving,
-                    }
-                ),
-                'EventBusName': EVENT_BUS_NAME
-            }
-        ]
+    event_publisher.publish(
+        'automatic_serving_counter_incr',
+        {
+            'previous_serving_counter_position': cur_serving - increment_by,
+            'increment_by': increment_by,
+            'current_serving_counter_position': cur_serving,
+        }
     )
@@ -0,0 +1,130 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: Apache-2.0
+
+"""
+This module maintains the high resolution telemetry of the waiting room in Redis.
+Handlers count enqueued requests, issued tokens, serving counter increments and session updates
+in per-second buckets of a ring buffer. The ring holds a fixed number of seconds per metric,
+so its memory use is bounded no matter how long the event runs. Each bucket is stored with
+the second it counts, a bucket left over from a previous turn of the ring is reset on write
+and ignored on read.
+"""
+
+from time import time
+import redis
+from counters import TELEMETRY
+
+# metrics recorded in the ring buffer
+ENQUEUED = "enqueued"
+TOKENS_ISSUED = "tokens_issued"
+SERVED = "served"
+SESSIONS_UPDATED = "sessions_updated"
+TELEMETRY_METRICS = [ENQUEUED, TOKENS_ISSUED, SERVED, SESSIONS_UPDATED]
+
+# longest window (seconds) the rates can be computed over
+MAX_TELEMETRY_WINDOW = 600
+
+# one more bucket than the longest window so the bucket of the current second is never read
+TELEMETRY_SLOTS = MAX_TELEMETRY_WINDOW + 1
+
+# KEYS[1] is the telemetry hash, ARGV[1] the current second, ARGV[2] the number of slots,
+# followed by metric name and count pairs.
+# Each bucket is a count field and a field holding the second it counts.
+RECORD_TELEMETRY_SCRIPT = """
+local now = ARGV[1]
+local slot = tonumber(now) % tonumber(ARGV[2])
+for i = 3, #ARGV, 2 do
+    local field = ARGV[i] .. ':' .. slot
+    if redis.call('HGET', KEYS[1], field .. ':t') == now then
+        redis.call('HINCRBY', KEYS[1], field, ARGV[i + 1])
+    else
+        redis.call('HSET', KEYS[1], field, ARGV[i + 1], field .. ':t', now)
+    end
+end
+return 1
+"""
+
+
+def telemetry_args(counts, current_time=None) -> list:
+    """
+    Returns the script arguments of the counts (metric name to count), None if every count is 0
+    """
+    args = [int(current_time or time()), TELEMETRY_SLOTS]
+    for (metric, count) in counts.items():
+        if count:
+            args.extend([metric, count])
+    return args if len(args) > 2 else None
+
+
+def record_telemetry(record_telemetry_script, counts, current_time=None) -> None:
+    """
+    Add the counts (metric name to count) to the bucket of the current second in a single call.
+    Telemetry is best effort, a failure is logged and does not fail the request.
+    """
+    args = telemetry_args(counts, current_time)
+    if args is None:
+        return
+    try:
+        record_telemetry_script(keys=[TELEMETRY], args=args)
+    except redis.RedisError as exception:
+        print(f"Telemetry not recorded: {exception}")
+
+
+def execute_with_telemetry(pipe, record_telemetry_script, counts, current_time=None) -> list:
+    """
+    Execute the commands queued on the pipeline and record the counts in the same round trip.
+    The script is run by its SHA, as redis-py checks that the scripts of a pipeline exist with an extra call.
+    It is only loaded, by a separate call, when Redis does not have it yet.
+    Returns the results of the queued commands, telemetry failures are logged like record_telemetry does.
+    """
+    args = telemetry_args(counts, current_time)
+    if record_telemetry_script is None or args is None:
+        return pipe.execute()
+    pipe.evalsha(record_telemetry_script.sha, 1, TELEMETRY, *args)
+    (*results, telemetry_result) = pipe.execute(raise_on_error=False)
+    for result in results:
+        if isinstance(result, Exception):
+            raise result
+    if isinstance(telemetry_result, redis.exceptions.NoScriptError):
+        record_telemetry(record_telemetry_script, counts, current_time)
+    elif isinstance(telemetry_result, redis.RedisError):
+        print(f"Telemetry not recorded: {telemetry_result}")
+    return results
+
+
+def read_telemetry(rc, window, current_time=None) -> dict:
+    """
+    Returns the per-second counts of each metric for the window (seconds) ending with the last complete second,
+    oldest first. All buckets are read in a single HMGET.
+    """
+    end = int(current_time or time())
+    seconds = range(end - window, end)
+    fields = []
+    for metric in TELEMETRY_METRICS:
+        for second in seconds:
+            field = f"{metric}:{second % TELEMETRY_SLOTS}"
+            fields.extend([field, f"{field}:t"])
+    values = rc.hmget(TELEMETRY, fields)
+
+    series = {}
+    for (index, metric) in enumerate(TELEMETRY_METRICS):
+        offset = index * window * 2
+        series[metric] = [
+            int(values[offset + 2 * i] or 0) if values[offset + 2 * i + 1] == str(second) else 0
+            for (i, second) in enumerate(seconds)
+        ]
+    return series
+
+
+def summarize(counts) -> dict:
+    """
+    Returns the total, the rate (per second) and the change of the rate (per second, per second) of a series of
+    per-second counts. The change of the rate is the slope of the least squares line through the counts.
+    """
+    samples = len(counts)
+    total = sum(counts)
+    rate = total / samples
+    mean_second = (samples - 1) / 2
+    variance = sum((second - mean_second) ** 2 for second in range(samples))
+    slope = sum((second - mean_second) * (count - rate) for (second, count) in enumerate(counts)) / variance if variance else 0.0
+    return {"total": total, "rate": round(rate, 3), "rate_change": round(slope, 3)}
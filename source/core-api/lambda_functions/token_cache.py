@@ -0,0 +1,82 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: Apache-2.0
+
+"""
+This module provides the Redis cache of serialized tokens used by the generate token methods.
+Tokens of a request ID are kept in a hash until they expire, with one field per token header variant
+(with or without the key ID). The update_session function marks the hash with the new session status,
+so that repeat calls are rejected without reading the token table.
+Hashes written in a previous reset generation are ignored.
+"""
+
+import json
+from time import time
+from counters import TOKEN_CACHE_PREFIX, RESET_GENERATION
+from generations import GENERATION_ATTRIBUTE, parse_generation
+
+# hash field holding the session status once the session is completed or abandoned
+SESSION_STATUS_FIELD = "session_status"
+
+# seconds the session status is kept when the token expiry is unknown (the token table still has the status)
+SESSION_STATUS_TTL = 3600
+
+
+def token_cache_key(request_id) -> str:
+    """
+    Key of the Redis hash holding the cached tokens of a request ID
+    """
+    return f"{TOKEN_CACHE_PREFIX}:{request_id}"
+
+
+def token_field(is_key_id_in_header) -> str:
+    """
+    Hash field of the token header variant
+    """
+    return "kid" if is_key_id_in_header else "no_kid"
+
+
+def get_cached_tokens(rc, request_id, is_key_id_in_header) -> tuple:
+    """
+    Returns (tokens, session_status) cached for the request ID, either can be None.
+    The hash and the current reset generation are read in a single round trip.
+    """
+    pipe = rc.pipeline(transaction=False)
+    pipe.hmget(token_cache_key(request_id), [token_field(is_key_id_in_header), SESSION_STATUS_FIELD, GENERATION_ATTRIBUTE])
+    pipe.get(RESET_GENERATION)
+    ((tokens, session_status, cached_generation), generation) = pipe.execute()
+    if int(cached_generation or 0) != parse_generation(generation):
+        return (None, None)
+    return (json.loads(tokens) if tokens else None, int(session_status) if session_status else None)
+
+
+def cache_tokens(rc, request_id, is_key_id_in_header, tokens, generation) -> None:
+    """
+    Cache the serialized tokens of the reset generation until they expire.
+    tokens holds access_token, refresh_token, id_token, expires and the kid of the signing key.
+    """
+    pipe = rc.pipeline(transaction=False)
+    queue_cache_tokens(pipe, request_id, is_key_id_in_header, tokens, generation)
+    pipe.execute()
+
+
+def queue_cache_tokens(pipe, request_id, is_key_id_in_header, tokens, generation) -> None:
+    """
+    Queue the caching of the serialized tokens on a pipeline, nothing is queued if they have expired
+    """
+    if tokens['expires'] <= int(time()):
+        return
+    key = token_cache_key(request_id)
+    pipe.hset(key, mapping={token_field(is_key_id_in_header): json.dumps(tokens), GENERATION_ATTRIBUTE: generation})
+    pipe.expireat(key, tokens['expires'])
+
+
+def queue_session_statuses(pipe, statuses, generation) -> None:
+    """
+    Queue on a pipeline the commands that drop the cached tokens and record the session status of each request ID
+    (dict of request ID to status)
+    """
+    for (request_id, status) in statuses.items():
+        key = token_cache_key(request_id)
+        pipe.delete(key)
+        pipe.hset(key, mapping={SESSION_STATUS_FIELD: status, GENERATION_ATTRIBUTE: generation})
+        pipe.expire(key, SESSION_STATUS_TTL)
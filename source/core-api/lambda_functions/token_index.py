@@ -0,0 +1,92 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: Apache-2.0
+
+"""
+This module provides the queries of the token table by expiry time.
+By default tokens are read from EventExpiresIndex, which has a single partition per event.
+If token index sharding is enabled, generate_token also writes an event_shard attribute
+(event ID and a shard number derived from the request ID) and the shards of EventShardExpiresIndex
+are queried concurrently.
+"""
+
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+from boto3.dynamodb.conditions import Key
+
+EVENT_EXPIRES_INDEX = "EventExpiresIndex"
+EVENT_SHARD_EXPIRES_INDEX = "EventShardExpiresIndex"
+
+# maximum number of shards queried at the same time
+MAX_QUERY_WORKERS = 16
+
+
+def token_index_shard(event_id, request_id, shards) -> str:
+    """
+    Returns the event_shard attribute value of a token
+    """
+    return f"{event_id}#{zlib.crc32(request_id.encode('utf-8')) % shards}"
+
+
+def query_token_index(ddb_table, event_id, shards, expires_condition, **query_args) -> list:
+    """
+    Returns the tokens of the event matching the expiry condition (e.g. Key('expires').lt(now)).
+    query_args are passed to every query (ProjectionExpression, FilterExpression, ...).
+    """
+    if shards <= 0:
+        return query_all_pages(ddb_table.query, **index_query_args(event_id, shards, 0, expires_condition), **query_args)
+
+    # the low-level client is thread safe, the table resource is not
+    client = ddb_table.meta.client
+    def query_shard(shard):
+        return query_all_pages(client.query, TableName=ddb_table.name,
+                               **index_query_args(event_id, shards, shard, expires_condition), **query_args)
+
+    items = []
+    with ThreadPoolExecutor(max_workers=min(shards, MAX_QUERY_WORKERS)) as executor:
+        for shard_items in executor.map(query_shard, range(shards)):
+            items.extend(shard_items)
+    return items
+
+
+def query_token_index_page(ddb_table, event_id, shards, expires_condition, limit, position=None, **query_args) -> tuple:
+    """
+    Returns at most limit tokens matching the expiry condition, starting at position, and the
+    position to continue from, or None once all the shards have been read.
+    A position is a (shard, ExclusiveStartKey) tuple. Shards are read one after the other
+    so that the items held by an invocation do not depend on the number of shards.
+    """
+    (shard, start_key) = position if position else (0, None)
+    items = []
+    while len(items) < limit:
+        page_args = dict(query_args, Limit=limit - len(items))
+        if start_key:
+            page_args["ExclusiveStartKey"] = start_key
+        response = ddb_table.query(**index_query_args(event_id, shards, shard, expires_condition), **page_args)
+        items.extend(response.get("Items", []))
+        start_key = response.get("LastEvaluatedKey")
+        if not start_key:
+            shard += 1
+            if shard >= max(shards, 1):
+                return (items, None)
+    return (items, (shard, start_key))
+
+
+def index_query_args(event_id, shards, shard, expires_condition) -> dict:
+    """
+    Returns the index and key condition used to query a shard of the token table expiry index
+    """
+    if shards <= 0:
+        return {"IndexName": EVENT_EXPIRES_INDEX, "KeyConditionExpression": Key('event_id').eq(event_id) & expires_condition}
+    return {"IndexName": EVENT_SHARD_EXPIRES_INDEX, "KeyConditionExpression": Key('event_shard').eq(f"{event_id}#{shard}") & expires_condition}
+
+
+def query_all_pages(query, **query_args) -> list:
+    """
+    Run the query and follow LastEvaluatedKey until all pages are read
+    """
+    response = query(**query_args)
+    items = response.get("Items", [])
+    while "LastEvaluatedKey" in response:
+        response = query(ExclusiveStartKey=response["LastEvaluatedKey"], **query_args)
+        items.extend(response.get("Items", []))
+    return items
@@ -5,6 +5,8 @@
 This module is the update_session API handler.
 It updates the status of a session (token) stored in DynamoDB.
 Session status is denoted by an integer. Sessions set to a status of 1 indicates completed, and -1 indicates abandoned.
+A request body with a sessions list (request_id and status pairs) updates up to 500 sessions at once
+and returns the result of each update.
 Authorization is required to invoke this API.
 """
 
@@ -12,12 +14,18 @@ import redis
 import json
 import boto3
 import os
+from concurrent.futures import ThreadPoolExecutor
 from botocore.exceptions import ClientError
 from botocore import config
 from boto3.dynamodb.conditions import Attr
 from counters import COMPLETED_SESSION_COUNTER, ABANDONED_SESSION_COUNTER
+from token_cache import queue_session_statuses
+from generations import get_generation, generation_event_id
+from active_tokens import remove_active_token, remove_active_tokens
+from telemetry import RECORD_TELEMETRY_SCRIPT, SESSIONS_UPDATED, execute_with_telemetry
 from vwr.common.sanitize import deep_clean
 from vwr.common.validate import is_valid_rid
+from vwr.common.events import EventPublisher
 
 # connection info and other globals
 REDIS_HOST = os.environ["REDIS_HOST"]
@@ -28,6 +36,10 @@ DDB_TOKEN_TABLE_NAME = os.environ["TOKEN_TABLE"]
 SOLUTION_ID = os.environ['SOLUTION_ID']
 SECRET_NAME_PREFIX = os.environ["STACK_NAME"]
 
+# maximum number of sessions in a batch update and number of concurrent conditional updates
+MAX_BATCH_SESSIONS = 500
+MAX_UPDATE_WORKERS = 16
+
 user_agent_extra = {"user_agent_extra": SOLUTION_ID}
 user_config = config.Config(**user_agent_extra)
 boto_session = boto3.session.Session()
@@ -35,11 +47,15 @@ region = boto_session.region_name
 ddb_resource = boto3.resource('dynamodb', endpoint_url=f"https://dynamodb.{region}.amazonaws.com", config=user_config)
 ddb_table = ddb_resource.Table(DDB_TOKEN_TABLE_NAME)
 events_client = boto3.client('events', endpoint_url=f"https://events.{region}.amazonaws.com", config=user_config)
+event_publisher = EventPublisher(events_client, EVENT_BUS_NAME)
+batch_event_publisher = EventPublisher(events_client, EVENT_BUS_NAME, deferred=True)
 status_codes = {1: "completed", -1: "abandoned"}
+status_counters = {1: COMPLETED_SESSION_COUNTER, -1: ABANDONED_SESSION_COUNTER}
 secrets_client = boto3.client('secretsmanager', config=user_config, endpoint_url=f"https://secretsmanager.{region}.amazonaws.com")
 response = secrets_client.get_secret_value(SecretId=f"{SECRET_NAME_PREFIX}/redis-auth")
 redis_auth = response.get("SecretString")
 rc = redis.Redis(host=REDIS_HOST, port=REDIS_PORT, ssl=True, decode_responses=True, password=redis_auth)
+record_telemetry_script = rc.register_script(RECORD_TELEMETRY_SCRIPT)
 
 def lambda_handler(event, _):
     """
@@ -48,46 +64,41 @@ def lambda_handler(event, _):
 
     print(event)
     body = json.loads(event['body'])
-    request_id = deep_clean(body['request_id'])
-    client_event_id = deep_clean(body['event_id'])
-    status = int(body['status'])
     headers = {
         'Content-Type': 'application/json',
         'Access-Control-Allow-Origin': '*'
     }
+    if 'sessions' in body:
+        return update_sessions_batch(body, headers)
+
+    request_id = deep_clean(body['request_id'])
+    client_event_id = deep_clean(body['event_id'])
+    status = int(body['status'])
 
     if client_event_id == EVENT_ID and is_valid_rid(request_id):
         try:
-            result = ddb_table.update_item(
-                UpdateExpression='SET session_status = :status',
-                ConditionExpression=(Attr('request_id').eq(request_id) and Attr('session_status').eq(0)),
-                Key={'request_id': request_id},
-                ExpressionAttributeValues={':status': status}
-            )
+            generation = get_generation(rc)
+            result = set_session_status(ddb_table.update_item, request_id, status, generation_event_id(EVENT_ID, generation))
             response = {
                 "statusCode": 200,
                 "headers": headers,
                 "body": json.dumps(result)
             }
+            # invalidate the tokens cached by generate_token, deactivate the token, increment the counter
+            # tracking sessions completed or abandoned and record the telemetry in a single round trip
+            pipe = rc.pipeline()
+            queue_session_statuses(pipe, {request_id: status}, generation)
+            remove_active_token(pipe, request_id)
+            if status in status_counters:
+                pipe.incr(status_counters[status], 1)
+            execute_with_telemetry(pipe, record_telemetry_script, {SESSIONS_UPDATED: 1})
             # write to event bus
-            events_client.put_events(
-                Entries=[
-                    {
-                        'Source': 'custom.waitingroom',
-                        'DetailType': 'session_updated',
-                        'Detail': json.dumps({"event_id": EVENT_ID,
-                                              "request_id": request_id,
-                                              "status": status_codes[status]}),
-                        'EventBusName': EVENT_BUS_NAME
-                    }
-                ]
+            event_publisher.publish(
+                'session_updated',
+                {"event_id": EVENT_ID,
+                 "request_id": request_id,
+                 "status": status_codes[status]}
             )
-            # increment counter tracking sessions completed
-            if status == -1:
-                rc.incr(ABANDONED_SESSION_COUNTER, 1)
-
-            elif status == 1:
-                rc.incr(COMPLETED_SESSION_COUNTER, 1)
         except ClientError as e:
             if e.response['Error']['Code'] != 'ConditionalCheckFailedException':
                 raise e
@@ -109,3 +120,100 @@ def lambda_handler(event, _):
         }
     print(response)
     return response
+
+
+def set_session_status(update_item, request_id, status, event_key, **table_args) -> dict:
+    """
+    Set the status of a session of the current reset generation (event_key) that has not been completed or abandoned yet.
+    Raises ClientError (ConditionalCheckFailedException) if the session doesn't exist or its status is already set.
+    """
+    return update_item(
+        UpdateExpression='SET session_status = :status',
+        ConditionExpression=(Attr('request_id').eq(request_id) & Attr('event_id').eq(event_key) & Attr('session_status').eq(0)),
+        Key={'request_id': request_id},
+        ExpressionAttributeValues={':status': status},
+        **table_args
+    )
+
+
+def update_sessions_batch(body, headers) -> dict:
+    """
+    Update the status of each session in the sessions list.
+    The conditional updates run concurrently, the session counters are incremented once per status
+    and the session_updated events are written in batches.
+    """
+    client_event_id = deep_clean(body['event_id'])
+    sessions = body['sessions']
+    if client_event_id != EVENT_ID or not isinstance(sessions, list) or len(sessions) > MAX_BATCH_SESSIONS:
+        response = {
+            "statusCode": 400,
+            "headers": headers,
+            "body": json.dumps({"error": f"Invalid event ID or more than {MAX_BATCH_SESSIONS} sessions"})
+        }
+        print(response)
+        return response
+
+    results = [update_result(session) for session in sessions]
+    valid_results = [result for result in results if result["result"] is None]
+    generation = get_generation(rc)
+    event_key = generation_event_id(EVENT_ID, generation)
+    # the low-level client is thread safe, the table resource is not
+    client = ddb_table.meta.client
+    def update_one(result):
+        try:
+            set_session_status(client.update_item, result["request_id"], result["status"], event_key, TableName=ddb_table.name)
+            result["result"] = "updated"
+        except ClientError as e:
+            print(e)
+            not_found = e.response['Error']['Code'] == 'ConditionalCheckFailedException'
+            result["result"] = "not_found" if not_found else "error"
+        except Exception as e:
+            # e.g. connection errors or throttling retries exhausted, the other sessions are still updated
+            print(e)
+            result["result"] = "error"
+    if valid_results:
+        with ThreadPoolExecutor(max_workers=min(len(valid_results), MAX_UPDATE_WORKERS)) as executor:
+            list(executor.map(update_one, valid_results))
+
+    updated = {result["request_id"]: result["status"] for result in results if result["result"] == "updated"}
+    if updated:
+        # invalidate the tokens cached by generate_token, deactivate the tokens, increment the counters
+        # tracking sessions completed and abandoned and record the telemetry in a single round trip
+        pipe = rc.pipeline()
+        queue_session_statuses(pipe, updated, generation)
+        remove_active_tokens(pipe, list(updated))
+        for (status, counter) in status_counters.items():
+            count = sum(1 for updated_status in updated.values() if updated_status == status)
+            if count:
+                pipe.incrby(counter, count)
+        execute_with_telemetry(pipe, record_telemetry_script, {SESSIONS_UPDATED: len(updated)})
+        for (request_id, status) in updated.items():
+            batch_event_publisher.publish(
+                'session_updated',
+                {"event_id": EVENT_ID,
+                 "request_id": request_id,
+                 "status": status_codes[status]}
+            )
+        batch_event_publisher.flush()
+
+    response = {
+        "statusCode": 200,
+        "headers": headers,
+        "body": json.dumps({"results": [{"request_id": result["request_id"], "result": result["result"]} for result in results]})
+    }
+    print(response)
+    return response
+
+
+def update_result(session) -> dict:
+    """
+    Returns the validated request ID and status of a session in a batch update.
+    The result is set to invalid if either is not valid.
+    """
+    try:
+        request_id = deep_clean(session['request_id'])
+        status = int(session['status'])
+    except (KeyError, TypeError, ValueError):
+        return {"request_id": None, "status": None, "result": "invalid"}
+    valid = is_valid_rid(request_id) and status in status_codes
+    return {"request_id": request_id, "status": status, "result": None if valid else "invalid"}
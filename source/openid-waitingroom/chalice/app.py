@@ -225,7 +225,8 @@ def openid_configuration():
     return {
         "authorization_endpoint":
         f"{issuer}/authorize",
-        "id_token_signing_alg_values_supported": ["RS256"],
+        "id_token_signing_alg_values_supported":
+        [get_public_jwk().get("alg", "RS256")],
         "issuer":
         f"{issuer}",
         "jwks_uri":
@@ -250,6 +251,13 @@ def jwks_json():
     """
     app.log.info('/.well-known/jwks.json')
     app.log.info(app.current_request.to_dict())
+    return {"keys": [get_public_jwk()]}
+
+
+def get_public_jwk():
+    """
+    This function retrieves the waiting room public key from the public API
+    """
     public_jwk = {}
     public_api = f'{PUBLIC_API_ENDPOINT}/public_key?event_id={WAITING_ROOM_EVENT_ID}'
     try:
@@ -258,4 +266,4 @@ def jwks_json():
             public_jwk = json.loads(response.text)
     except (OSError, RuntimeError):
         print_exception()
-    return {"keys": [public_jwk]}
+    return public_jwk
@@ -23,6 +23,8 @@ CORE_API_ENDPOINT = os.environ.get("CORE_API_ENDPOINT")
 CORE_API_REGION = os.environ.get("CORE_API_REGION")
 MAX_SIZE = int(os.environ.get("MAX_SIZE"))
 TIMEOUT = 60
+# maximum number of sessions accepted by a single update_session call
+UPDATE_BATCH_SIZE = 500
 
 increment_by_api = f'{CORE_API_ENDPOINT}/increment_serving_counter'
 update_status_api = f'{CORE_API_ENDPOINT}/update_session'
@@ -89,19 +91,21 @@ def lambda_handler(event, _):
 
 def update_tokens(status, request_ids, auth):
     """
-    This function is responsible for updating the status of a token via the API
+    This function is responsible for updating the status of tokens via the API,
+    UPDATE_BATCH_SIZE request IDs per call
     """
 
     global num_updated_tokens
     print(f"number of status {status}: {len(request_ids)}")
 
-    body = {
-        "event_id": EVENT_ID,
-        "status": status
-    }
-    for request_id in request_ids:
-        body["request_id"] = request_id
+    for start in range(0, len(request_ids), UPDATE_BATCH_SIZE):
+        body = {
+            "event_id": EVENT_ID,
+            "sessions": [{"request_id": request_id, "status": status}
+                         for request_id in request_ids[start:start + UPDATE_BATCH_SIZE]]
+        }
         response = requests.post(update_status_api, json=body, auth=auth, timeout=TIMEOUT)
         if response.status_code == 200:
-            num_updated_tokens += 1
+            results = response.json()["results"]
+            num_updated_tokens += sum(1 for result in results if result["result"] == "updated")
         print(response.content.decode())
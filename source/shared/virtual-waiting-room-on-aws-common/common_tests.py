@@ -6,11 +6,14 @@ This module is the unit test for the shared functions.
 """
 
 import os
+import threading
+import time
 import unittest
+from unittest.mock import MagicMock, patch
 
 os.environ["SOLUTION_ID"] = "SO12345"
 
-from vwr.common import diag, jwt, sanitize, validate
+from vwr.common import diag, events, jwt, sanitize, validate
 
 class CommonTest(unittest.TestCase):
     """
@@ -82,6 +85,64 @@ class CommonTest(unittest.TestCase):
         expected = {'sub': '1234567890', 'name': 'Mary Jane', 'iat': 1516239022 }
         self.assertNotEqual(payload, expected)
 
-
-if __name__ == "__main":
+    def test_event_publisher(self):
+        """
+        Tests batching and retries of the event publisher
+        """
+        events_client = MagicMock()
+        events_client.put_events.return_value = {'FailedEntryCount': 0, 'Entries': []}
+
+        # events are sent as they are published
+        publisher = events.EventPublisher(events_client, "bus")
+        publisher.publish("token_generated", {"request_id": "1"})
+        events_client.put_events.assert_called_once()
+        entry = events_client.put_events.call_args.kwargs['Entries'][0]
+        self.assertEqual(entry['DetailType'], "token_generated")
+        self.assertEqual(entry['EventBusName'], "bus")
+
+        # deferred events are sent in batches of 10
+        events_client.reset_mock()
+        publisher = events.EventPublisher(events_client, "bus", deferred=True)
+        for request_id in range(12):
+            publisher.publish("token_generated", {"request_id": request_id})
+        self.assertEqual(events_client.put_events.call_count, 1)
+        publisher.flush()
+        self.assertEqual(events_client.put_events.call_count, 2)
+        self.assertEqual(len(events_client.put_events.call_args.kwargs['Entries']), 2)
+
+        # failed entries are retried
+        events_client.reset_mock()
+        events_client.put_events.side_effect = [
+            {'FailedEntryCount': 1, 'Entries': [{'EventId': '1'}, {'ErrorCode': 'InternalFailure'}]},
+            {'FailedEntryCount': 0, 'Entries': [{'EventId': '2'}]}
+        ]
+        publisher.publish("token_generated", {"request_id": "1"})
+        publisher.publish("token_generated", {"request_id": "2"})
+        with patch.object(events.time, 'sleep'):
+            publisher.flush()
+        self.assertEqual(events_client.put_events.call_count, 2)
+        self.assertEqual(events_client.put_events.call_args.kwargs['Entries'][0]['Detail'], '{"request_id": "2"}')
+
+        # asynchronous events are sent by the worker thread, flush waits until they are sent
+        events_client.reset_mock()
+        sent = threading.Event()
+        def put_events(**_):
+            time.sleep(0.1)
+            sent.set()
+            return {'FailedEntryCount': 0, 'Entries': []}
+        events_client.put_events.side_effect = put_events
+        publisher = events.EventPublisher(events_client, "bus", asynchronous=True)
+        publisher.publish("token_generated", {"request_id": "1"})
+        publisher.flush()
+        self.assertTrue(sent.is_set())
+        events_client.put_events.assert_called_once()
+
+        # a failed asynchronous send does not fail the caller
+        events_client.put_events.side_effect = ConnectionError
+        publisher.publish("token_generated", {"request_id": "2"})
+        publisher.flush()
+        self.assertEqual(publisher.pending, [])
+
+
+if __name__ == "__main__":
     unittest.main()
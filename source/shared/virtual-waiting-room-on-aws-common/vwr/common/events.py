@@ -0,0 +1,112 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: Apache-2.0
+"""
+This module provides a buffered publisher for the events written to the waiting room event bus.
+"""
+
+import json
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, wait
+
+# maximum number of entries accepted by a single PutEvents call
+MAX_PUT_EVENTS_ENTRIES = 10
+
+# number of PutEvents calls made for a batch before giving up on its failed entries
+MAX_PUT_EVENTS_ATTEMPTS = 3
+
+# base delay (seconds) for the exponential backoff between retries of failed entries
+RETRY_BASE_DELAY = 0.05
+
+EVENT_SOURCE = "custom.waitingroom"
+
+
+class EventPublisher:
+    """
+    Publishes waiting room events to an EventBridge bus in batches of up to 10 entries.
+
+    By default each event is sent as soon as it is published. With deferred=True, events are
+    buffered until flush() is called (typically at the end of the invocation) or a full batch
+    is available. With asynchronous=True, events are sent by a worker thread while the caller
+    goes on, and flush() waits until they are sent. Handlers must call flush() before they return,
+    as the execution environment may be frozen with the worker thread still running.
+    """
+
+    def __init__(self, events_client, event_bus_name, deferred=False, asynchronous=False):
+        self.events_client = events_client
+        self.event_bus_name = event_bus_name
+        self.deferred = deferred
+        self.asynchronous = asynchronous
+        self.entries = []
+        self.lock = threading.Lock()
+        self.executor = ThreadPoolExecutor(max_workers=1) if asynchronous else None
+        self.pending = []
+
+    def publish(self, detail_type, detail) -> None:
+        """
+        Publish an event with the given detail type and detail (dict)
+        """
+        entry = {
+            'Source': EVENT_SOURCE,
+            'DetailType': detail_type,
+            'Detail': json.dumps(detail),
+            'EventBusName': self.event_bus_name
+        }
+        with self.lock:
+            self.entries.append(entry)
+            if self.asynchronous:
+                self.pending.append(self.executor.submit(self._send_buffered))
+                return
+            if self.deferred and len(self.entries) < MAX_PUT_EVENTS_ENTRIES:
+                return
+            entries = self.entries
+            self.entries = []
+        self._send(entries)
+
+    def flush(self) -> None:
+        """
+        Send the buffered events. In asynchronous mode, wait until the worker thread has sent them.
+        """
+        if self.asynchronous:
+            with self.lock:
+                pending = self.pending
+                self.pending = []
+            for future in wait(pending).done:
+                if future.exception():
+                    print(f'Failed to write events to {self.event_bus_name}: {future.exception()}')
+            return
+
+        with self.lock:
+            entries = self.entries
+            self.entries = []
+        self._send(entries)
+
+    def _send(self, entries) -> None:
+        for start in range(0, len(entries), MAX_PUT_EVENTS_ENTRIES):
+            self._send_batch(entries[start:start + MAX_PUT_EVENTS_ENTRIES])
+
+    def _send_batch(self, batch) -> None:
+        """
+        Send a batch of at most 10 entries and retry the failed entries with exponential backoff
+        """
+        attempt = 0
+        while batch:
+            response = self.events_client.put_events(Entries=batch)
+            attempt += 1
+            if not response.get('FailedEntryCount'):
+                return
+            # result entries are in the same order as the request entries
+            batch = [entry for (entry, result) in zip(batch, response['Entries']) if 'ErrorCode' in result]
+            if attempt >= MAX_PUT_EVENTS_ATTEMPTS:
+                break
+            time.sleep(RETRY_BASE_DELAY * (2 ** attempt))
+        print(f'{len(batch)} events not written to {self.event_bus_name}: {batch}')
+
+    def _send_buffered(self) -> None:
+        """
+        Send the events buffered in asynchronous mode, events published meanwhile are sent together
+        """
+        with self.lock:
+            entries = self.entries
+            self.entries = []
+        self._send(entries)
@@ -5,13 +5,15 @@ This module contains the Lambda authorizers that
 can be integrated with solutions for the Waiting Room.
 """
 
+import hashlib
 import json
-import os.path
+import os
 import time
+from collections import OrderedDict
 
 import requests
 from jwcrypto import jwk, jwt
-from jwcrypto.common import JWException
+from jwcrypto.common import JWException, base64url_decode, json_decode
 from vwr.common.diag import print_exception
 from chalice import Chalice, Response
 
@@ -21,31 +23,92 @@ WAITING_ROOM_EVENT_ID = os.environ.get("WAITING_ROOM_EVENT_ID")
 PUBLIC_API_ENDPOINT = os.environ.get("PUBLIC_API_ENDPOINT")
 ISSUER = os.environ.get("ISSUER")
 
+# seconds the public keys are used before they are fetched again
+PUBLIC_KEY_CACHE_SECONDS = 300
+
+# seconds the public key API is not called again after a failed fetch
+PUBLIC_KEY_RETRY_SECONDS = 30
+
+# minimum seconds between fetches caused by tokens signed with an unknown key ID
+PUBLIC_KEY_MIN_REFRESH_SECONDS = 10
+
+# maximum number of tokens whose verified claims are cached
+VERIFIED_CLAIMS_CACHE_SIZE = 10000
+
+# verified claims indexed by the SHA-256 digest of the token, least recently used first,
+# kept for the life of the execution environment
+verified_claims_cache = OrderedDict()
+
+# public keys (JWK objects and their algorithm) indexed by key ID, when they were fetched
+# and when a fetch may be retried after a failure, kept for the life of the execution environment
+public_key_cache = {}
+
 
 def get_public_key():
     """
     This function is responsible for retrieving the
-    public JWK from the closest location
-    """
-    # Bandit B108: /tmp directory is ephemeral as this is ran on Lambda
-    local_key_file = "/tmp/jwks.json" # nosec
-    key = {}
-    if os.path.isfile(local_key_file):
-        # retrieve from the local file
-        with open(local_key_file, 'rt', encoding='utf-8') as cache_file:
-            key = json.loads(cache_file.read())
-    else:
-        # retrieve from the core API
-        api_endpoint = f'{PUBLIC_API_ENDPOINT}/public_key?event_id={WAITING_ROOM_EVENT_ID}'
-        try:
-            response = requests.get(api_endpoint, timeout=60)
-            if response.status_code == 200:
-                with open(local_key_file, 'wt', encoding='utf-8') as cache_file:
-                    cache_file.write(response.text)
-                key = json.loads(response.text)
-        except (OSError, RuntimeError):
-            print_exception()
-    return key
+    public JWK (or JWK set) from the core API
+    """
+    api_endpoint = f'{PUBLIC_API_ENDPOINT}/public_key?event_id={WAITING_ROOM_EVENT_ID}'
+    try:
+        response = requests.get(api_endpoint, timeout=60)
+        if response.status_code == 200:
+            return json.loads(response.text)
+        print(f'public key request failed with status {response.status_code}')
+    except (OSError, RuntimeError, ValueError):
+        print_exception()
+    return {}
+
+
+def load_public_keys():
+    """
+    This function is responsible for retrieving the public keys and
+    returning them as JWK objects and algorithms indexed by key ID
+    """
+    key_set = get_public_key()
+    keys = {}
+    try:
+        for key_dict in key_set.get('keys', [key_set] if key_set else []):
+            keys[key_dict.get('kid')] = (jwk.JWK(**key_dict), key_dict.get('alg', 'RS256'))
+    except (JWException, TypeError, ValueError):
+        print_exception()
+        return {}
+    return keys
+
+
+def get_public_keys(kid=None):
+    """
+    This function is responsible for returning the cached public keys indexed by key ID.
+    The keys are fetched again when they are older than PUBLIC_KEY_CACHE_SECONDS or, at most every
+    PUBLIC_KEY_MIN_REFRESH_SECONDS, when kid is not one of them (the key may have been rotated).
+    Failed fetches are not retried for PUBLIC_KEY_RETRY_SECONDS, the keys fetched last are used meanwhile.
+    """
+    current_time = time.time()
+    keys = public_key_cache.get('keys', {})
+    expired = current_time - public_key_cache.get('fetched_at', 0) >= PUBLIC_KEY_CACHE_SECONDS
+    unknown = kid is not None and kid not in keys and \
+        current_time - public_key_cache.get('fetched_at', 0) >= PUBLIC_KEY_MIN_REFRESH_SECONDS
+    if (expired or unknown) and current_time >= public_key_cache.get('retry_at', 0):
+        loaded_keys = load_public_keys()
+        if loaded_keys:
+            public_key_cache.update({'keys': loaded_keys, 'fetched_at': current_time, 'retry_at': 0})
+            keys = loaded_keys
+        else:
+            public_key_cache['retry_at'] = current_time + PUBLIC_KEY_RETRY_SECONDS
+    return keys
+
+
+def get_token_key_id(token):
+    """
+    This function is responsible for returning the key ID in the
+    (unverified) header of a JWT token, or None
+    """
+    try:
+        header = json_decode(base64url_decode(token.split('.')[0]))
+    except (ValueError, TypeError):
+        return None
+    kid = header.get('kid') if isinstance(header, dict) else None
+    return kid if isinstance(kid, str) else None
 
 
 def verify_token_sig(token):
@@ -53,17 +116,26 @@ def verify_token_sig(token):
     This function is responsible for verifying a JWT token against public keys and returning
     verified claims within the token or False
     """
-    # get the public JWK dictionary
-    pubkey_dict = get_public_key()
-    # recreate the token with public key verification
-    try:
-        key = jwk.JWK(**pubkey_dict)
-        verified = jwt.JWT(key=key, jwt=token)
-        return json.loads(verified.claims)
-    except JWException:
-        # signature is invalid or token has expired
-        print_exception()
+    # get the public key the token was signed with, tokens without key ID are checked against every key
+    kid = get_token_key_id(token)
+    keys = get_public_keys(kid)
+    if kid is not None:
+        candidates = [keys[kid]] if kid in keys else []
+    else:
+        candidates = list(keys.values())
+    if not candidates:
+        print('no public key for the token')
         return False
+    # recreate the token with public key verification
+    for (key, alg) in candidates:
+        try:
+            # only accept the algorithm the key was generated for
+            verified = jwt.JWT(key=key, jwt=token, algs=[alg])
+            return json.loads(verified.claims)
+        except (JWException, ValueError):
+            # token is malformed, signature is invalid or token has expired
+            print_exception()
+    return False
 
 
 def verify_token(token, use='access'):
@@ -94,6 +166,30 @@ def verify_token(token, use='access'):
     return False
 
 
+def get_verified_claims(token):
+    """
+    This function is responsible for returning the claims of a valid access token or False.
+    Tokens verified earlier are looked up by their digest until they expire,
+    so their signature is checked only once.
+    """
+    digest = hashlib.sha256(token.encode('utf-8')).digest()
+    claims = verified_claims_cache.get(digest)
+    if claims is not None:
+        if time.time() <= claims['exp']:
+            verified_claims_cache.move_to_end(digest)
+            return claims
+        del verified_claims_cache[digest]
+        print('token is expired')
+        return False
+
+    claims = verify_token(token)
+    if claims:
+        verified_claims_cache[digest] = claims
+        while len(verified_claims_cache) > VERIFIED_CLAIMS_CACHE_SIZE:
+            verified_claims_cache.popitem(last=False)
+    return claims
+
+
 def check_authorizer_token(token, resource):
     """
     This function is responsible for checking tokens and
@@ -112,7 +208,7 @@ def check_authorizer_token(token, resource):
         "Resource": resource
     }
     response["policyDocument"]["Statement"].append(statement)
-    claims = verify_token(token)
+    claims = get_verified_claims(token)
     if claims:
         principal_id = claims.get("sub", 'approved')
         response["principalId"] = principal_id
@@ -68,6 +68,7 @@ class TestInletStrategies(unittest.TestCase):
         Test the get_public_key function
         """
         import app
+        app.public_key_cache.clear()
         app.get_public_key()
 
     @patch('app.get_public_key', new=get_public_key)
@@ -77,6 +78,7 @@ class TestInletStrategies(unittest.TestCase):
         Test the verify_token_sig function
         """
         import app
+        app.public_key_cache.clear()
         app.verify_token_sig(TESTING_TOKEN)
 
     @patch('app.get_public_key', new=get_public_key)
@@ -86,6 +88,7 @@ class TestInletStrategies(unittest.TestCase):
         Test the verify_token function
         """
         import app
+        app.public_key_cache.clear()
         app.verify_token(TESTING_TOKEN)
 
     @patch('app.get_public_key', new=get_public_key)
@@ -95,6 +98,7 @@ class TestInletStrategies(unittest.TestCase):
         Test the check_authorizer_token function
         """
         import app
+        app.public_key_cache.clear()
         app.check_authorizer_token(TESTING_TOKEN, "/")
 
     @patch('app.get_public_key', new=get_public_key)
@@ -104,6 +108,7 @@ class TestInletStrategies(unittest.TestCase):
         Test the api_gateway_authorizer function
         """
         import app
+        app.public_key_cache.clear()
         app.api_gateway_authorizer(
             {
                 'authorizationToken':
@@ -112,6 +117,121 @@ class TestInletStrategies(unittest.TestCase):
                 "arn:aws:execute-api:us-east-1:0123456789012:pvb6r6th3e/*/GET/expired_tokens"
             }, {})
 
+    def test_verify_token_sig_algorithms(self, patched_resource, patched_client,
+                                         patched_post, patched_get):
+        """
+        Test the verify_token_sig function with the supported signing algorithms
+        """
+        import app
+        app.public_key_cache.clear()
+        from jwcrypto import jwk, jwt
+        for (alg, key_parameters) in [('ES256', {'kty': 'EC', 'crv': 'P-256'}),
+                                      ('EdDSA', {'kty': 'OKP', 'crv': 'Ed25519'})]:
+            keypair = jwk.JWK.generate(kid=alg, alg=alg, **key_parameters)
+            token = jwt.JWT(header={"alg": alg, "typ": "JWT", "kid": alg},
+                            claims={"sub": "request_id"})
+            token.make_signed_token(keypair)
+            public_key = keypair.export_public(as_dict=True)
+            with patch('app.get_public_key', return_value=public_key):
+                self.assertEqual(app.verify_token_sig(token.serialize()),
+                                 {"sub": "request_id"})
+            # tokens signed with another algorithm than the key's are rejected
+            public_key['alg'] = 'RS256'
+            app.public_key_cache.clear()
+            with patch('app.get_public_key', return_value=public_key):
+                self.assertFalse(app.verify_token_sig(token.serialize()))
+            app.public_key_cache.clear()
+
+    def test_public_key_cache(self, patched_resource, patched_client,
+                              patched_post, patched_get):
+        """
+        Test the public keys cached by get_public_keys
+        """
+        import app
+        app.public_key_cache.clear()
+        kid = json.loads(TESTING_PUBLIC_KEY)["kid"]
+        with patch('app.get_public_key', side_effect=get_public_key) as mock_get_public_key, \
+                patch('app.time.time', return_value=1000):
+            # the key is fetched once and reused
+            self.assertEqual(list(app.get_public_keys(kid)), [kid])
+            app.verify_token_sig(TESTING_TOKEN)
+            self.assertEqual(mock_get_public_key.call_count, 1)
+
+            # an unknown key ID is fetched again, at most every PUBLIC_KEY_MIN_REFRESH_SECONDS
+            app.get_public_keys("rotated")
+            self.assertEqual(mock_get_public_key.call_count, 1)
+            app.time.time.return_value = 1000 + app.PUBLIC_KEY_MIN_REFRESH_SECONDS
+            app.get_public_keys("rotated")
+            self.assertEqual(mock_get_public_key.call_count, 2)
+
+            # the keys are fetched again when they expire
+            app.time.time.return_value = 1010 + app.PUBLIC_KEY_CACHE_SECONDS
+            app.get_public_keys(kid)
+            self.assertEqual(mock_get_public_key.call_count, 3)
+
+        # failed fetches are not retried for PUBLIC_KEY_RETRY_SECONDS, the last keys are kept
+        with patch('app.get_public_key', return_value={}) as mock_get_public_key, \
+                patch('app.time.time', return_value=2000 + app.PUBLIC_KEY_CACHE_SECONDS):
+            self.assertEqual(list(app.get_public_keys(kid)), [kid])
+            app.get_public_keys("rotated")
+            self.assertEqual(mock_get_public_key.call_count, 1)
+            app.time.time.return_value += app.PUBLIC_KEY_RETRY_SECONDS
+            app.get_public_keys(kid)
+            self.assertEqual(mock_get_public_key.call_count, 2)
+
+        # key sets are indexed by key ID
+        app.public_key_cache.clear()
+        with patch('app.get_public_key', return_value={"keys": [get_public_key()]}):
+            self.assertEqual(list(app.get_public_keys()), [kid])
+        app.public_key_cache.clear()
+
+    def test_verified_claims_cache(self, patched_resource, patched_client,
+                                   patched_post, patched_get):
+        """
+        Test the verified claims cached by get_verified_claims
+        """
+        import app
+        from jwcrypto import jwk, jwt
+        app.public_key_cache.clear()
+        app.verified_claims_cache.clear()
+        keypair = jwk.JWK.generate(kid="cache", alg="ES256", kty="EC", crv="P-256")
+        tokens = []
+        for subject in ["first", "second"]:
+            token = jwt.JWT(header={"alg": "ES256", "typ": "JWT", "kid": "cache"},
+                            claims={"sub": subject, "aud": app.WAITING_ROOM_EVENT_ID,
+                                    "iss": app.ISSUER, "token_use": "access",
+                                    "exp": 2000})
+            token.make_signed_token(keypair)
+            tokens.append(token.serialize())
+        public_key = keypair.export_public(as_dict=True)
+        with patch('app.get_public_key', return_value=public_key), \
+                patch('app.time.time', return_value=1000), \
+                patch('app.verify_token_sig', wraps=app.verify_token_sig) as mock_verify, \
+                patch('app.VERIFIED_CLAIMS_CACHE_SIZE', 1):
+            # the signature is verified once per token
+            response = app.check_authorizer_token(tokens[0], "/")
+            self.assertEqual(response["principalId"], "first")
+            response = app.check_authorizer_token(tokens[0], "/")
+            self.assertEqual(response["policyDocument"]["Statement"][0]["Effect"], "Allow")
+            self.assertEqual(mock_verify.call_count, 1)
+
+            # least recently used tokens are evicted
+            app.check_authorizer_token(tokens[1], "/")
+            self.assertEqual(len(app.verified_claims_cache), 1)
+            app.check_authorizer_token(tokens[0], "/")
+            self.assertEqual(mock_verify.call_count, 3)
+
+            # cached tokens are denied once expired
+            app.time.time.return_value = 2001
+            response = app.check_authorizer_token(tokens[0], "/")
+            self.assertEqual(response["policyDocument"]["Statement"][0]["Effect"], "Deny")
+            self.assertEqual(len(app.verified_claims_cache), 0)
+
+            # invalid tokens are not cached
+            app.check_authorizer_token("invalid", "/")
+            self.assertEqual(len(app.verified_claims_cache), 0)
+        app.public_key_cache.clear()
+
 
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,81 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: Apache-2.0
+
+"""
+This module measures the authorizations per second of the token authorizer
+(check_authorizer_token) with and without the verified claims cache.
+The same RS256 access token is authorized repeatedly, like a client calling
+a protected API several times with the token it was issued.
+
+Usage: python authorizer_cache_benchmark.py [iterations]
+"""
+
+import contextlib
+import io
+import os
+import sys
+import time
+import uuid
+
+from jwcrypto import jwk, jwt
+
+EVENT_ID = "Sample"
+ISSUER = "https://example.com"
+
+os.environ["WAITING_ROOM_EVENT_ID"] = EVENT_ID
+os.environ["ISSUER"] = ISSUER
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "token-authorizer", "chalice"))
+
+import app  # pylint: disable=C0413
+
+ITERATIONS = int(sys.argv[1]) if len(sys.argv) > 1 else 1000
+CACHE_SIZE = app.VERIFIED_CLAIMS_CACHE_SIZE
+
+
+def sample_token(keypair):
+    """
+    Returns an access token shaped like the ones issued by the generate_token API
+    """
+    issued_at = int(time.time())
+    token = jwt.JWT(
+        header={"alg": "RS256", "typ": "JWT", "kid": keypair.get("kid")},
+        claims={
+            "aud": EVENT_ID,
+            "sub": str(uuid.uuid4()),
+            "queue_position": 1,
+            "token_use": "access",
+            "iat": issued_at,
+            "nbf": issued_at,
+            "exp": issued_at + 3600,
+            "iss": ISSUER
+        }
+    )
+    token.make_signed_token(keypair)
+    return token.serialize()
+
+
+def benchmark(label, token, cache_size):
+    """
+    Authorize the token ITERATIONS times and print the authorizations per second
+    """
+    app.VERIFIED_CLAIMS_CACHE_SIZE = cache_size
+    app.verified_claims_cache.clear()
+    # the authorizer logs every policy, keep it out of the measurement output
+    with contextlib.redirect_stdout(io.StringIO()):
+        start = time.perf_counter()
+        for _ in range(ITERATIONS):
+            response = app.check_authorizer_token(token, "arn:aws:execute-api:us-east-1:123456789012:api/*/*/*")
+        seconds = time.perf_counter() - start
+    assert response["policyDocument"]["Statement"][0]["Effect"] == "Allow"
+    print(f"{label:14} {ITERATIONS / seconds:10.0f} authorizations/s")
+
+
+if __name__ == "__main__":
+    rsa_keypair = jwk.JWK.generate(kid=str(uuid.uuid4()), alg="RS256", kty="RSA", size=2048)
+    # serve the public key from memory instead of the public_key API
+    app.get_public_key = lambda: rsa_keypair.export_public(as_dict=True)
+    access_token = sample_token(rsa_keypair)
+
+    print(f"{ITERATIONS} authorizations of the same token")
+    benchmark("without cache", access_token, 0)
+    benchmark("with cache", access_token, CACHE_SIZE)
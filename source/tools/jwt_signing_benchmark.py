@@ -0,0 +1,73 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: Apache-2.0
+
+"""
+This module measures the token signing and verification throughput
+of the key algorithms supported by the waiting room (KeyAlgorithm parameter).
+The token claims match the ones issued by the generate_token API.
+
+Usage: python jwt_signing_benchmark.py [iterations]
+"""
+
+import sys
+import time
+import uuid
+
+from jwcrypto import jwk, jwt
+
+KEY_PARAMETERS = {
+    "RS256": {"kty": "RSA", "size": 2048},
+    "ES256": {"kty": "EC", "crv": "P-256"},
+    "EdDSA": {"kty": "OKP", "crv": "Ed25519"}
+}
+
+ITERATIONS = int(sys.argv[1]) if len(sys.argv) > 1 else 1000
+
+
+def sample_claims():
+    """
+    Returns claims shaped like the waiting room access token
+    """
+    issued_at = int(time.time())
+    return {
+        "aud": "Sample",
+        "sub": str(uuid.uuid4()),
+        "queue_position": 1,
+        "token_use": "access",
+        "iat": issued_at,
+        "nbf": issued_at,
+        "exp": issued_at + 3600,
+        "iss": "https://example.com"
+    }
+
+
+def benchmark(alg, key_parameters):
+    """
+    Sign and verify ITERATIONS tokens and print the operations per second
+    """
+    keypair = jwk.JWK.generate(kid=str(uuid.uuid4()), alg=alg, **key_parameters)
+    public_key = jwk.JWK(**keypair.export_public(as_dict=True))
+    header = {"alg": alg, "typ": "JWT", "kid": keypair.get("kid")}
+
+    start = time.perf_counter()
+    tokens = []
+    for _ in range(ITERATIONS):
+        token = jwt.JWT(header=header, claims=sample_claims())
+        token.make_signed_token(keypair)
+        tokens.append(token.serialize())
+    sign_seconds = time.perf_counter() - start
+
+    start = time.perf_counter()
+    for token in tokens:
+        jwt.JWT(key=public_key, jwt=token, algs=[alg])
+    verify_seconds = time.perf_counter() - start
+
+    print(f"{alg:6} sign: {ITERATIONS / sign_seconds:10.0f} ops/s  "
+          f"verify: {ITERATIONS / verify_seconds:10.0f} ops/s  "
+          f"token size: {len(tokens[0])} bytes")
+
+
+if __name__ == "__main__":
+    print(f"{ITERATIONS} iterations per algorithm")
+    for algorithm, parameters in KEY_PARAMETERS.items():
+        benchmark(algorithm, parameters)